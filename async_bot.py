@@ -0,0 +1,646 @@
+"""
+Optional asyncio runtime: `python async_bot.py` instead of `python bot.py`.
+Updates are received by telebot's AsyncTeleBot and Postgres is read through an asyncpg pool,
+so /start, text input of the channel/group dialogs, the high-volume buttons (ratings, main menu)
+and broadcast sends run as coroutines and one process keeps thousands of Telegram and Postgres
+requests in flight. Bot API calls share bot.py's outbound limiter and metrics. Everything without
+a coroutine version yet (admin screens and dialogs, other buttons and commands) is handed to the
+synchronous handlers in bot.py on worker threads, never run on the event loop.
+Needs `pip install aiohttp asyncpg` on top of requirements.txt.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import json
+import logging
+import os
+import re
+import time
+
+from telebot import types
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError: # aiohttp is not installed
+    asyncio_helper = None
+    AsyncTeleBot = None
+
+import bot as sync
+
+# Postgres connections held by the asyncpg pool
+ASYNC_DB_POOL_MIN_SIZE = int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', '2'))
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', '20'))
+# Open HTTP connections to the Bot API, and broadcast messages awaiting a reply at once
+ASYNC_REQUEST_LIMIT = int(os.getenv('ASYNC_REQUEST_LIMIT', '100'))
+ASYNC_BROADCAST_CONCURRENCY = int(os.getenv('ASYNC_BROADCAST_CONCURRENCY', '50'))
+# Threads that wait for outbound rate-limit tokens on behalf of coroutines
+ASYNC_LIMITER_THREADS = int(os.getenv('ASYNC_LIMITER_THREADS', '8'))
+
+# Fire-and-forget tasks (webhook updates) are referenced here until they finish
+_background_tasks = set()
+
+def spawn(coro):
+    """Runs a coroutine in the background, keeping a reference so it is not garbage-collected."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# ============ TELEGRAM TRANSPORT ============
+
+# Set by the broadcast worker so its sends (and those of the tasks it starts) take the limiter's bulk lane
+_bulk_sends = contextvars.ContextVar('bulk_sends', default=False)
+
+class AsyncTelegramTransport:
+    """
+    Paces AsyncTeleBot's Bot API calls through bot.py's OutboundLimiter (this process's share of the
+    bot-wide budget, with its priority lanes) and records them in the same metrics as bot.TelegramTransport.
+    asyncio_helper has no CUSTOM_REQUEST_SENDER, so install() wraps _process_request, which every API method calls.
+    """
+    def __init__(self, limiter, threads):
+        self.limiter = limiter
+        # Bulk waits get their own thread so they never hold up an interactive reply's token
+        self._interactive = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='async-limiter')
+        self._bulk = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='async-limiter-bulk')
+        self._process_request = None
+
+    def install(self):
+        if self._process_request is None:
+            self._process_request = asyncio_helper._process_request
+            asyncio_helper._process_request = self.process_request
+
+    def _acquire_bulk(self, chat_id, new_message):
+        with self.limiter.bulk_sends():
+            self.limiter.acquire(chat_id, new_message)
+
+    async def process_request(self, token, url, method='get', params=None, files=None, **kwargs):
+        """Stand-in for asyncio_helper._process_request; `url` is the API method name."""
+        chat_id = params.get('chat_id') if params else None
+        if chat_id is not None:
+            try:
+                chat_id = int(chat_id)
+            except ValueError:
+                pass # @channelusername
+            new_message = url.startswith(('send', 'forward', 'copy'))
+            loop = asyncio.get_running_loop()
+            if _bulk_sends.get():
+                await loop.run_in_executor(self._bulk, self._acquire_bulk, chat_id, new_message)
+            else:
+                await loop.run_in_executor(self._interactive, self.limiter.acquire, chat_id, new_message)
+        started = time.perf_counter()
+        try:
+            result = await self._process_request(token, url, method, params, files, **kwargs)
+            sync.TELEGRAM_API_RESPONSES.inc(url, '200')
+            return result
+        except asyncio_helper.ApiTelegramException as e:
+            sync.TELEGRAM_API_RESPONSES.inc(url, str(e.error_code))
+            retry_after = ((e.result_json or {}).get('parameters') or {}).get('retry_after')
+            if e.error_code == 429 and retry_after:
+                logging.warning(f"Telegram flood limit на {url}, пауза всіх відправок на {retry_after}с")
+                self.limiter.pause(retry_after)
+            raise
+        except Exception:
+            sync.TELEGRAM_API_RESPONSES.inc(url, 'error')
+            raise
+        finally:
+            sync.TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, url)
+
+    def close(self):
+        self._interactive.shutdown(wait=False)
+        self._bulk.shutdown(wait=False)
+
+async_transport = AsyncTelegramTransport(sync.outbound_limiter, ASYNC_LIMITER_THREADS)
+
+# ============ CONVERSATION STATE STORE ============
+
+class AsyncMemoryStateStore:
+    """Awaitable view of bot.py's in-memory store; its operations never block, so they run on the loop."""
+    def __init__(self, store):
+        self._store = store
+
+    async def get(self, chat_id):
+        return self._store.get(chat_id)
+
+    async def set(self, chat_id, state):
+        self._store.set(chat_id, state)
+
+    async def delete(self, chat_id):
+        self._store.delete(chat_id)
+
+class AsyncPostgresStateStore:
+    """
+    Coroutine counterpart of bot.PostgresStateStore: same table and statements, and set() likewise
+    purges expired rows every PURGE_INTERVAL seconds.
+    """
+    PURGE_INTERVAL = sync.PostgresStateStore.PURGE_INTERVAL
+
+    def __init__(self, pool, ttl):
+        self._pool = pool
+        self._ttl = ttl
+        self._last_purge = time.monotonic()
+
+    async def get(self, chat_id):
+        state = await self._pool.fetchval("""
+            SELECT state FROM conversation_states
+            WHERE chat_id = $1 AND expires_at > CURRENT_TIMESTAMP;
+        """, chat_id)
+        return json.loads(state) if state is not None else None
+
+    async def set(self, chat_id, state):
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO conversation_states (chat_id, state, expires_at)
+                    VALUES ($1, $2::jsonb, CURRENT_TIMESTAMP + make_interval(secs => $3))
+                    ON CONFLICT (chat_id) DO UPDATE SET
+                    state = EXCLUDED.state,
+                    expires_at = EXCLUDED.expires_at;
+                """, chat_id, json.dumps(state), float(self._ttl))
+                if time.monotonic() - self._last_purge > self.PURGE_INTERVAL:
+                    self._last_purge = time.monotonic()
+                    await conn.execute("DELETE FROM conversation_states WHERE expires_at <= CURRENT_TIMESTAMP;")
+
+    async def delete(self, chat_id):
+        await self._pool.execute("DELETE FROM conversation_states WHERE chat_id = $1;", chat_id)
+
+# Set by main() once the asyncpg pool is open
+db_pool = None
+user_states = None
+
+async def get_user_profile(chat_id):
+    """Coroutine counterpart of bot.get_user_profile, sharing its cache."""
+    profile = sync.user_profiles.get(chat_id)
+    if profile is None:
+        row = await db_pool.fetchrow("SELECT city, notifications, is_active FROM users WHERE chat_id = $1;", chat_id)
+        profile = dict(row) if row else {}
+        sync.user_profiles.set(chat_id, profile)
+    return profile
+
+async def get_user_city(chat_id):
+    """Coroutine counterpart of bot.get_user_city."""
+    profile = await get_user_profile(chat_id)
+    return profile.get('city') or 'київ'
+
+async def broadcast_template_exists(template_id):
+    """Coroutine counterpart of bot.broadcast_template_exists, sharing its cache."""
+    exists = sync.rating_templates.get(template_id)
+    if exists is None:
+        exists = await db_pool.fetchval("SELECT EXISTS (SELECT 1 FROM broadcast_templates WHERE id = $1);", template_id)
+        sync.rating_templates.set(template_id, exists)
+    return exists
+
+# ============ HANDLERS ============
+
+async_callback_router = sync.CallbackRouter()
+async_callback_route = async_callback_router.route
+
+async def start_message(message, bot):
+    """Handles the /start command, welcoming the user and showing the main menu."""
+    await bot.send_message(message.chat.id, sync.build_welcome_text(message.from_user.first_name),
+                           reply_markup=sync.get_main_menu())
+
+async def forward_message(message, bot):
+    """Passes messages without a coroutine handler to the synchronous bot, off the event loop (its filters read Postgres)."""
+    await asyncio.to_thread(sync.bot.process_new_messages, [message])
+
+async def is_waiting_for_input(message):
+    """Handler filter: true when the chat is in the middle of a multi-step conversation."""
+    state = await user_states.get(message.chat.id)
+    # Keep the state on the message so the handler (or bot.handle_user_input) does not read the store again
+    message.conversation_state = state
+    return bool(state and 'waiting_for' in state)
+
+async def handle_user_input(message, bot):
+    """Handles user input during multi-step processes; the admin dialogs still run on a worker thread."""
+    chat_id = message.chat.id
+    state = message.conversation_state
+    input_type = state['waiting_for']
+    user_input = message.text.strip()
+
+    if input_type.startswith('admin_broadcast_'):
+        await asyncio.to_thread(sync.handle_admin_broadcast_input, message, user_input, input_type, state)
+    elif input_type.startswith(('admin_bot_target_location_', 'admin_comment_template_')):
+        await asyncio.to_thread(sync.handle_admin_bot_activity_input, message, user_input, input_type, state)
+    elif input_type == 'channel_name':
+        await handle_channel_name_input(bot, message, user_input, state)
+    elif input_type == 'group_name':
+        await handle_group_name_input(bot, message, user_input, state)
+    elif input_type == 'channel_link':
+        await complete_channel_addition(bot, message, user_input, state)
+    elif input_type == 'group_link':
+        await complete_group_addition(bot, message, user_input, state)
+    else:
+        # Clear state if an unexpected input type is encountered
+        await user_states.delete(chat_id)
+        await bot.send_message(chat_id, "Неочікуване введення. Будь ласка, спробуйте знову з головного меню.",
+                               reply_markup=sync.get_main_menu())
+
+async def handle_channel_name_input(bot, message, channel_name, state):
+    """Processes the channel name input from the user."""
+    chat_id = message.chat.id
+    clean_name = re.sub(r'[^a-zA-Z0-9_а-яА-ЯіІїЇєЄ]', '', channel_name)
+    if not clean_name:
+        await bot.send_message(chat_id, "❌ Некоректна назва каналу. Спробуйте ще раз:")
+        return
+
+    state['channel_name'] = clean_name
+    state['waiting_for'] = 'channel_link'
+    await user_states.set(chat_id, state)
+    await bot.send_message(chat_id, f"📺 Канал: @{clean_name}\n\nТепер введіть посилання на канал (https://t.me/...):")
+
+async def handle_group_name_input(bot, message, group_name, state):
+    """Processes the group name input from the user."""
+    chat_id = message.chat.id
+    clean_name = re.sub(r'[^a-zA-Z0-9_а-яА-ЯіІїЇєЄ]', '', group_name)
+    if not clean_name:
+        await bot.send_message(chat_id, "❌ Некоректна назва групи. Спробуйте ще раз:")
+        return
+
+    state['group_name'] = clean_name
+    state['waiting_for'] = 'group_link'
+    await user_states.set(chat_id, state)
+    await bot.send_message(chat_id, f"👥 Група: @{clean_name}\n\nТепер введіть посилання на групу (https://t.me/...):")
+
+async def complete_channel_addition(bot, message, channel_link, state):
+    """Completes the channel addition process, saving data to the database."""
+    chat_id = message.chat.id
+    if not channel_link.startswith('https://t.me/'):
+        await bot.send_message(chat_id, "❌ Посилання має починатися з https://t.me/\nСпробуйте ще раз:")
+        return
+
+    channel_name = state.get('channel_name')
+    if not channel_name:
+        await bot.send_message(chat_id, "Назва каналу не знайдена. Будь ласка, почніть знову.",
+                               reply_markup=sync.get_main_menu())
+        await user_states.delete(chat_id)
+        return
+
+    try:
+        user_city = await get_user_city(chat_id)
+        await db_pool.execute("""
+            INSERT INTO target_channels (channel_name, channel_link, city, added_by)
+            VALUES ($1, $2, $3, $4);
+        """, channel_name, channel_link, user_city, chat_id)
+        await user_states.delete(chat_id)
+        city_hashtag = sync.UKRAINIAN_CITIES.get(user_city, f"#{user_city.replace('_', ' ').title()}")
+        await bot.send_message(
+            chat_id,
+            f"✅ Канал успішно додано!\n\n"
+            f"📺 @{channel_name}\n"
+            f"🏙️ Місто: {user_city.replace('_', ' ').title()} {city_hashtag}\n"
+            f"🔗 {channel_link}",
+            reply_markup=sync.get_main_menu()
+        )
+    except Exception as e:
+        logging.error(f"Помилка при додаванні каналу: {e}")
+        await bot.send_message(chat_id, "❌ Сталася помилка при додаванні каналу.")
+        await user_states.delete(chat_id)
+
+async def complete_group_addition(bot, message, group_link, state):
+    """Completes the group addition process, saving data to the database."""
+    chat_id = message.chat.id
+    if not group_link.startswith('https://t.me/'):
+        await bot.send_message(chat_id, "❌ Посилання має починатися з https://t.me/\nСпробуйте ще раз:")
+        return
+
+    group_name = state.get('group_name')
+    if not group_name:
+        await bot.send_message(chat_id, "Назва групи не знайдена. Будь ласка, почніть знову.",
+                               reply_markup=sync.get_main_menu())
+        await user_states.delete(chat_id)
+        return
+
+    try:
+        user_city = await get_user_city(chat_id)
+        await db_pool.execute("""
+            INSERT INTO target_groups (group_name, group_link, city, added_by)
+            VALUES ($1, $2, $3, $4);
+        """, group_name, group_link, user_city, chat_id)
+        await user_states.delete(chat_id)
+        city_hashtag = sync.UKRAINIAN_CITIES.get(user_city, f"#{user_city.replace('_', ' ').title()}")
+        await bot.send_message(
+            chat_id,
+            f"✅ Група успішно додана!\n\n"
+            f"👥 @{group_name}\n"
+            f"🏙️ Місто: {user_city.replace('_', ' ').title()} {city_hashtag}\n"
+            f"🔗 {group_link}",
+            reply_markup=sync.get_main_menu()
+        )
+    except Exception as e:
+        logging.error(f"Помилка при додаванні групи: {e}")
+        await bot.send_message(chat_id, "❌ Сталася помилка при додаванні групи.")
+        await user_states.delete(chat_id)
+
+async def callback_handler(call, bot):
+    """Answers the callback query, then runs its coroutine route or the synchronous one on a worker thread."""
+    await bot.answer_callback_query(call.id)
+    try:
+        found = async_callback_router.resolve(call.data)
+        if found:
+            route, params = found
+            started = time.perf_counter()
+            try:
+                await route.handler(call, bot, **params)
+            except Exception:
+                sync.CALLBACK_ERRORS.inc(route.pattern)
+                raise
+            finally:
+                sync.CALLBACK_SECONDS.observe(time.perf_counter() - started, route.pattern)
+        else:
+            await asyncio.to_thread(sync.callback_router.dispatch, call)
+    except Exception as e:
+        logging.error(f"Помилка в callback_handler ({call.data}): {e}")
+        await bot.send_message(call.message.chat.id, "Сталася помилка під час обробки вашого запиту. "
+                                                     "Спробуйте ще раз або зверніться до адміністратора.")
+
+@async_callback_route("main_menu")
+async def show_main_menu(call, bot):
+    """Returns the user to the main menu."""
+    await bot.edit_message_text("Головне меню:", call.message.chat.id, call.message.message_id,
+                                reply_markup=sync.get_main_menu())
+
+@async_callback_route("skip_rating")
+async def skip_rating(call, bot):
+    """Dismisses the rating prompt."""
+    await bot.edit_message_text("Добре, ви пропустили оцінку.", call.message.chat.id, call.message.message_id,
+                                reply_markup=sync.get_main_menu())
+
+@async_callback_route("rate_{template_id:int}_{rating:int}")
+async def handle_rating(call, bot, template_id, rating):
+    """Handles user rating of a broadcast message."""
+    chat_id = call.message.chat.id
+    rejection = sync.rating_rejection(rating, await get_user_profile(chat_id), await broadcast_template_exists(template_id))
+    if rejection:
+        await bot.edit_message_text(rejection, chat_id, call.message.message_id, reply_markup=sync.get_main_menu())
+        return
+    # RatingWriter.submit only buffers the rating, so it is safe to call from the event loop
+    sync.rating_writer.submit(chat_id, template_id, rating)
+    await bot.edit_message_text(sync.build_rating_thanks_text(rating), chat_id, call.message.message_id,
+                                reply_markup=sync.get_main_menu())
+
+def create_bot():
+    """Builds the AsyncTeleBot with its handlers; /start, text input and buttons first, everything else falls through."""
+    asyncio_helper.REQUEST_LIMIT = ASYNC_REQUEST_LIMIT
+    if sync.TELEGRAM_API_URL:
+        asyncio_helper.API_URL = sync.TELEGRAM_API_URL
+    async_transport.install()
+    abot = AsyncTeleBot(sync.TOKEN)
+    abot.register_message_handler(start_message, commands=['start'], pass_bot=True)
+    abot.register_message_handler(handle_user_input, func=is_waiting_for_input, pass_bot=True)
+    abot.register_message_handler(forward_message, func=lambda message: True, pass_bot=True)
+    abot.register_callback_query_handler(callback_handler, func=lambda call: True, pass_bot=True)
+    return abot
+
+# ============ BROADCAST DELIVERY ============
+
+async def claim_broadcast_deliveries(pool, limit, stale_after):
+    """Same claim as bot.claim_broadcast_deliveries, over asyncpg."""
+    return await pool.fetch("""
+        WITH claimable AS (
+            SELECT job_id, chat_id FROM broadcast_deliveries
+            WHERE status IN ('pending', 'sending')
+              AND (status = 'pending' OR claimed_at < CURRENT_TIMESTAMP - make_interval(secs => $1))
+            ORDER BY job_id, chat_id
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE broadcast_deliveries d
+        SET status = 'sending', claimed_at = CURRENT_TIMESTAMP, attempts = d.attempts + 1
+        FROM claimable
+        WHERE d.job_id = claimable.job_id AND d.chat_id = claimable.chat_id
+        RETURNING d.job_id, d.chat_id, d.city;
+    """, float(stale_after), limit)
+
+async def get_broadcast_job(pool, job_id):
+    """Retrieves a single broadcast job by ID."""
+    return await pool.fetchrow("SELECT id, template_id, name, message, requested_by FROM broadcast_jobs WHERE id = $1;",
+                               job_id)
+
+async def record_broadcast_deliveries(pool, job_id, outcomes):
+    """Stores the (chat_id, status, error_message) outcomes of one job's batch and bumps its counters in one statement."""
+    chat_ids, statuses, errors = zip(*outcomes)
+    await pool.execute("""
+        WITH recorded AS (
+            UPDATE broadcast_deliveries d
+            SET status = o.status, error_message = o.error_message, attempted_at = CURRENT_TIMESTAMP
+            FROM unnest($2::bigint[], $3::text[], $4::text[]) AS o(chat_id, status, error_message)
+            WHERE d.job_id = $1 AND d.chat_id = o.chat_id AND d.status = 'sending'
+            RETURNING d.status
+        )
+        UPDATE broadcast_jobs
+        SET sent_count = sent_count + (SELECT count(*) FROM recorded WHERE status = 'sent'),
+            failed_count = failed_count + (SELECT count(*) FROM recorded WHERE status = 'failed'),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = $1;
+    """, job_id, list(chat_ids), list(statuses), list(errors))
+
+async def complete_finished_broadcast_jobs(pool, job_ids):
+    """Marks fully expanded jobs with no pending or in-flight deliveries as completed and returns them."""
+    return await pool.fetch("""
+        UPDATE broadcast_jobs j
+        SET status = 'completed', finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+        WHERE j.id = ANY($1::int[]) AND j.status = 'running' AND j.expanded = TRUE
+        AND NOT EXISTS (
+            SELECT 1 FROM broadcast_deliveries d
+            WHERE d.job_id = j.id AND d.status IN ('pending', 'sending')
+        )
+        RETURNING j.id, j.name, j.requested_by, j.sent_count, j.failed_count, j.created_at, j.finished_at;
+    """, job_ids)
+
+async def send_broadcast_message(bot, in_flight, chat_id, text, reply_markup):
+    """Sends one broadcast message, waiting out 429 flood limits; returns (chat_id, status, error_message)."""
+    async with in_flight:
+        for attempt in range(sync.BROADCAST_MAX_RETRIES + 1):
+            try:
+                await bot.send_message(chat_id, text, reply_markup=reply_markup)
+                return chat_id, 'sent', None
+            except asyncio_helper.ApiTelegramException as e:
+                if e.error_code == 429 and attempt < sync.BROADCAST_MAX_RETRIES:
+                    # The transport has already paused the shared limiter for retry_after
+                    continue
+                if sync.is_permanent_delivery_error(e.error_code, e.description):
+                    logging.info(f"Користувач {chat_id} недоступний ({e.description}), буде деактивований")
+                    # Only buffers the chat_id; the batch is written from UnreachableUsers' own thread
+                    sync.unreachable_users.submit(chat_id, e.description)
+                    return chat_id, 'failed', str(e)
+                logging.error(f"Помилка відправки повідомлення {chat_id}: {e}")
+                return chat_id, 'failed', str(e)
+            except Exception as e:
+                logging.error(f"Помилка відправки повідомлення {chat_id}: {e}")
+                return chat_id, 'failed', str(e)
+        return chat_id, 'failed', "retries exhausted"
+
+async def deliver_job_batch(bot, pool, in_flight, job_row, deliveries):
+    """Sends one job's claimed deliveries concurrently and writes the outcomes back in one round trip."""
+    keyboard = sync.get_rating_keyboard(job_row['template_id']) if job_row['template_id'] else None
+    outcomes = await asyncio.gather(*(
+        send_broadcast_message(bot, in_flight, chat_id, text, reply_markup)
+        for chat_id, text, reply_markup in sync.build_broadcast_messages(deliveries, job_row['message'], keyboard)
+    ))
+    for chat_id, status, error_message in outcomes:
+        sync.BROADCAST_MESSAGES.inc(status)
+    try:
+        await record_broadcast_deliveries(pool, job_row['id'], outcomes)
+    except Exception as e:
+        # The claims expire after BROADCAST_CLAIM_TIMEOUT and are retried
+        logging.error(f"Error recording deliveries of job {job_row['id']}: {e}")
+
+async def run_broadcast_worker(bot, pool):
+    """Coroutine counterpart of bot.run_broadcast_worker sharing the same Postgres queue and outbound limiter."""
+    _bulk_sends.set(True) # Inherited by the send tasks started below
+    in_flight = asyncio.Semaphore(ASYNC_BROADCAST_CONCURRENCY)
+    job_cache = {}
+    while True:
+        try:
+            claimed = await claim_broadcast_deliveries(pool, sync.BROADCAST_CLAIM_BATCH, sync.BROADCAST_CLAIM_TIMEOUT)
+        except Exception as e:
+            logging.error(f"Помилка при отриманні доставок з черги: {e}")
+            claimed = []
+        if not claimed:
+            await asyncio.sleep(sync.BROADCAST_POLL_INTERVAL)
+            continue
+
+        deliveries_by_job = collections.defaultdict(list)
+        for delivery in claimed:
+            deliveries_by_job[delivery['job_id']].append(delivery)
+
+        batches = []
+        for job_id, deliveries in deliveries_by_job.items():
+            job_row = job_cache.get(job_id) or await get_broadcast_job(pool, job_id)
+            if not job_row:
+                continue
+            job_cache[job_id] = job_row
+            batches.append(deliver_job_batch(bot, pool, in_flight, job_row, deliveries))
+        await asyncio.gather(*batches)
+
+        try:
+            finished_jobs = await complete_finished_broadcast_jobs(pool, list(deliveries_by_job))
+        except Exception as e:
+            logging.error(f"Error completing broadcast jobs {list(deliveries_by_job)}: {e}")
+            finished_jobs = []
+        for job_row in finished_jobs:
+            job_cache.pop(job_row['id'], None)
+            logging.info(f"Розсилка '{job_row['name']}' (job {job_row['id']}) завершена: "
+                         f"надіслано {job_row['sent_count']}, помилок {job_row['failed_count']}")
+            if not job_row['requested_by']:
+                continue
+            try:
+                await bot.send_message(job_row['requested_by'], sync.build_broadcast_report_text(job_row),
+                                       parse_mode='Markdown', reply_markup=sync.get_admin_broadcast_menu())
+            except Exception as e:
+                logging.error(f"Не вдалося надіслати звіт про розсилку {job_row['id']}: {e}")
+
+# ============ WEBHOOK SERVER ============
+
+async def metrics_endpoint(request):
+    from aiohttp import web
+    if sync.METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {sync.METRICS_TOKEN}":
+        return web.Response(status=403)
+    return web.Response(body=sync.metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def health(request):
+    from aiohttp import web
+    return web.Response(text='ok')
+
+async def start_metrics_server(port):
+    """Serves /metrics and the health check on `port` (polling mode); returns the runner to clean up."""
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get(sync.METRICS_PATH, metrics_endpoint)
+    app.router.add_get('/{tail:.*}', health)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logging.info(f"Метрики доступні на порту {port}{sync.METRICS_PATH}")
+    return runner
+
+async def run_webhook_server(bot):
+    """Registers the webhook with Telegram and serves updates on PORT until cancelled."""
+    from aiohttp import web
+
+    async def handle_update(request):
+        if sync.WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != sync.WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.text())
+        except Exception as e:
+            logging.error(f"Некоректне оновлення від вебхука: {e}")
+            return web.Response(status=400)
+        # Acknowledge straight away so Telegram never waits on a handler
+        spawn(bot.process_new_updates([update]))
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(sync.WEBHOOK_PATH, handle_update)
+    app.router.add_get(sync.METRICS_PATH, metrics_endpoint)
+    app.router.add_get('/{tail:.*}', health)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', sync.PORT).start()
+
+    await bot.remove_webhook()
+    await bot.set_webhook(url=f"{sync.WEBHOOK_URL.rstrip('/')}{sync.WEBHOOK_PATH}", secret_token=sync.WEBHOOK_SECRET,
+                          max_connections=sync.WEBHOOK_MAX_CONNECTIONS)
+    logging.info(f"Async вебхук-сервер слухає порт {sync.PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# ============ MAIN FUNCTION ============
+
+async def main():
+    global db_pool, user_states
+    abot = create_bot()
+    pool = await asyncpg.create_pool(sync.DATABASE_URL, min_size=ASYNC_DB_POOL_MIN_SIZE, max_size=ASYNC_DB_POOL_MAX_SIZE)
+    db_pool = pool
+    if sync.STATE_STORE == 'postgres':
+        user_states = AsyncPostgresStateStore(pool, sync.STATE_TTL)
+    else:
+        user_states = AsyncMemoryStateStore(sync.user_states)
+    # Pick up broadcasts that were cut short by a restart
+    await asyncio.to_thread(sync.resume_broadcast_jobs)
+    if sync.BROADCAST_INPROCESS_WORKER:
+        spawn(run_broadcast_worker(abot, pool))
+    logging.info("Бот запущено (asyncio)...")
+    metrics_runner = None
+    try:
+        if sync.BOT_MODE == 'webhook':
+            await run_webhook_server(abot)
+        else:
+            if sync.METRICS_PORT:
+                metrics_runner = await start_metrics_server(sync.METRICS_PORT)
+            # Telegram refuses getUpdates while a webhook is registered
+            await abot.remove_webhook()
+            await abot.infinity_polling()
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await pool.close()
+        await abot.close_session()
+        async_transport.close()
+
+if __name__ == '__main__':
+    if asyncpg is None or AsyncTeleBot is None:
+        raise SystemExit("Для async-режиму потрібні пакети aiohttp та asyncpg: pip install aiohttp asyncpg")
+    sync.init_db()
+    sync.warm_keyboards()
+    sync.audience_index.load()
+    sync.install_profile_signal()
+    sync.rate_share.start()
+    try:
+        asyncio.run(main())
+    finally:
+        sync.rating_writer.close()
+        sync.unreachable_users.close()
+        sync.rate_share.close()
+        sync.db_pool.closeall()
+        sync.telegram_transport.close()
@@ -1,12 +1,31 @@
 import os
 import logging
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import Json, RealDictCursor, execute_values
 from dotenv import load_dotenv
-from telebot import TeleBot, types
+from telebot import TeleBot, apihelper, types
+from telebot.apihelper import ApiTelegramException
+import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import abc
+import array
+import atexit
+import bisect
+import collections
+import contextlib
+import functools
+import inspect
+import io
 import json
+import queue
 import re
+import signal
+import socket
+import sys
+import tempfile
+import threading
 import time
 
 load_dotenv()
@@ -16,12 +35,19 @@ TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 CHANNEL_ID = -1002510470267 # Example channel ID, replace with your actual channel ID if needed
 DATABASE_URL = os.getenv('DATABASE_URL')
 
-bot = TeleBot(TOKEN)
+# Update delivery: 'webhook' (production, needs WEBHOOK_URL) or 'polling' (local development fallback)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+BOT_MODE = os.getenv('BOT_MODE', 'webhook' if WEBHOOK_URL else 'polling')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram-webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+PORT = int(os.getenv('PORT', '8080'))
+# Size of the thread pool that runs message/callback handlers
+BOT_WORKER_THREADS = int(os.getenv('BOT_WORKER_THREADS', '16'))
+
+bot = TeleBot(TOKEN, num_threads=BOT_WORKER_THREADS)
 logging.basicConfig(level=logging.INFO)
 
-# Dictionary to store temporary user data for multi-step conversations
-user_states = {}
-
 # List of allowed admin chat IDs (IMPORTANT: replace with actual admin IDs in production)
 ALLOWED_ADMINS = [int(admin_id) for admin_id in os.getenv('TELEGRAM_ADMIN_IDS', '').split(',') if admin_id.strip()]
 if not ALLOWED_ADMINS:
@@ -67,160 +93,1553 @@ UKRAINIAN_CITIES = {
     'прип\'ять': '#Припять' # Similar to Chernobyl, for completeness
 }
 
-def get_db_connection():
-    """Establishes and returns a database connection."""
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn
+# ============ METRICS ============
+# In-process counters, histograms and gauges, rendered in the Prometheus text format on /metrics
+# by the webhook server (or, in polling mode, by a small server on METRICS_PORT).
+# Observations take one lock and a bisect, cheap enough to leave on.
+
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+# When set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram in seconds."""
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def copy(self):
+        histogram = LatencyHistogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count, histogram.total, histogram.max = self.count, self.total, self.max
+        return histogram
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (capped by the observed maximum)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+# Database statements are mostly sub-millisecond
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf'))
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in zip(names, values)) + '}'
+
+class MetricFamily:
+    """A named metric with one child per combination of label values."""
+    type_name = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+class Counter(MetricFamily):
+    type_name = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._children[label_values] = self._children.get(label_values, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._children)
+
+    def _samples(self):
+        for label_values, value in sorted(self.values().items()):
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Histogram(MetricFamily):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LatencyHistogram.BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, seconds, *label_values):
+        with self._lock:
+            child = self._children.get(label_values)
+            if child is None:
+                child = self._children[label_values] = LatencyHistogram(self.buckets)
+            child.observe(seconds)
+
+    def snapshot(self):
+        """Returns {label values: LatencyHistogram copy}."""
+        with self._lock:
+            return {label_values: child.copy() for label_values, child in self._children.items()}
+
+    def _samples(self):
+        bucket_labels = self.labels + ('le',)
+        for label_values, child in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                yield f"{self.name}_bucket{_format_labels(bucket_labels, label_values + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {child.total}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {child.count}"
+
+class Gauge(MetricFamily):
+    """Value read from a callback when /metrics is scraped."""
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, callback):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def _samples(self):
+        try:
+            yield f"{self.name} {self.callback()}"
+        except Exception as e:
+            logging.error(f"Не вдалося прочитати метрику {self.name}: {e}")
+
+class MetricsRegistry:
+    """Holds every metric family of the process and renders them for /metrics."""
+    def __init__(self):
+        self._families = []
+
+    def _register(self, family):
+        self._families.append(family)
+        return family
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LatencyHistogram.BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, callback):
+        return self._register(Gauge(name, help_text, callback))
+
+    def render(self):
+        return '\n'.join(family.render() for family in self._families) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram('bot_handler_seconds', "Message handler latency by command", ('handler',))
+HANDLER_ERRORS = metrics.counter('bot_handler_errors_total', "Message handler exceptions by command", ('handler',))
+CALLBACK_SECONDS = metrics.histogram('bot_callback_seconds', "Callback route latency", ('route',))
+CALLBACK_ERRORS = metrics.counter('bot_callback_errors_total', "Callback route exceptions", ('route',))
+DB_QUERY_SECONDS = metrics.histogram('db_query_seconds', "SQL statement latency by calling helper", ('helper',), DB_BUCKETS)
+DB_QUERY_ERRORS = metrics.counter('db_query_errors_total', "Failed SQL statements by calling helper", ('helper',))
+TELEGRAM_API_SECONDS = metrics.histogram('telegram_api_seconds', "Bot API request latency", ('method',))
+TELEGRAM_API_RESPONSES = metrics.counter('telegram_api_responses_total',
+                                         "Bot API responses by HTTP status ('error' for transport failures)",
+                                         ('method', 'code'))
+BROADCAST_MESSAGES = metrics.counter('broadcast_messages_total', "Broadcast messages attempted by outcome", ('result',))
+metrics.gauge('broadcast_queue_depth', "Messages waiting in the in-process delivery queue",
+              lambda: broadcast_engine.queue_depth)
+metrics.gauge('conversation_states', "Active multi-step conversations", lambda: len(user_states))
+metrics.gauge('profile_cache_entries', "Cached user profiles", lambda: len(user_profiles))
+metrics.gauge('db_pool_open_connections', "Open pooled Postgres connections", lambda: db_pool.open_connections)
+metrics.gauge('db_pool_idle_connections', "Idle pooled Postgres connections", lambda: db_pool.idle_connections)
+metrics.gauge('rating_writer_pending', "Ratings waiting for the next batch write", lambda: rating_writer.pending)
+
+def timed_handler(name):
+    """Decorator recording a message handler's latency and exceptions under handler=name."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(message, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return handler(message, *args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+# Statements slower than this (ms) are logged and aggregated for /slow_queries
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '500'))
+SLOW_QUERY_MAX_ENTRIES = int(os.getenv('SLOW_QUERY_MAX_ENTRIES', '200'))
+
+def _param_shape(value):
+    if isinstance(value, (list, tuple, str)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+def describe_params(params):
+    """Types and sizes of statement parameters, without their values (which may hold user data)."""
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f"{key}: {_param_shape(value)}" for key, value in params.items()) + '}'
+    return '(' + ', '.join(_param_shape(value) for value in params) + ')'
+
+class SlowQueryLog:
+    """Aggregates slow statements by (helper, SQL); the entry with the least total time is evicted when full."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def record(self, helper, sql, params_shape, seconds, error=None):
+        logging.warning(f"Повільний запит {seconds * 1000:.0f} мс у {helper} {params_shape}"
+                        f"{f' ({error})' if error else ''}: {sql[:500]}")
+        key = (helper, sql)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k]['total'])]
+                entry = self._entries[key] = {'helper': helper, 'sql': sql, 'calls': 0, 'errors': 0,
+                                              'total': 0.0, 'max': 0.0}
+            entry['calls'] += 1
+            entry['errors'] += error is not None
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['params'] = params_shape
+            entry['last_seen'] = datetime.now()
+
+    def top(self, n):
+        """The n statements with the most total slow time."""
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries.values()]
+        return sorted(entries, key=lambda entry: entry['total'], reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+
+slow_queries = SlowQueryLog(SLOW_QUERY_MAX_ENTRIES)
+
+def calling_helper():
+    """Qualified name of the innermost bot.py function on the stack above the cursor."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == __file__:
+            return getattr(code, 'co_qualname', code.co_name)
+        frame = frame.f_back
+    return 'other'
+
+class InstrumentedCursor(RealDictCursor):
+    """
+    RealDictCursor that times every statement and attributes it to the helper that issued it;
+    statements over SLOW_QUERY_THRESHOLD_MS also go to the slow query log.
+    """
+    def execute(self, query, vars=None):
+        helper = calling_helper()
+        started = time.perf_counter()
+        error = None
+        try:
+            return super().execute(query, vars)
+        except Exception as e:
+            DB_QUERY_ERRORS.inc(helper)
+            error = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed, helper)
+            if elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+                slow_queries.record(helper, self._sql_text(query), describe_params(vars), elapsed, error)
+
+    def _sql_text(self, query):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        elif not isinstance(query, str):
+            query = query.as_string(self.connection) # psycopg2.sql.Composed
+        return ' '.join(query.split())
+
+# ============ SAMPLING PROFILER ============
+# Samples the stacks of every thread with sys._current_frames() and aggregates them in the
+# collapsed-stack format read by flamegraph.pl and speedscope. Runs on demand from /profile
+# or SIGUSR1, so the live process can be profiled without a restart.
+
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.01'))
+PROFILE_DEFAULT_SECONDS = int(os.getenv('PROFILE_DEFAULT_SECONDS', '30'))
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '300'))
+# Where profiles started by the signal are also written
+PROFILE_DIR = os.getenv('PROFILE_DIR', tempfile.gettempdir())
+# Frames of threads parked waiting for work; left in the file but kept out of the caption's top list
+PROFILE_IDLE_FRAMES = ('Queue.get (queue.py', 'Event.wait (threading.py', 'select (selectors.py')
+
+class SamplingProfiler:
+    """Wall-clock sampling profiler over every thread of the process; one profile at a time."""
+    def __init__(self, interval):
+        self.interval = interval
+        self._running = threading.Lock()
+
+    @staticmethod
+    def _frame_label(code):
+        name = getattr(code, 'co_qualname', code.co_name)
+        return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    @staticmethod
+    def _thread_label(name):
+        # Pool threads differ only by a numeric suffix; merging them gives one tower per pool
+        return re.sub(r'[-_]?\d+$', '', name) or name
+
+    def sample(self, seconds):
+        """Samples for `seconds`; returns (Counter of collapsed stacks, number of sampling rounds)."""
+        stacks = collections.Counter()
+        labels = {} # code object -> frame label
+        own = threading.get_ident()
+        rounds = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = self._frame_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(self._thread_label(names.get(ident, str(ident))))
+                stacks[';'.join(reversed(stack))] += 1
+            rounds += 1
+            time.sleep(self.interval)
+        return stacks, rounds
+
+    def profile(self, seconds):
+        """Runs one profile; returns (collapsed text, summary) or None if another one is running."""
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            started = time.monotonic()
+            stacks, rounds = self.sample(seconds)
+            elapsed = time.monotonic() - started
+        finally:
+            self._running.release()
+
+        collapsed = ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+        leaves = collections.Counter()
+        idle = 0
+        for stack, count in stacks.items():
+            if any(frame in stack for frame in PROFILE_IDLE_FRAMES):
+                idle += count
+            else:
+                leaves[stack.rsplit(';', 1)[-1]] += count
+        summary = {'seconds': elapsed, 'rounds': rounds, 'samples': sum(stacks.values()), 'idle': idle,
+                   'top': leaves.most_common(5)}
+        return collapsed, summary
+
+profiler = SamplingProfiler(PROFILE_SAMPLE_INTERVAL)
+
+def build_profile_caption(summary):
+    busy = summary['samples'] - summary['idle']
+    caption = (f"🔥 Профіль за {summary['seconds']:.0f} с: {summary['rounds']} знімків, "
+               f"{summary['samples']} стеків потоків, з них {summary['idle']} у очікуванні роботи.\n"
+               f"Найчастіші функції серед активних:\n")
+    for label, count in summary['top']:
+        caption += f"{count * 100 / (busy or 1):.1f}% {label}\n"
+    return caption[:1024] # Telegram's caption limit
+
+def run_profile(seconds, chat_ids, save=False):
+    """Profiles the process for `seconds` and sends the collapsed stacks to every chat in chat_ids."""
+    result = profiler.profile(seconds)
+    if result is None:
+        for chat_id in chat_ids:
+            bot.send_message(chat_id, "⏳ Профілювання вже виконується, спробуйте пізніше.")
+        return
+    collapsed, summary = result
+    filename = f"profile-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.folded"
+    if save:
+        path = os.path.join(PROFILE_DIR, filename)
+        with open(path, 'w') as f:
+            f.write(collapsed)
+        logging.info(f"Профіль записано у {path}")
+    caption = build_profile_caption(summary)
+    for chat_id in chat_ids:
+        try:
+            bot.send_document(chat_id, types.InputFile(io.BytesIO(collapsed.encode('utf-8')), filename),
+                              caption=caption)
+        except Exception as e:
+            logging.error(f"Не вдалося надіслати профіль адміну {chat_id}: {e}")
 
-def init_db():
-    """Initializes the database by creating necessary tables and populating initial data."""
-    conn = get_db_connection()
-    with conn:
-        with conn.cursor() as cur:
-            # Table for logging invite attempts
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS invite_logs (
-                    id SERIAL PRIMARY KEY,
-                    user_chat_id BIGINT NOT NULL,
-                    status VARCHAR(10) NOT NULL,
-                    error_message TEXT,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
+def start_profile(seconds, chat_ids, save=False):
+    threading.Thread(target=run_profile, args=(seconds, chat_ids, save), name="sampling-profiler",
+                     daemon=True).start()
 
-            # Table for storing metadata related to invites (e.g., last invite time)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS invite_meta (
-                    id SERIAL PRIMARY KEY,
-                    last_invite_time TIMESTAMP
-                );
-            """)
+def install_profile_signal():
+    """SIGUSR1 profiles the process for PROFILE_DEFAULT_SECONDS, saves the result and sends it to all admins."""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    def handle_signal(signum, frame):
+        logging.info(f"Отримано SIGUSR1, профілювання {PROFILE_DEFAULT_SECONDS} с")
+        start_profile(PROFILE_DEFAULT_SECONDS, ALLOWED_ADMINS, save=True)
+    signal.signal(signal.SIGUSR1, handle_signal)
+
+# ============ TELEGRAM TRANSPORT ============
+
+# Bot API HTTP settings (seconds where applicable); TELEGRAM_API_URL points the bot at a local Bot API server,
+# e.g. http://localhost:8081/bot{0}/{1}
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '32'))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', '5'))
+TELEGRAM_READ_TIMEOUT = float(os.getenv('TELEGRAM_READ_TIMEOUT', '30'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Outbound limits shared by every send path: Telegram allows ~30 messages/s per bot overall,
+# about 1 message/s per private chat and 20 messages/min per group or channel.
+# TELEGRAM_RATE_PER_SECOND is the bot-wide budget: every process sending to Telegram (web, worker dynos)
+# paces itself to TELEGRAM_RATE_PER_SECOND / live senders (see RateShare). BROADCAST_RATE_PER_SECOND is
+# its older name and is still honoured.
+TELEGRAM_RATE_PER_SECOND = float(os.getenv('TELEGRAM_RATE_PER_SECOND', os.getenv('BROADCAST_RATE_PER_SECOND', '25')))
+# Seconds between a sender's heartbeats; a sender silent for three heartbeats no longer counts
+TELEGRAM_SHARE_HEARTBEAT = float(os.getenv('TELEGRAM_SHARE_HEARTBEAT', '10'))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1.0'))
+TELEGRAM_GROUP_INTERVAL = float(os.getenv('TELEGRAM_GROUP_INTERVAL', '3.0'))
+# Tokens of the global bucket that bulk (broadcast) sends leave for interactive replies
+TELEGRAM_INTERACTIVE_RESERVE = float(os.getenv('TELEGRAM_INTERACTIVE_RESERVE', '5'))
+
+class OutboundLimiter:
+    """
+    Paces Bot API calls that target a chat: one global token bucket plus a minimum spacing between new
+    messages to the same chat (private chats and groups/channels have separate intervals).
+    Sends run in the interactive lane unless the calling thread is inside bulk_sends(); bulk sends only take
+    a token while no interactive send is waiting and leave `reserve` tokens in the bucket for replies.
+    """
+    def __init__(self, rate, chat_interval, group_interval, reserve):
+        self._rate = rate
+        self._capacity = max(rate, reserve + 1)
+        self._reserve = reserve
+        self._chat_interval = chat_interval
+        self._group_interval = group_interval
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._interactive_waiting = 0
+        self._next_slot = {} # chat_id -> earliest time of its next message
+        self._cond = threading.Condition()
+        self._lane = threading.local()
+
+    @contextlib.contextmanager
+    def bulk_sends(self):
+        """Marks Bot API calls made by the current thread as bulk traffic."""
+        previous = getattr(self._lane, 'bulk', False)
+        self._lane.bulk = True
+        try:
+            yield
+        finally:
+            self._lane.bulk = previous
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate):
+        """Changes the global rate (this process's share of the bot-wide budget) without losing accrued tokens."""
+        with self._cond:
+            now = time.monotonic()
+            if now >= self._paused_until:
+                elapsed = now - max(self._updated_at, self._paused_until)
+                self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+                self._updated_at = now
+            self._rate = rate
+            self._capacity = max(rate, self._reserve + 1)
+            self._tokens = min(self._tokens, self._capacity)
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        """Stops all sends for `seconds` (Telegram's retry_after after a 429)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def acquire(self, chat_id, new_message):
+        """Blocks until a call to chat_id may go out; new_message also applies the per-chat spacing."""
+        if new_message:
+            self._wait_chat_slot(chat_id)
+        self._take_token(getattr(self._lane, 'bulk', False))
+
+    def _wait_chat_slot(self, chat_id):
+        # Negative ids and @usernames are groups and channels
+        interval = self._chat_interval if isinstance(chat_id, int) and chat_id > 0 else self._group_interval
+        with self._cond:
+            now = time.monotonic()
+            if len(self._next_slot) > 10000:
+                self._next_slot = {cid: slot for cid, slot in self._next_slot.items() if slot > now}
+            slot = max(now, self._next_slot.get(chat_id, now))
+            self._next_slot[chat_id] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _take_token(self, bulk):
+        floor = 1 + (self._reserve if bulk else 0)
+        with self._cond:
+            if not bulk:
+                self._interactive_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now < self._paused_until:
+                        wait = self._paused_until - now
+                    else:
+                        elapsed = now - max(self._updated_at, self._paused_until)
+                        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+                        self._updated_at = now
+                        if self._tokens >= floor and not (bulk and self._interactive_waiting):
+                            self._tokens -= 1
+                            return
+                        wait = max(floor - self._tokens, 0) / self._rate or 1 / self._rate
+                    self._cond.wait(wait)
+            finally:
+                if not bulk:
+                    self._interactive_waiting -= 1
+                    self._cond.notify_all()
+
+class TelegramTransport:
+    """
+    Sends every Bot API request over one shared keep-alive session, paced by an OutboundLimiter,
+    and records per-method latency and response codes in the metrics registry.
+    """
+    def __init__(self, pool_size, connect_timeout, read_timeout, limiter):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.limiter = limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def install(self):
+        """Routes telebot's apihelper through this transport."""
+        apihelper.CONNECT_TIMEOUT = self.connect_timeout
+        apihelper.READ_TIMEOUT = self.read_timeout
+        if TELEGRAM_API_URL:
+            apihelper.API_URL = TELEGRAM_API_URL
+        apihelper.CUSTOM_REQUEST_SENDER = self.send
+
+    def send(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """apihelper.CUSTOM_REQUEST_SENDER hook; returns the raw response for apihelper to check."""
+        api_method = url.rsplit('/', 1)[-1]
+        chat_id = params.get('chat_id') if params else None
+        if chat_id is not None:
+            try:
+                chat_id = int(chat_id)
+            except ValueError:
+                pass # @channelusername
+            self.limiter.acquire(chat_id, api_method.startswith(('send', 'forward', 'copy')))
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+            TELEGRAM_API_RESPONSES.inc(api_method, str(response.status_code))
+            if response.status_code == 429:
+                try:
+                    retry_after = (response.json().get('parameters') or {}).get('retry_after')
+                except ValueError:
+                    retry_after = None
+                if retry_after:
+                    logging.warning(f"Telegram flood limit на {api_method}, пауза всіх відправок на {retry_after}с")
+                    self.limiter.pause(retry_after)
+            return response
+        except requests.RequestException:
+            TELEGRAM_API_RESPONSES.inc(api_method, 'error')
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, api_method)
+
+    def stats(self):
+        """Returns per-method latency percentiles and failed calls, busiest method first."""
+        errors = collections.Counter()
+        for (method, code), count in TELEGRAM_API_RESPONSES.values().items():
+            if code != '200':
+                errors[method] += count
+        rows = [
+            {'method': method, 'calls': h.count, 'errors': errors[method],
+             'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99), 'max': h.max}
+            for (method,), h in TELEGRAM_API_SECONDS.snapshot().items()
+        ]
+        return sorted(rows, key=lambda row: row['calls'], reverse=True)
+
+    def close(self):
+        self.session.close()
+
+outbound_limiter = OutboundLimiter(TELEGRAM_RATE_PER_SECOND, TELEGRAM_CHAT_INTERVAL, TELEGRAM_GROUP_INTERVAL,
+                                   TELEGRAM_INTERACTIVE_RESERVE)
+telegram_transport = TelegramTransport(TELEGRAM_POOL_SIZE, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT,
+                                       outbound_limiter)
+telegram_transport.install()
+
+class RateShare:
+    """
+    Splits the bot-wide TELEGRAM_RATE_PER_SECOND between the processes sending to Telegram.
+    Each process heartbeats its row in outbound_senders every `heartbeat` seconds and sets its limiter
+    to global_rate / live senders, so adding a worker dyno lowers everyone's share instead of adding 25 msg/s.
+    Until the first heartbeat the limiter runs at the full global rate.
+    """
+    def __init__(self, limiter, global_rate, heartbeat):
+        self.limiter = limiter
+        self.global_rate = global_rate
+        self.heartbeat = heartbeat
+        self.sender_id = f"{os.getenv('DYNO') or socket.gethostname()}:{os.getpid()}"
+        self.senders = None
+        self._stop = threading.Event()
+
+    def refresh(self):
+        """Heartbeats this process and re-divides the budget between the live senders."""
+        self.senders = max(heartbeat_outbound_sender(self.sender_id, self.heartbeat * 3), 1)
+        self.limiter.set_rate(self.global_rate / self.senders)
+
+    def start(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.error(f"Не вдалося зареєструвати процес у outbound_senders: {e}")
+        threading.Thread(target=self._run, name="rate-share", daemon=True).start()
+
+    def _run(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep the last share; a sender that stops heartbeating drops out of the others' count
+                logging.error(f"Помилка оновлення частки ліміту Telegram: {e}")
+
+    def close(self):
+        self._stop.set()
+        try:
+            remove_outbound_sender(self.sender_id)
+        except Exception as e:
+            logging.error(f"Не вдалося видалити процес з outbound_senders: {e}")
 
-            # Table for storing user information
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    chat_id BIGINT PRIMARY KEY,
-                    username VARCHAR(100),
-                    first_name VARCHAR(100),
-                    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    notifications BOOLEAN DEFAULT TRUE,
-                    city VARCHAR(50)
-                );
-            """)
+rate_share = RateShare(outbound_limiter, TELEGRAM_RATE_PER_SECOND, TELEGRAM_SHARE_HEARTBEAT)
 
-            # Tables for managing target channels and groups (for general usage, e.g., finding relevant ones)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS target_channels (
-                    id SERIAL PRIMARY KEY,
-                    channel_name VARCHAR(200) NOT NULL,
-                    channel_link VARCHAR(500),
-                    channel_type VARCHAR(20) DEFAULT 'channel',
-                    description TEXT,
-                    city VARCHAR(50),
-                    added_by BIGINT,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (added_by) REFERENCES users(chat_id)
-                );
-            """)
+# ============ DATABASE CONNECTION POOL ============
 
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS target_groups (
-                    id SERIAL PRIMARY KEY,
-                    group_name VARCHAR(200) NOT NULL,
-                    group_link VARCHAR(500),
-                    description TEXT,
-                    city VARCHAR(50),
-                    added_by BIGINT,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (added_by) REFERENCES users(chat_id)
-                );
-            """)
+# Pool sizing and lifecycle settings (seconds where applicable)
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_HEALTH_CHECK_AFTER = float(os.getenv('DB_POOL_HEALTH_CHECK_AFTER', '30'))
+# Server-side limits applied to every pooled connection, in milliseconds (0 disables)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '15000'))
+DB_LOCK_TIMEOUT_MS = int(os.getenv('DB_LOCK_TIMEOUT_MS', '5000'))
+DB_IDLE_IN_TRANSACTION_TIMEOUT_MS = int(os.getenv('DB_IDLE_IN_TRANSACTION_TIMEOUT_MS', '60000'))
 
-            # NEW: Table for storing specific channels/groups where bot will post comments/invites
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS bot_target_locations (
-                    id SERIAL PRIMARY KEY,
-                    location_name VARCHAR(255) NOT NULL,
-                    location_id BIGINT UNIQUE NOT NULL, -- Telegram chat_id of the channel/group
-                    location_type VARCHAR(10) NOT NULL, -- 'channel' or 'group'
-                    comment_message_id INTEGER, -- Foreign key to specific_messages (optional)
-                    invite_link TEXT, -- Persistent invite link for the location
-                    is_active BOOLEAN DEFAULT TRUE,
-                    added_by BIGINT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
+def connection_options():
+    """libpq `options` setting the session timeouts, so a runaway query cannot hold a handler thread."""
+    settings = {'statement_timeout': DB_STATEMENT_TIMEOUT_MS, 'lock_timeout': DB_LOCK_TIMEOUT_MS,
+                'idle_in_transaction_session_timeout': DB_IDLE_IN_TRANSACTION_TIMEOUT_MS}
+    return ' '.join(f"-c {name}={value}" for name, value in settings.items())
 
-            # NEW: Table for storing specific messages/comments the bot will use
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS bot_comment_templates (
-                    id SERIAL PRIMARY KEY,
-                    name VARCHAR(100) UNIQUE NOT NULL,
-                    message_text TEXT NOT NULL,
-                    subscription_link TEXT,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
+def disable_statement_timeouts(cur):
+    """Lifts the session timeouts until the end of the current transaction (migrations, full rebuilds)."""
+    cur.execute("SET LOCAL statement_timeout = 0; SET LOCAL lock_timeout = 0;")
 
-            # Table for storing broadcast message templates
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS broadcast_templates (
-                    id SERIAL PRIMARY KEY,
-                    name VARCHAR(100) NOT NULL UNIQUE,
-                    title VARCHAR(200),
-                    message TEXT NOT NULL,
-                    buttons_config TEXT,
-                    target_cities TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes free within the checkout timeout."""
 
-            # Table for storing user ratings of broadcast messages
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS broadcast_ratings (
-                    id SERIAL PRIMARY KEY,
-                    user_chat_id BIGINT,
-                    template_id INTEGER,
-                    rating INTEGER CHECK (rating >= 1 AND rating <= 5),
-                    feedback TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE (user_chat_id, template_id),
-                    FOREIGN KEY (user_chat_id) REFERENCES users(chat_id),
-                    FOREIGN KEY (template_id) REFERENCES broadcast_templates(id)
-                );
-            """)
+class PooledConnection:
+    """
+    Proxy around a pooled psycopg2 connection.
+    Behaves like the raw connection (including `with conn:` transactions),
+    but close() hands the connection back to the pool instead of closing it.
+    """
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def _raw(self):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise psycopg2.InterfaceError("connection already returned to pool")
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(self._raw(), name)
+
+    def __enter__(self):
+        self._raw().__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._raw().__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __del__(self):
+        # Safety net for code paths that forget to close(): never leak a pool slot, but say so
+        try:
+            if self.__dict__.get('_conn') is not None:
+                logging.warning("З'єднання з БД не закрито через close(), повертаю його в пул під час збирання сміття")
+                self.close()
+        except Exception:
+            pass
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+    Connections are opened lazily up to max_size, pinged before reuse if they sat idle
+    for longer than health_check_after, and recycled once older than max_lifetime.
+    """
+    def __init__(self, dsn, max_size, timeout, max_lifetime, health_check_after):
+        self._dsn = dsn
+        self._max_size = max_size
+        self._timeout = timeout
+        self._max_lifetime = max_lifetime
+        self._health_check_after = health_check_after
+        self._idle = []  # stack of (conn, last_used); LIFO keeps the hottest connections busy
+        self._created_at = {}  # id(conn) -> monotonic creation time
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = psycopg2.connect(self._dsn, cursor_factory=InstrumentedCursor, options=connection_options())
+        self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_expired(self, conn):
+        created_at = self._created_at.get(id(conn))
+        return created_at is None or time.monotonic() - created_at > self._max_lifetime
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self._health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """Checks out a connection, waiting up to the pool timeout for one to become free."""
+        deadline = time.monotonic() + self._timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self._max_size:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError(f"No database connection available after {self._timeout}s")
+                self._cond.wait(remaining)
+
+        try:
+            if conn is not None and (self._is_expired(conn) or not self._is_healthy(conn, last_used)):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        """Returns a connection to the pool, rolling back any transaction left open."""
+        reusable = not conn.closed and not self._is_expired(conn)
+        if reusable and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                reusable = False
+
+        with self._cond:
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._size -= 1
+            self._cond.notify()
+        if not reusable:
+            self._discard(conn)
+
+    @property
+    def open_connections(self):
+        return self._size
+
+    @property
+    def idle_connections(self):
+        return len(self._idle)
+
+    def closeall(self):
+        """Closes every idle connection (used on shutdown)."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+db_pool = ConnectionPool(DATABASE_URL, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_LIFETIME, DB_POOL_HEALTH_CHECK_AFTER)
+
+def get_db_connection():
+    """Checks out a database connection from the shared pool. Call close() to return it."""
+    return db_pool.getconn()
+
+# ============ CONVERSATION STATE STORE ============
+
+# 'memory' keeps multi-step conversation state in this process; 'postgres' shares it between processes
+STATE_STORE = os.getenv('STATE_STORE', 'memory')
+STATE_TTL = float(os.getenv('STATE_TTL', '3600'))
+STATE_MAX_ENTRIES = int(os.getenv('STATE_MAX_ENTRIES', '10000'))
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire after `ttl` seconds; the least recently used entry is evicted when full."""
+    def __init__(self, max_entries, ttl):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = collections.OrderedDict() # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class InMemoryStateStore:
+    """Per-process conversation state with TTL expiry and LRU eviction (single bot process only)."""
+    def __init__(self, max_entries, ttl):
+        self._cache = TTLCache(max_entries, ttl)
+
+    def get(self, chat_id):
+        return self._cache.get(chat_id)
+
+    def set(self, chat_id, state):
+        self._cache.set(chat_id, state)
+
+    def delete(self, chat_id):
+        self._cache.delete(chat_id)
+
+    def __len__(self):
+        return len(self._cache)
+
+class PostgresStateStore:
+    """
+    Conversation state in an UNLOGGED Postgres table, shared by every bot process.
+    Each get/set/delete is a single statement; expired rows are ignored on read and purged periodically.
+    """
+    PURGE_INTERVAL = 60
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._last_purge = time.monotonic()
+
+    def get(self, chat_id):
+        conn = get_db_connection()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT state FROM conversation_states
+                        WHERE chat_id = %s AND expires_at > CURRENT_TIMESTAMP;
+                    """, (chat_id,))
+                    row = cur.fetchone()
+                    return row['state'] if row else None
+        finally:
+            conn.close()
+
+    def set(self, chat_id, state):
+        conn = get_db_connection()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO conversation_states (chat_id, state, expires_at)
+                        VALUES (%s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+                        ON CONFLICT (chat_id) DO UPDATE SET
+                        state = EXCLUDED.state,
+                        expires_at = EXCLUDED.expires_at;
+                    """, (chat_id, Json(state), self._ttl))
+                    if time.monotonic() - self._last_purge > self.PURGE_INTERVAL:
+                        self._last_purge = time.monotonic()
+                        cur.execute("DELETE FROM conversation_states WHERE expires_at <= CURRENT_TIMESTAMP;")
+        finally:
+            conn.close()
+
+    def delete(self, chat_id):
+        conn = get_db_connection()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM conversation_states WHERE chat_id = %s;", (chat_id,))
+        finally:
+            conn.close()
+
+    def __len__(self):
+        conn = get_db_connection()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT COUNT(*) FROM conversation_states WHERE expires_at > CURRENT_TIMESTAMP;")
+                    return cur.fetchone()['count']
+        finally:
+            conn.close()
 
-            # Table for storing city hashtags
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS city_hashtags (
-                    id SERIAL PRIMARY KEY,
-                    city_name VARCHAR(50) UNIQUE NOT NULL,
-                    hashtag VARCHAR(50) NOT NULL,
-                    is_active BOOLEAN DEFAULT TRUE
-                );
+# Temporary user data for multi-step conversations, keyed by chat_id
+if STATE_STORE == 'postgres':
+    user_states = PostgresStateStore(STATE_TTL)
+else:
+    user_states = InMemoryStateStore(STATE_MAX_ENTRIES, STATE_TTL)
+
+# ============ SCHEMA MIGRATIONS ============
+# Each migration runs once, in order, and is recorded in schema_version. Never edit an applied
+# migration: append a new one (including for new UKRAINIAN_CITIES entries, which are seeded here).
+
+SCHEMA_MIGRATION_LOCK_ID = 94000001 # pg_advisory_xact_lock key serialising concurrent deploys
+
+def _migration_initial_schema(cur):
+    """Creates the original tables and seeds cities and invite metadata."""
+    # Table for logging invite attempts
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS invite_logs (
+            id SERIAL PRIMARY KEY,
+            user_chat_id BIGINT NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            error_message TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # Table for storing metadata related to invites (e.g., last invite time)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS invite_meta (
+            id SERIAL PRIMARY KEY,
+            last_invite_time TIMESTAMP
+        );
+    """)
+
+    # Table for storing user information
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id BIGINT PRIMARY KEY,
+            username VARCHAR(100),
+            first_name VARCHAR(100),
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE,
+            notifications BOOLEAN DEFAULT TRUE,
+            city VARCHAR(50)
+        );
+    """)
+
+    # Tables for managing target channels and groups (for general usage, e.g., finding relevant ones)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS target_channels (
+            id SERIAL PRIMARY KEY,
+            channel_name VARCHAR(200) NOT NULL,
+            channel_link VARCHAR(500),
+            channel_type VARCHAR(20) DEFAULT 'channel',
+            description TEXT,
+            city VARCHAR(50),
+            added_by BIGINT,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (added_by) REFERENCES users(chat_id)
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS target_groups (
+            id SERIAL PRIMARY KEY,
+            group_name VARCHAR(200) NOT NULL,
+            group_link VARCHAR(500),
+            description TEXT,
+            city VARCHAR(50),
+            added_by BIGINT,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (added_by) REFERENCES users(chat_id)
+        );
+    """)
+
+    # NEW: Table for storing specific channels/groups where bot will post comments/invites
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_target_locations (
+            id SERIAL PRIMARY KEY,
+            location_name VARCHAR(255) NOT NULL,
+            location_id BIGINT UNIQUE NOT NULL, -- Telegram chat_id of the channel/group
+            location_type VARCHAR(10) NOT NULL, -- 'channel' or 'group'
+            comment_message_id INTEGER, -- Foreign key to specific_messages (optional)
+            invite_link TEXT, -- Persistent invite link for the location
+            is_active BOOLEAN DEFAULT TRUE,
+            added_by BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # NEW: Table for storing specific messages/comments the bot will use
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_comment_templates (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) UNIQUE NOT NULL,
+            message_text TEXT NOT NULL,
+            subscription_link TEXT,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # Table for storing broadcast message templates
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_templates (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL UNIQUE,
+            title VARCHAR(200),
+            message TEXT NOT NULL,
+            buttons_config TEXT,
+            target_cities TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+    # Table for storing user ratings of broadcast messages
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_ratings (
+            id SERIAL PRIMARY KEY,
+            user_chat_id BIGINT,
+            template_id INTEGER,
+            rating INTEGER CHECK (rating >= 1 AND rating <= 5),
+            feedback TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_chat_id, template_id),
+            FOREIGN KEY (user_chat_id) REFERENCES users(chat_id),
+            FOREIGN KEY (template_id) REFERENCES broadcast_templates(id)
+        );
+    """)
+
+    # Table for storing city hashtags
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS city_hashtags (
+            id SERIAL PRIMARY KEY,
+            city_name VARCHAR(50) UNIQUE NOT NULL,
+            hashtag VARCHAR(50) NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE
+        );
+    """)
+
+    # Seed every city in one round trip
+    execute_values(cur, """
+        INSERT INTO city_hashtags (city_name, hashtag) VALUES %s
+        ON CONFLICT (city_name) DO NOTHING;
+    """, list(UKRAINIAN_CITIES.items()))
+
+    cur.execute("""
+        INSERT INTO invite_meta (last_invite_time)
+        SELECT NULL WHERE NOT EXISTS (SELECT 1 FROM invite_meta);
+    """)
+
+def _migration_broadcast_queue(cur):
+    """Adds persistent broadcast jobs and the per-recipient delivery queue."""
+    # Tables for persistent, resumable broadcast jobs and their per-recipient delivery log
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            template_id INTEGER,
+            name VARCHAR(100) NOT NULL,
+            message TEXT NOT NULL,
+            target_cities TEXT,
+            requested_by BIGINT,
+            status VARCHAR(12) NOT NULL DEFAULT 'running', -- 'running' or 'completed'
+            expanded BOOLEAN NOT NULL DEFAULT FALSE, -- All recipients have been queued as deliveries
+            last_chat_id BIGINT, -- Keyset checkpoint: every recipient up to this chat_id is queued
+            total_recipients INTEGER NOT NULL DEFAULT 0,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (template_id) REFERENCES broadcast_templates(id) ON DELETE SET NULL
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            chat_id BIGINT NOT NULL,
+            city VARCHAR(50),
+            status VARCHAR(10) NOT NULL DEFAULT 'pending', -- 'pending', 'sending', 'sent' or 'failed'
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_at TIMESTAMP, -- When a worker took the delivery; stale claims are retaken
+            error_message TEXT,
+            attempted_at TIMESTAMP,
+            PRIMARY KEY (job_id, chat_id),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs(id) ON DELETE CASCADE
+        );
+    """)
+
+    # Work queue index: workers only ever scan deliveries that are not finished yet
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS broadcast_deliveries_queue_idx
+        ON broadcast_deliveries (job_id, chat_id)
+        WHERE status IN ('pending', 'sending');
+    """)
+
+def _migration_conversation_states(cur):
+    """Adds the shared conversation state table."""
+    # Shared conversation state for multi-step flows (STATE_STORE=postgres).
+    # UNLOGGED: skips WAL for these short-lived rows; losing them on a crash only resets open dialogs.
+    cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS conversation_states (
+            chat_id BIGINT PRIMARY KEY,
+            state JSONB NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        );
+    """)
+
+def _migration_hot_path_indexes(cur):
+    """Adds indexes matched to the broadcast targeting, per-user listing and rating queries."""
+    # iter_broadcast_recipients: everyone reachable, in chat_id order (whole-audience broadcasts)...
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS users_broadcast_idx
+        ON users (chat_id)
+        WHERE is_active = TRUE AND notifications = TRUE;
+    """)
+    # ...and the same audience narrowed to target cities
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS users_broadcast_city_idx
+        ON users (city, chat_id)
+        WHERE is_active = TRUE AND notifications = TRUE;
+    """)
+
+    # get_channels_by_user / get_groups_by_user: filter by owner, newest first
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS target_channels_added_by_idx
+        ON target_channels (added_by, created_at DESC)
+        WHERE is_active = TRUE;
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS target_groups_added_by_idx
+        ON target_groups (added_by, created_at DESC)
+        WHERE is_active = TRUE;
+    """)
+
+    # show_ratings_stats join and delete_broadcast_template_db; rating included for index-only aggregates
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS broadcast_ratings_template_idx
+        ON broadcast_ratings (template_id, rating);
+    """)
+
+    # PostgresStateStore purge of expired dialogs
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS conversation_states_expires_idx
+        ON conversation_states (expires_at);
+    """)
+
+def rebuild_city_stats_rows(cur):
+    """Recomputes city_stats from the source tables; writers are blocked until the caller commits."""
+    disable_statement_timeouts(cur)
+    cur.execute("LOCK TABLE users, target_channels, target_groups IN SHARE MODE;")
+    cur.execute("DELETE FROM city_stats;")
+    cur.execute("""
+        INSERT INTO city_stats (city, user_count, active_user_count, channel_count, group_count)
+        SELECT city_key, SUM(users), SUM(active_users), SUM(channels), SUM(groups_added)
+        FROM (
+            SELECT COALESCE(city, '') AS city_key, 1 AS users, (is_active IS TRUE)::int AS active_users,
+                   0 AS channels, 0 AS groups_added
+            FROM users
+            UNION ALL
+            SELECT COALESCE(city, ''), 0, 0, 1, 0 FROM target_channels WHERE is_active = TRUE
+            UNION ALL
+            SELECT COALESCE(city, ''), 0, 0, 0, 1 FROM target_groups WHERE is_active = TRUE
+        ) source_rows
+        GROUP BY city_key;
+    """)
+
+def _migration_city_stats(cur):
+    """Adds the city_stats rollup maintained by statement-level triggers."""
+    # One row per city ('' for users without one) plus the '*' row holding totals (dropped by migration 8)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS city_stats (
+            city VARCHAR(50) PRIMARY KEY,
+            user_count INTEGER NOT NULL DEFAULT 0,
+            active_user_count INTEGER NOT NULL DEFAULT 0,
+            channel_count INTEGER NOT NULL DEFAULT 0, -- Active channels
+            group_count INTEGER NOT NULL DEFAULT 0 -- Active groups
+        );
+    """)
+
+    # Applies a batch of per-city deltas to the city rows and the totals row.
+    # Rows are upserted in city order so concurrent writers always lock them in the same order.
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION city_stats_add(deltas city_stats[]) RETURNS void AS $$
+            INSERT INTO city_stats AS s (city, user_count, active_user_count, channel_count, group_count)
+            SELECT target.city, SUM(d.user_count), SUM(d.active_user_count), SUM(d.channel_count), SUM(d.group_count)
+            FROM unnest(deltas) d
+            CROSS JOIN LATERAL (VALUES (d.city), ('*')) AS target(city)
+            GROUP BY target.city
+            HAVING SUM(d.user_count) <> 0 OR SUM(d.active_user_count) <> 0
+                OR SUM(d.channel_count) <> 0 OR SUM(d.group_count) <> 0
+            ORDER BY target.city
+            ON CONFLICT (city) DO UPDATE SET
+                user_count = s.user_count + EXCLUDED.user_count,
+                active_user_count = s.active_user_count + EXCLUDED.active_user_count,
+                channel_count = s.channel_count + EXCLUDED.channel_count,
+                group_count = s.group_count + EXCLUDED.group_count;
+        $$ LANGUAGE sql;
+    """)
+
+    # Statement-level triggers see all changed rows at once through transition tables,
+    # so batch updates and COPY cost one upsert per statement rather than one per row.
+    # Updates that touch neither city nor is_active cancel out and write nothing.
+    for table, deltas in (
+        ('users', "(COALESCE(city, ''), {sign}, {sign} * (is_active IS TRUE)::int, 0, 0)"),
+        ('target_channels', "(COALESCE(city, ''), 0, 0, {sign} * (is_active IS TRUE)::int, 0)"),
+        ('target_groups', "(COALESCE(city, ''), 0, 0, 0, {sign} * (is_active IS TRUE)::int)"),
+    ):
+        added = deltas.format(sign='1')
+        removed = deltas.format(sign='-1')
+        cur.execute(f"""
+            CREATE OR REPLACE FUNCTION {table}_city_stats() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    PERFORM city_stats_add(ARRAY(SELECT ROW{added}::city_stats FROM new_rows));
+                ELSIF TG_OP = 'DELETE' THEN
+                    PERFORM city_stats_add(ARRAY(SELECT ROW{removed}::city_stats FROM old_rows));
+                ELSE
+                    PERFORM city_stats_add(ARRAY(
+                        SELECT ROW{added}::city_stats FROM new_rows
+                        UNION ALL
+                        SELECT ROW{removed}::city_stats FROM old_rows
+                    ));
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """)
+        for event, transitions in (('INSERT', 'NEW TABLE AS new_rows'),
+                                   ('UPDATE', 'NEW TABLE AS new_rows OLD TABLE AS old_rows'),
+                                   ('DELETE', 'OLD TABLE AS old_rows')):
+            cur.execute(f"""
+                CREATE TRIGGER {table}_city_stats_{event.lower()}
+                AFTER {event} ON {table}
+                REFERENCING {transitions}
+                FOR EACH STATEMENT EXECUTE FUNCTION {table}_city_stats();
             """)
 
-            # Add Ukrainian cities and their hashtags to the city_hashtags table
-            # This loop will now insert the expanded list of cities/towns
-            for city, hashtag in UKRAINIAN_CITIES.items():
-                cur.execute("""
-                    INSERT INTO city_hashtags (city_name, hashtag)
-                    VALUES (%s, %s) ON CONFLICT (city_name) DO NOTHING;
-                """, (city, hashtag))
+    # Backfill as applied, with the '*' totals row; rebuild_city_stats_rows follows the current schema
+    disable_statement_timeouts(cur)
+    cur.execute("LOCK TABLE users, target_channels, target_groups IN SHARE MODE;")
+    cur.execute("DELETE FROM city_stats;")
+    cur.execute("""
+        INSERT INTO city_stats (city, user_count, active_user_count, channel_count, group_count)
+        SELECT COALESCE(city_key, '*'), COALESCE(SUM(users), 0), COALESCE(SUM(active_users), 0),
+               COALESCE(SUM(channels), 0), COALESCE(SUM(groups_added), 0)
+        FROM (
+            SELECT COALESCE(city, '') AS city_key, 1 AS users, (is_active IS TRUE)::int AS active_users,
+                   0 AS channels, 0 AS groups_added
+            FROM users
+            UNION ALL
+            SELECT COALESCE(city, ''), 0, 0, 1, 0 FROM target_channels WHERE is_active = TRUE
+            UNION ALL
+            SELECT COALESCE(city, ''), 0, 0, 0, 1 FROM target_groups WHERE is_active = TRUE
+        ) source_rows
+        GROUP BY ROLLUP (city_key); -- The rollup row (city_key NULL) becomes the '*' totals row
+    """)
+
+def _migration_rating_stats(cur):
+    """Adds per-template rating aggregates maintained by statement-level triggers."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_rating_stats (
+            template_id INTEGER PRIMARY KEY,
+            rating_count INTEGER NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            stars_1 INTEGER NOT NULL DEFAULT 0,
+            stars_2 INTEGER NOT NULL DEFAULT 0,
+            stars_3 INTEGER NOT NULL DEFAULT 0,
+            stars_4 INTEGER NOT NULL DEFAULT 0,
+            stars_5 INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (template_id) REFERENCES broadcast_templates(id) ON DELETE CASCADE
+        );
+    """)
+
+    # Same shape as city_stats_add: sum the deltas per template and upsert in key order
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION rating_stats_add(deltas broadcast_rating_stats[]) RETURNS void AS $$
+            INSERT INTO broadcast_rating_stats AS s
+                (template_id, rating_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+            SELECT d.template_id, SUM(d.rating_count), SUM(d.rating_sum),
+                   SUM(d.stars_1), SUM(d.stars_2), SUM(d.stars_3), SUM(d.stars_4), SUM(d.stars_5)
+            FROM unnest(deltas) d
+            WHERE d.template_id IS NOT NULL
+            GROUP BY d.template_id
+            HAVING SUM(d.rating_count) <> 0 OR SUM(d.rating_sum) <> 0
+                OR SUM(d.stars_1) <> 0 OR SUM(d.stars_2) <> 0 OR SUM(d.stars_3) <> 0
+                OR SUM(d.stars_4) <> 0 OR SUM(d.stars_5) <> 0
+            ORDER BY d.template_id
+            ON CONFLICT (template_id) DO UPDATE SET
+                rating_count = s.rating_count + EXCLUDED.rating_count,
+                rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+                stars_1 = s.stars_1 + EXCLUDED.stars_1,
+                stars_2 = s.stars_2 + EXCLUDED.stars_2,
+                stars_3 = s.stars_3 + EXCLUDED.stars_3,
+                stars_4 = s.stars_4 + EXCLUDED.stars_4,
+                stars_5 = s.stars_5 + EXCLUDED.stars_5;
+        $$ LANGUAGE sql;
+    """)
+
+    # A changed rating (the ON CONFLICT DO UPDATE path in handle_rating) arrives through the
+    # UPDATE trigger as old row out, new row in, so it moves between histogram buckets.
+    deltas = ("(template_id, {sign}, {sign} * rating, {sign} * (rating = 1)::int, {sign} * (rating = 2)::int, "
+              "{sign} * (rating = 3)::int, {sign} * (rating = 4)::int, {sign} * (rating = 5)::int)")
+    added = deltas.format(sign='1')
+    removed = deltas.format(sign='-1')
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION broadcast_ratings_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM rating_stats_add(ARRAY(SELECT ROW{added}::broadcast_rating_stats FROM new_rows));
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM rating_stats_add(ARRAY(SELECT ROW{removed}::broadcast_rating_stats FROM old_rows));
+            ELSE
+                PERFORM rating_stats_add(ARRAY(
+                    SELECT ROW{added}::broadcast_rating_stats FROM new_rows
+                    UNION ALL
+                    SELECT ROW{removed}::broadcast_rating_stats FROM old_rows
+                ));
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    for event, transitions in (('INSERT', 'NEW TABLE AS new_rows'),
+                               ('UPDATE', 'NEW TABLE AS new_rows OLD TABLE AS old_rows'),
+                               ('DELETE', 'OLD TABLE AS old_rows')):
+        cur.execute(f"""
+            CREATE TRIGGER broadcast_ratings_stats_{event.lower()}
+            AFTER {event} ON broadcast_ratings
+            REFERENCING {transitions}
+            FOR EACH STATEMENT EXECUTE FUNCTION broadcast_ratings_stats();
+        """)
+
+    # Backfill from existing ratings
+    cur.execute("""
+        INSERT INTO broadcast_rating_stats
+            (template_id, rating_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+        SELECT template_id, COUNT(*), SUM(rating),
+               COUNT(*) FILTER (WHERE rating = 1), COUNT(*) FILTER (WHERE rating = 2),
+               COUNT(*) FILTER (WHERE rating = 3), COUNT(*) FILTER (WHERE rating = 4),
+               COUNT(*) FILTER (WHERE rating = 5)
+        FROM broadcast_ratings
+        WHERE template_id IS NOT NULL AND rating IS NOT NULL
+        GROUP BY template_id;
+    """)
+
+def _migration_city_stats_without_totals(cur):
+    """Drops the '*' totals row: every writer upserted it, so all of them queued on its row lock."""
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION city_stats_add(deltas city_stats[]) RETURNS void AS $$
+            INSERT INTO city_stats AS s (city, user_count, active_user_count, channel_count, group_count)
+            SELECT d.city, SUM(d.user_count), SUM(d.active_user_count), SUM(d.channel_count), SUM(d.group_count)
+            FROM unnest(deltas) d
+            GROUP BY d.city
+            HAVING SUM(d.user_count) <> 0 OR SUM(d.active_user_count) <> 0
+                OR SUM(d.channel_count) <> 0 OR SUM(d.group_count) <> 0
+            ORDER BY d.city
+            ON CONFLICT (city) DO UPDATE SET
+                user_count = s.user_count + EXCLUDED.user_count,
+                active_user_count = s.active_user_count + EXCLUDED.active_user_count,
+                channel_count = s.channel_count + EXCLUDED.channel_count,
+                group_count = s.group_count + EXCLUDED.group_count;
+        $$ LANGUAGE sql;
+    """)
+    cur.execute("DELETE FROM city_stats WHERE city = '*';")
+
+def _migration_rating_stats_null_ratings(cur):
+    """Stops the rating trigger counting rows without a rating, and recomputes the aggregates it skewed."""
+    # Same trigger function as migration 6, except rows without a rating (feedback only) count nowhere,
+    # matching the backfill's rating IS NOT NULL
+    stars = ", ".join(f"{{sign}} * COALESCE(rating = {n}, FALSE)::int" for n in range(1, 6))
+    deltas = f"(template_id, {{sign}} * (rating IS NOT NULL)::int, {{sign}} * COALESCE(rating, 0), {stars})"
+    added = deltas.format(sign='1')
+    removed = deltas.format(sign='-1')
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION broadcast_ratings_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM rating_stats_add(ARRAY(SELECT ROW{added}::broadcast_rating_stats FROM new_rows));
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM rating_stats_add(ARRAY(SELECT ROW{removed}::broadcast_rating_stats FROM old_rows));
+            ELSE
+                PERFORM rating_stats_add(ARRAY(
+                    SELECT ROW{added}::broadcast_rating_stats FROM new_rows
+                    UNION ALL
+                    SELECT ROW{removed}::broadcast_rating_stats FROM old_rows
+                ));
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    # Recompute from scratch; writers are blocked until the migration commits
+    cur.execute("LOCK TABLE broadcast_ratings IN SHARE MODE;")
+    cur.execute("DELETE FROM broadcast_rating_stats;")
+    cur.execute("""
+        INSERT INTO broadcast_rating_stats
+            (template_id, rating_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+        SELECT template_id, COUNT(*), SUM(rating),
+               COUNT(*) FILTER (WHERE rating = 1), COUNT(*) FILTER (WHERE rating = 2),
+               COUNT(*) FILTER (WHERE rating = 3), COUNT(*) FILTER (WHERE rating = 4),
+               COUNT(*) FILTER (WHERE rating = 5)
+        FROM broadcast_ratings
+        WHERE template_id IS NOT NULL AND rating IS NOT NULL
+        GROUP BY template_id;
+    """)
+
+def _migration_outbound_senders(cur):
+    """Adds the registry of processes sharing the bot-wide Telegram rate budget."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS outbound_senders (
+            sender_id TEXT PRIMARY KEY,
+            heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+
+MIGRATIONS = [
+    (1, "initial schema", _migration_initial_schema),
+    (2, "broadcast jobs and delivery queue", _migration_broadcast_queue),
+    (3, "conversation states", _migration_conversation_states),
+    (4, "hot-path indexes", _migration_hot_path_indexes),
+    (5, "city stats rollup", _migration_city_stats),
+    (6, "rating aggregates", _migration_rating_stats),
+    (7, "outbound sender registry", _migration_outbound_senders),
+    (8, "city stats without totals row", _migration_city_stats_without_totals),
+    (9, "rating aggregates skip missing ratings", _migration_rating_stats_null_ratings),
+]
+
+def get_schema_version(cur):
+    """Returns the highest applied migration, or 0 on a database that has never been migrated."""
+    try:
+        cur.execute("SELECT MAX(version) AS version FROM schema_version;")
+    except psycopg2.errors.UndefinedTable:
+        cur.connection.rollback()
+        return 0
+    return cur.fetchone()['version'] or 0
+
+def init_db():
+    """Brings the schema up to date; a warm restart costs a single version query."""
+    latest = MIGRATIONS[-1][0]
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            current = get_schema_version(cur)
+        conn.rollback()
+        if current >= latest:
+            return
 
-            # Check and add basic invite_meta data if it doesn't exist
-            cur.execute("SELECT COUNT(*) FROM invite_meta;")
-            count = cur.fetchone()['count']
-            if count == 0:
-                cur.execute("INSERT INTO invite_meta (last_invite_time) VALUES (NULL);")
-    conn.close()
+        # All pending migrations commit together or not at all
+        with conn:
+            with conn.cursor() as cur:
+                # Index builds on big tables, and waiting for another process's migration, can take a while
+                disable_statement_timeouts(cur)
+                cur.execute("SELECT pg_advisory_xact_lock(%s);", (SCHEMA_MIGRATION_LOCK_ID,))
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                current = get_schema_version(cur) # Another process may have migrated while we waited for the lock
+                for version, description, migrate in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    migrate(cur)
+                    cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s);",
+                                (version, description))
+                    logging.info(f"Застосовано міграцію {version}: {description}")
+    finally:
+        conn.close()
 
 # ============ KEYBOARDS ============
+# Keyboards below are built once per distinct argument set and returned as pre-serialised JSON;
+# telebot passes string markup through untouched, so callers hand them straight to reply_markup.
+# Treat the result as read-only: build a fresh InlineKeyboardMarkup if a screen needs extra buttons.
+# The caches live for the life of the process: UKRAINIAN_CITIES and the menu texts are code, so a
+# change to them ships with a deploy and the restart rebuilds every keyboard.
 
+KEYBOARD_REGISTRY = []
+
+def cached_keyboard(maxsize=8):
+    """
+    Memoises a keyboard builder by its arguments and returns the markup as a JSON string.
+    The default maxsize covers argument-free and flag-style keyboards; builders keyed by ids pass their own.
+    """
+    def decorator(builder):
+        @functools.lru_cache(maxsize=maxsize)
+        @functools.wraps(builder)
+        def wrapper(*args):
+            return builder(*args).to_json()
+        KEYBOARD_REGISTRY.append(wrapper)
+        return wrapper
+    return decorator
+
+def warm_keyboards():
+    """Builds every argument-free keyboard so the first tap after startup is already cached."""
+    for keyboard in KEYBOARD_REGISTRY:
+        if not inspect.signature(keyboard).parameters:
+            keyboard()
+
+@cached_keyboard()
 def get_main_menu():
     """Returns the main menu inline keyboard."""
     keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -242,6 +1661,7 @@ def get_main_menu():
     )
     return keyboard
 
+@cached_keyboard()
 def get_cities_keyboard():
     """Returns an inline keyboard with Ukrainian cities for selection."""
     keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -262,6 +1682,7 @@ def get_cities_keyboard():
     keyboard.add(types.InlineKeyboardButton("🔙 Назад", callback_data="main_menu"))
     return keyboard
 
+@cached_keyboard()
 def get_channel_management_menu():
     """Returns the channel management menu inline keyboard."""
     keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -278,6 +1699,7 @@ def get_channel_management_menu():
     )
     return keyboard
 
+@cached_keyboard(maxsize=256) # One entry per recently broadcast template
 def get_rating_keyboard(template_id):
     """Returns an inline keyboard for rating a broadcast message."""
     keyboard = types.InlineKeyboardMarkup(row_width=5)
@@ -290,6 +1712,7 @@ def get_rating_keyboard(template_id):
     keyboard.add(types.InlineKeyboardButton("Пропустити", callback_data="skip_rating"))
     return keyboard
 
+@cached_keyboard()
 def get_admin_menu():
     """Returns the admin panel inline keyboard."""
     keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -310,6 +1733,7 @@ def get_admin_menu():
     )
     return keyboard
 
+@cached_keyboard()
 def get_admin_broadcast_menu():
     """Returns the admin broadcast management menu."""
     keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -323,6 +1747,9 @@ def get_admin_broadcast_menu():
     )
     keyboard.add(
         types.InlineKeyboardButton("🗑️ Видалити розсилку", callback_data="admin_broadcast_delete_select"),
+        types.InlineKeyboardButton("📊 Статус розсилок", callback_data="admin_broadcast_jobs")
+    )
+    keyboard.add(
         types.InlineKeyboardButton("🔙 Назад", callback_data="admin_menu")
     )
     return keyboard
@@ -346,6 +1773,7 @@ def get_user_channel_group_management_keyboard(item_id, item_type):
     )
     return keyboard
 
+@cached_keyboard()
 def get_user_settings_menu(notifications_enabled):
     """Returns the user settings menu."""
     keyboard = types.InlineKeyboardMarkup(row_width=1)
@@ -357,6 +1785,7 @@ def get_user_settings_menu(notifications_enabled):
     return keyboard
 
 # NEW: Bot activity management keyboards
+@cached_keyboard()
 def get_admin_bot_activity_menu():
     """Returns the admin menu for bot activity (commenting/inviting)."""
     keyboard = types.InlineKeyboardMarkup(row_width=1)
@@ -393,21 +1822,24 @@ def get_bot_comment_template_manage_keyboard(template_id):
 
 # ============ MAIN COMMANDS ============
 
+def build_welcome_text(first_name):
+    """Greeting shown by /start."""
+    return f"Привіт, {first_name}! 👋\n\n" \
+           "Я бот для роботи з каналами та групами України.\n" \
+           "Можу допомогти:\n" \
+           "• Додавати канали та групи по містах\n" \
+           "• Розсилати запрошення сегментовано\n" \
+           "• Знаходити цільову аудиторію з хештегами\n\n" \
+           "Оберіть дію з меню:"
+
 @bot.message_handler(commands=['start'])
+@timed_handler('/start')
 def start_message(message):
     """Handles the /start command, welcoming the user and showing the main menu."""
-    user_info = message.from_user
-    welcome_text = f"Привіт, {user_info.first_name}! 👋\n\n" \
-                   "Я бот для роботи з каналами та групами України.\n" \
-                   "Можу допомогти:\n" \
-                   "• Додавати канали та групи по містах\n" \
-                   "• Розсилати запрошення сегментовано\n" \
-                   "• Знаходити цільову аудиторію з хештегами\n\n" \
-                   "Оберіть дію з меню:"
-
-    bot.send_message(message.chat.id, welcome_text, reply_markup=get_main_menu())
+    bot.send_message(message.chat.id, build_welcome_text(message.from_user.first_name), reply_markup=get_main_menu())
 
 @bot.message_handler(commands=['admin'])
+@timed_handler('/admin')
 def admin_panel(message):
     """Handles the /admin command, showing the admin panel if the user is authorized."""
     admin_chat_id = message.chat.id
@@ -417,6 +1849,171 @@ def admin_panel(message):
 
     bot.send_message(admin_chat_id, "🔧 Панель адміністратора", reply_markup=get_admin_menu())
 
+@bot.message_handler(commands=['rebuild_stats'])
+@timed_handler('/rebuild_stats')
+def rebuild_stats_command(message):
+    """Recomputes the statistics rollup (admin only)."""
+    admin_chat_id = message.chat.id
+    if admin_chat_id not in ALLOWED_ADMINS:
+        bot.send_message(admin_chat_id, "❌ У вас немає прав доступу до цієї функції.")
+        return
+
+    bot.send_message(admin_chat_id, "🔄 Перераховую статистику...")
+    if rebuild_city_stats():
+        bot.send_message(admin_chat_id, "✅ Статистику перераховано.")
+    else:
+        bot.send_message(admin_chat_id, "❌ Не вдалося перерахувати статистику.")
+
+# ============ CALLBACK ROUTER ============
+
+class CallbackRoute:
+    """A registered callback pattern with its handler and timing counters."""
+    __slots__ = ('pattern', 'handler', 'admin_only', 'calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, pattern, handler, admin_only):
+        self.pattern = pattern
+        self.handler = handler
+        self.admin_only = admin_only
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+class _RouteNode:
+    """One '_'-separated segment of a parameterised callback pattern."""
+    __slots__ = ('children', 'params', 'route')
+
+    def __init__(self):
+        self.children = {}  # literal segment -> _RouteNode
+        self.params = []    # (name, converter, _RouteNode); converter None means "rest of the data"
+        self.route = None
+
+class CallbackRouter:
+    """Maps callback_data to handlers: a dict for fixed strings, a segment trie for patterns with {name:type} parameters."""
+    PARAM_TYPES = {'int': int, 'str': str, 'rest': None}
+    PARAM_RE = re.compile(r'^\{(\w+)(?::(\w+))?\}$')
+    SEGMENT_RE = re.compile(r'\{[^}]*\}|[^_]+')
+
+    def __init__(self):
+        self._exact = {}
+        self._root = _RouteNode()
+        self._routes = []
+        self._lock = threading.Lock()
+
+    def route(self, pattern, admin=False):
+        """Decorator registering a handler; parameters are passed to it as keyword arguments."""
+        def decorator(handler):
+            self.add(pattern, handler, admin)
+            return handler
+        return decorator
+
+    def add(self, pattern, handler, admin=False):
+        route = CallbackRoute(pattern, handler, admin)
+        segments = self.SEGMENT_RE.findall(pattern)
+        if not any(self.PARAM_RE.match(segment) for segment in segments):
+            if pattern in self._exact:
+                raise ValueError(f"Duplicate callback route: {pattern}")
+            self._exact[pattern] = route
+        else:
+            node = self._root
+            for index, segment in enumerate(segments):
+                param = self.PARAM_RE.match(segment)
+                if not param:
+                    node = node.children.setdefault(segment, _RouteNode())
+                    continue
+                name, type_name = param.group(1), param.group(2) or 'str'
+                if type_name not in self.PARAM_TYPES:
+                    raise ValueError(f"Unknown parameter type '{type_name}' in {pattern}")
+                converter = self.PARAM_TYPES[type_name]
+                if converter is None and index != len(segments) - 1:
+                    raise ValueError(f"'rest' parameter must be last in {pattern}")
+                for existing_name, existing_converter, child in node.params:
+                    if existing_name == name and existing_converter is converter:
+                        node = child
+                        break
+                else:
+                    child = _RouteNode()
+                    node.params.append((name, converter, child))
+                    node = child
+            if node.route:
+                raise ValueError(f"Duplicate callback route: {pattern}")
+            node.route = route
+        self._routes.append(route)
+        return route
+
+    def resolve(self, data):
+        """Returns (route, params) for callback_data, or None if nothing matches."""
+        route = self._exact.get(data)
+        if route:
+            return route, {}
+        return self._match(self._root, data.split('_'), 0, {})
+
+    def _match(self, node, segments, index, params):
+        if index == len(segments):
+            return (node.route, params) if node.route else None
+        child = node.children.get(segments[index])
+        if child:
+            found = self._match(child, segments, index + 1, params)
+            if found:
+                return found
+        for name, converter, child in node.params:
+            if converter is None:
+                if child.route:
+                    return child.route, {**params, name: '_'.join(segments[index:])}
+                continue
+            try:
+                value = converter(segments[index])
+            except ValueError:
+                continue
+            found = self._match(child, segments, index + 1, {**params, name: value})
+            if found:
+                return found
+        return None
+
+    def dispatch(self, call):
+        """Runs the handler for a callback query; returns False if no route matched."""
+        found = self.resolve(call.data)
+        if not found:
+            logging.warning(f"Невідомий callback: {call.data}")
+            return False
+        route, params = found
+
+        if route.admin_only and call.message.chat.id not in ALLOWED_ADMINS:
+            bot.send_message(call.message.chat.id, "❌ У вас немає прав доступу до цієї функції.")
+            return True
+
+        started = time.perf_counter()
+        failed = False
+        try:
+            route.handler(call, **params)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            CALLBACK_SECONDS.observe(elapsed, route.pattern)
+            if failed:
+                CALLBACK_ERRORS.inc(route.pattern)
+            with self._lock:
+                route.calls += 1
+                route.errors += failed
+                route.total_time += elapsed
+                route.max_time = max(route.max_time, elapsed)
+        return True
+
+    def stats(self):
+        """Returns per-route counters, slowest total first."""
+        with self._lock:
+            rows = [
+                {'pattern': r.pattern, 'calls': r.calls, 'errors': r.errors,
+                 'total_time': r.total_time, 'max_time': r.max_time}
+                for r in self._routes if r.calls
+            ]
+        return sorted(rows, key=lambda row: row['total_time'], reverse=True)
+
+callback_router = CallbackRouter()
+callback_route = callback_router.route
+
 # ============ CALLBACK HANDLERS ============
 
 @bot.callback_query_handler(func=lambda call: True)
@@ -429,76 +2026,134 @@ def callback_handler(call):
     bot.answer_callback_query(call.id)
 
     try:
-        if call.data == "main_menu":
-            bot.edit_message_text("Головне меню:", chat_id, call.message.message_id,
-                                  reply_markup=get_main_menu())
-
-        elif call.data == "register":
-            handle_registration_start(call)
-
-        elif call.data == "get_invite":
-            send_invite_link(chat_id)
-
-        elif call.data == "add_channel":
-            handle_add_channel_start(call)
-
-        elif call.data == "add_group":
-            handle_add_group_start(call)
-
-        elif call.data == "my_cities":
-            show_cities_selection(call)
-
-        elif call.data.startswith("select_city_"):
-            handle_city_selection(call)
-
-        elif call.data.startswith("rate_"):
-            handle_rating(call)
-
-        elif call.data.startswith("admin_"):
-            handle_admin_actions(call)
-
-        elif call.data == "my_channels":
-            show_my_channels(call)
-
-        elif call.data == "my_groups":
-            show_my_groups(call)
-
-        elif call.data.startswith("delete_channel_"):
-            delete_user_channel(call)
-
-        elif call.data.startswith("delete_group_"):
-            delete_user_group(call)
-
-        elif call.data == "settings":
-            user_settings(call)
-
-        elif call.data == "toggle_notifications":
-            toggle_notifications(call)
-
-        elif call.data == "channels_by_city":
-            bot.send_message(chat_id, "Функція 'Канали за містами' ще не реалізована для звичайних користувачів, але ви можете переглянути свої додані канали та групи.")
+        callback_router.dispatch(call)
+    except Exception as e:
+        logging.error(f"Помилка в callback_handler ({call.data}): {e}")
+        bot.send_message(chat_id, "Сталася помилка під час обробки вашого запиту. Спробуйте ще раз або зверніться до адміністратора.")
 
-        elif call.data == "channels_stats":
-            bot.send_message(chat_id, "Функція 'Статистика каналів' доступна тільки адміністраторам.")
+@callback_route("main_menu")
+def show_main_menu(call):
+    """Returns the user to the main menu."""
+    bot.edit_message_text("Головне меню:", call.message.chat.id, call.message.message_id,
+                          reply_markup=get_main_menu())
+
+@callback_route("get_invite")
+def handle_get_invite(call):
+    """Sends the channel invite link."""
+    send_invite_link(call.message.chat.id)
+
+@callback_route("channels_by_city")
+def show_channels_by_city(call):
+    """Placeholder for channels-by-city listing."""
+    bot.send_message(call.message.chat.id, "Функція 'Канали за містами' ще не реалізована для звичайних користувачів, але ви можете переглянути свої додані канали та групи.")
+
+@callback_route("channels_stats")
+def show_user_channels_stats(call):
+    """Channel statistics are admin-only."""
+    bot.send_message(call.message.chat.id, "Функція 'Статистика каналів' доступна тільки адміністраторам.")
+
+@callback_route("help")
+def show_help(call):
+    """Placeholder for the help screen."""
+    bot.send_message(call.message.chat.id, "Допомога ще не реалізована. Зверніться до адміністратора.")
+
+@callback_route("skip_rating")
+def skip_rating(call):
+    """Dismisses the rating prompt."""
+    bot.edit_message_text("Добре, ви пропустили оцінку.", call.message.chat.id, call.message.message_id,
+                          reply_markup=get_main_menu())
+
+@callback_route("admin_menu", admin=True)
+def show_admin_menu(call):
+    """Returns the admin to the admin panel."""
+    bot.edit_message_text("🔧 Панель адміністратора", call.message.chat.id, call.message.message_id, reply_markup=get_admin_menu())
+
+@callback_route("admin_settings", admin=True)
+def show_admin_settings(call):
+    """Placeholder for admin panel settings."""
+    bot.send_message(call.message.chat.id, "Налаштування адмін-панелі ще не реалізовані.")
+
+@bot.message_handler(commands=['callback_stats'])
+@timed_handler('/callback_stats')
+def callback_stats_command(message):
+    """Shows per-route callback timings to admins."""
+    if message.chat.id not in ALLOWED_ADMINS:
+        bot.send_message(message.chat.id, "❌ У вас немає прав доступу до цієї функції.")
+        return
 
-        elif call.data == "stats":
-            show_overall_stats(call)
+    rows = callback_router.stats()[:15]
+    if not rows:
+        bot.send_message(message.chat.id, "Ще немає оброблених кнопок.")
+        return
+    text = "⏱️ Час обробки кнопок (топ-15):\n\n"
+    for row in rows:
+        avg_ms = row['total_time'] / row['calls'] * 1000
+        text += f"{row['pattern']}: {row['calls']} викл., сер. {avg_ms:.1f} мс, макс. {row['max_time'] * 1000:.1f} мс, помилок: {row['errors']}\n"
+    bot.send_message(message.chat.id, text)
+
+@bot.message_handler(commands=['api_stats'])
+@timed_handler('/api_stats')
+def api_stats_command(message):
+    """Shows per-method Telegram API latency to admins."""
+    if message.chat.id not in ALLOWED_ADMINS:
+        bot.send_message(message.chat.id, "❌ У вас немає прав доступу до цієї функції.")
+        return
 
-        elif call.data == "help":
-            bot.send_message(chat_id, "Допомога ще не реалізована. Зверніться до адміністратора.")
+    rows = telegram_transport.stats()[:15]
+    if not rows:
+        bot.send_message(message.chat.id, "Ще немає запитів до Telegram API.")
+        return
+    text = "📡 Затримка Telegram API (топ-15):\n\n"
+    for row in rows:
+        text += (f"{row['method']}: {row['calls']} викл., p50 {row['p50'] * 1000:.0f} мс, p95 {row['p95'] * 1000:.0f} мс, "
+                 f"p99 {row['p99'] * 1000:.0f} мс, макс. {row['max'] * 1000:.0f} мс, помилок: {row['errors']}\n")
+    bot.send_message(message.chat.id, text)
+
+@bot.message_handler(commands=['profile'])
+@timed_handler('/profile')
+def profile_command(message):
+    """Profiles the running bot for N seconds (/profile [N]) and sends the collapsed stacks to the admin."""
+    if message.chat.id not in ALLOWED_ADMINS:
+        bot.send_message(message.chat.id, "❌ У вас немає прав доступу до цієї функції.")
+        return
 
-        elif call.data == "skip_rating":
-            bot.edit_message_text("Добре, ви пропустили оцінку.", chat_id, call.message.message_id,
-                                  reply_markup=get_main_menu())
-            return
+    args = message.text.split()[1:]
+    try:
+        seconds = int(args[0]) if args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        bot.send_message(message.chat.id, "Використання: /profile [секунд]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    bot.send_message(message.chat.id, f"🔥 Профілювання {seconds} с, результат надійде файлом.")
+    start_profile(seconds, [message.chat.id])
+
+@bot.message_handler(commands=['slow_queries'])
+@timed_handler('/slow_queries')
+def slow_queries_command(message):
+    """Shows the statements with the most time over SLOW_QUERY_THRESHOLD_MS (/slow_queries reset clears them)."""
+    if message.chat.id not in ALLOWED_ADMINS:
+        bot.send_message(message.chat.id, "❌ У вас немає прав доступу до цієї функції.")
+        return
 
-    except Exception as e:
-        logging.error(f"Помилка в callback_handler: {e}")
-        bot.send_message(chat_id, "Сталася помилка під час обробки вашого запиту. Спробуйте ще раз або зверніться до адміністратора.")
+    if message.text.split()[1:2] == ['reset']:
+        slow_queries.reset()
+        bot.send_message(message.chat.id, "✅ Журнал повільних запитів очищено.")
+        return
+    rows = slow_queries.top(10)
+    if not rows:
+        bot.send_message(message.chat.id, f"Запитів, повільніших за {SLOW_QUERY_THRESHOLD_MS:.0f} мс, ще не було.")
+        return
+    text = f"🐢 Повільні запити (> {SLOW_QUERY_THRESHOLD_MS:.0f} мс, топ-10 за сумарним часом):\n\n"
+    for row in rows:
+        text += (f"{row['helper']}: {row['calls']} разів, сумарно {row['total']:.1f} с, "
+                 f"макс. {row['max'] * 1000:.0f} мс, помилок: {row['errors']}, параметри {row['params']}\n"
+                 f"  {row['sql'][:150]}\n\n")
+    bot.send_message(message.chat.id, text[:4096])
 
 
 # ============ REGISTRATION WITH CITY SELECTION ============
 
+@callback_route("register")
 def handle_registration_start(call):
     """Starts the registration process by prompting the user to select a city."""
     chat_id = call.message.chat.id
@@ -509,16 +2164,17 @@ def handle_registration_start(call):
     bot.edit_message_text(text, chat_id, call.message.message_id,
                           reply_markup=get_cities_keyboard())
 
+@callback_route("my_cities")
 def show_cities_selection(call):
     """Displays the city selection keyboard."""
     text = "🏙️ Оберіть місто для налаштування таргетованих розсилок:"
     bot.edit_message_text(text, call.message.chat.id, call.message.message_id,
                           reply_markup=get_cities_keyboard())
 
-def handle_city_selection(call):
+@callback_route("select_city_{city_key:rest}")
+def handle_city_selection(call, city_key):
     """Handles the user's city selection during registration or city update."""
     chat_id = call.message.chat.id
-    city_key = call.data.replace("select_city_", "")
     city_name = city_key.replace('_', ' ').title()
     hashtag = UKRAINIAN_CITIES.get(city_key, f"#{city_name}")
 
@@ -526,18 +2182,24 @@ def handle_city_selection(call):
 
     try:
         conn = get_db_connection()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO users (chat_id, username, first_name, city)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (chat_id) DO UPDATE SET
-                    username = EXCLUDED.username,
-                    first_name = EXCLUDED.first_name,
-                    city = EXCLUDED.city;
-                """, (chat_id, user_info.username, user_info.first_name, city_key))
-
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO users (chat_id, username, first_name, city)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (chat_id) DO UPDATE SET
+                        username = EXCLUDED.username,
+                        first_name = EXCLUDED.first_name,
+                        city = EXCLUDED.city,
+                        is_active = TRUE -- A returning user who was deactivated as unreachable is reachable again
+                        RETURNING city, notifications, is_active;
+                    """, (chat_id, user_info.username, user_info.first_name, city_key))
+                    profile = dict(cur.fetchone())
+                    user_profiles.set(chat_id, profile) # Write-through to the profile cache
+                    audience_index.apply(chat_id, profile)
+        finally:
+            conn.close()
 
         bot.edit_message_text(
             f"✅ Вітаємо в {city_name}! {hashtag}\n\n"
@@ -553,6 +2215,7 @@ def handle_city_selection(call):
 
 # ============ ADDING CHANNELS / GROUPS ============
 
+@callback_route("add_channel")
 def handle_add_channel_start(call):
     """Starts the process of adding a new channel."""
     chat_id = call.message.chat.id
@@ -563,10 +2226,11 @@ def handle_add_channel_start(call):
         chat_id, call.message.message_id
     )
 
-    if chat_id not in user_states:
-        user_states[chat_id] = {}
-    user_states[chat_id]['waiting_for'] = 'channel_name'
+    state = user_states.get(chat_id) or {}
+    state['waiting_for'] = 'channel_name'
+    user_states.set(chat_id, state)
 
+@callback_route("add_group")
 def handle_add_group_start(call):
     """Starts the process of adding a new group."""
     chat_id = call.message.chat.id
@@ -577,42 +2241,50 @@ def handle_add_group_start(call):
         chat_id, call.message.message_id
     )
 
-    if chat_id not in user_states:
-        user_states[chat_id] = {}
-    user_states[chat_id]['waiting_for'] = 'group_name'
+    state = user_states.get(chat_id) or {}
+    state['waiting_for'] = 'group_name'
+    user_states.set(chat_id, state)
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and 'waiting_for' in user_states[message.chat.id])
+def is_waiting_for_input(message):
+    """Handler filter: true when the chat is in the middle of a multi-step conversation."""
+    state = user_states.get(message.chat.id)
+    # Keep the state on the message so handle_user_input does not read the store a second time
+    message.conversation_state = state
+    return bool(state and 'waiting_for' in state)
+
+@bot.message_handler(func=is_waiting_for_input)
+@timed_handler('text_input')
 def handle_user_input(message):
     """Handles user input during multi-step processes like adding channels/groups."""
     chat_id = message.chat.id
-    input_type = user_states[chat_id]['waiting_for']
+    state = message.conversation_state
+    input_type = state['waiting_for']
     user_input = message.text.strip()
 
     # Admin broadcast input handler
     if input_type.startswith('admin_broadcast_'):
-        handle_admin_broadcast_input(message, user_input, input_type)
+        handle_admin_broadcast_input(message, user_input, input_type, state)
         return
     # NEW: Admin bot activity input handler
     elif input_type.startswith('admin_bot_target_location_') or input_type.startswith('admin_comment_template_'):
-        handle_admin_bot_activity_input(message, user_input, input_type)
+        handle_admin_bot_activity_input(message, user_input, input_type, state)
         return
 
     if input_type == 'channel_name':
-        handle_channel_name_input(message, user_input)
+        handle_channel_name_input(message, user_input, state)
     elif input_type == 'group_name':
-        handle_group_name_input(message, user_input)
+        handle_group_name_input(message, user_input, state)
     elif input_type == 'channel_link':
-        complete_channel_addition(message, user_input)
+        complete_channel_addition(message, user_input, state)
     elif input_type == 'group_link':
-        complete_group_addition(message, user_input)
+        complete_group_addition(message, user_input, state)
     else:
         # Clear state if an unexpected input type is encountered
-        if chat_id in user_states:
-            del user_states[chat_id]
+        user_states.delete(chat_id)
         bot.send_message(chat_id, "Неочікуване введення. Будь ласка, спробуйте знову з головного меню.", reply_markup=get_main_menu())
 
 
-def handle_channel_name_input(message, channel_name):
+def handle_channel_name_input(message, channel_name, state):
     """Processes the channel name input from the user."""
     chat_id = message.chat.id
 
@@ -623,8 +2295,9 @@ def handle_channel_name_input(message, channel_name):
         bot.send_message(chat_id, "❌ Некоректна назва каналу. Спробуйте ще раз:")
         return
 
-    user_states[chat_id]['channel_name'] = clean_name
-    user_states[chat_id]['waiting_for'] = 'channel_link'
+    state['channel_name'] = clean_name
+    state['waiting_for'] = 'channel_link'
+    user_states.set(chat_id, state)
 
     bot.send_message(
         chat_id,
@@ -632,7 +2305,7 @@ def handle_channel_name_input(message, channel_name):
         "Тепер введіть посилання на канал (https://t.me/...):"
     )
 
-def handle_group_name_input(message, group_name):
+def handle_group_name_input(message, group_name, state):
     """Processes the group name input from the user."""
     chat_id = message.chat.id
 
@@ -643,8 +2316,9 @@ def handle_group_name_input(message, group_name):
         bot.send_message(chat_id, "❌ Некоректна назва групи. Спробуйте ще раз:")
         return
 
-    user_states[chat_id]['group_name'] = clean_name
-    user_states[chat_id]['waiting_for'] = 'group_link'
+    state['group_name'] = clean_name
+    state['waiting_for'] = 'group_link'
+    user_states.set(chat_id, state)
 
     bot.send_message(
         chat_id,
@@ -652,7 +2326,7 @@ def handle_group_name_input(message, group_name):
         "Тепер введіть посилання на групу (https://t.me/...):"
     )
 
-def complete_channel_addition(message, channel_link):
+def complete_channel_addition(message, channel_link, state):
     """Completes the channel addition process, saving data to the database."""
     chat_id = message.chat.id
 
@@ -660,10 +2334,10 @@ def complete_channel_addition(message, channel_link):
         bot.send_message(chat_id, "❌ Посилання має починатися з https://t.me/\nСпробуйте ще раз:")
         return
 
-    channel_name = user_states[chat_id].get('channel_name')
+    channel_name = state.get('channel_name')
     if not channel_name:
         bot.send_message(chat_id, "Назва каналу не знайдена. Будь ласка, почніть знову.", reply_markup=get_main_menu())
-        del user_states[chat_id]
+        user_states.delete(chat_id)
         return
 
     # Get the user's city
@@ -671,17 +2345,18 @@ def complete_channel_addition(message, channel_link):
 
     try:
         conn = get_db_connection()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO target_channels (channel_name, channel_link, city, added_by)
-                    VALUES (%s, %s, %s, %s);
-                """, (channel_name, channel_link, user_city, chat_id))
-
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO target_channels (channel_name, channel_link, city, added_by)
+                        VALUES (%s, %s, %s, %s);
+                    """, (channel_name, channel_link, user_city, chat_id))
+        finally:
+            conn.close()
 
         # Clear the user's state
-        del user_states[chat_id]
+        user_states.delete(chat_id)
 
         city_hashtag = UKRAINIAN_CITIES.get(user_city, f"#{user_city.replace('_', ' ').title()}")
 
@@ -697,10 +2372,9 @@ def complete_channel_addition(message, channel_link):
     except Exception as e:
         logging.error(f"Помилка при додаванні каналу: {e}")
         bot.send_message(chat_id, "❌ Сталася помилка при додаванні каналу.")
-        if chat_id in user_states:
-            del user_states[chat_id]
+        user_states.delete(chat_id)
 
-def complete_group_addition(message, group_link):
+def complete_group_addition(message, group_link, state):
     """Completes the group addition process, saving data to the database."""
     chat_id = message.chat.id
 
@@ -708,10 +2382,10 @@ def complete_group_addition(message, group_link):
         bot.send_message(chat_id, "❌ Посилання має починатися з https://t.me/\nСпробуйте ще раз:")
         return
 
-    group_name = user_states[chat_id].get('group_name')
+    group_name = state.get('group_name')
     if not group_name:
         bot.send_message(chat_id, "Назва групи не знайдена. Будь ласка, почніть знову.", reply_markup=get_main_menu())
-        del user_states[chat_id]
+        user_states.delete(chat_id)
         return
 
     # Get the user's city
@@ -719,17 +2393,18 @@ def complete_group_addition(message, group_link):
 
     try:
         conn = get_db_connection()
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO target_groups (group_name, group_link, city, added_by)
-                    VALUES (%s, %s, %s, %s);
-                """, (group_name, group_link, user_city, chat_id))
-
-        conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO target_groups (group_name, group_link, city, added_by)
+                        VALUES (%s, %s, %s, %s);
+                    """, (group_name, group_link, user_city, chat_id))
+        finally:
+            conn.close()
 
         # Clear the user's state
-        del user_states[chat_id]
+        user_states.delete(chat_id)
 
         city_hashtag = UKRAINIAN_CITIES.get(user_city, f"#{user_city.replace('_', ' ').title()}")
 
@@ -745,157 +2420,765 @@ def complete_group_addition(message, group_link):
     except Exception as e:
         logging.error(f"Помилка при додаванні групи: {e}")
         bot.send_message(chat_id, "❌ Сталася помилка при додаванні групи.")
-        if chat_id in user_states:
-            del user_states[chat_id]
+        user_states.delete(chat_id)
 
 # ============ RATING SYSTEM ============
 
-def handle_rating(call):
-    """Handles user rating of a broadcast message."""
-    chat_id = call.message.chat.id
-    parts = call.data.split('_')
-    template_id = int(parts[1])
-    rating = int(parts[2])
-
-    try:
+# Ratings are written behind: taps are buffered and flushed every RATING_FLUSH_INTERVAL seconds
+# or once RATING_FLUSH_SIZE distinct (user, template) pairs are pending, whichever comes first.
+RATING_FLUSH_INTERVAL = float(os.getenv('RATING_FLUSH_INTERVAL', '2'))
+RATING_FLUSH_SIZE = int(os.getenv('RATING_FLUSH_SIZE', '500'))
+# template_id -> whether it still exists, so a tap is only confirmed for a template the batch will accept
+RATING_TEMPLATE_CACHE_TTL = float(os.getenv('RATING_TEMPLATE_CACHE_TTL', '300'))
+rating_templates = TTLCache(1000, RATING_TEMPLATE_CACHE_TTL)
+
+def broadcast_template_exists(template_id):
+    exists = rating_templates.get(template_id)
+    if exists is None:
         conn = get_db_connection()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT EXISTS (SELECT 1 FROM broadcast_templates WHERE id = %s) AS exists;",
+                                (template_id,))
+                    exists = cur.fetchone()['exists']
+        finally:
+            conn.close()
+        rating_templates.set(template_id, exists)
+    return exists
+
+def rating_rejection(rating, profile, template_exists):
+    """Why save_ratings would drop this rating (text for the user), or None if it will be stored."""
+    if not 1 <= rating <= 5:
+        return "❌ Некоректна оцінка."
+    if not profile:
+        return "❌ Оцінку не збережено: спершу зареєструйтесь через /start."
+    if not template_exists:
+        return "❌ Ця розсилка вже недоступна для оцінювання."
+    return None
+
+def save_ratings(ratings):
+    """
+    Upserts {(user_chat_id, template_id): rating} in one statement. Out-of-range ratings and ones
+    for users or templates that no longer exist are filtered out instead of failing the batch.
+    Returns the set of (user_chat_id, template_id) keys written.
+    """
+    conn = get_db_connection()
+    try:
         with conn:
             with conn.cursor() as cur:
-                cur.execute("""
+                rows = execute_values(cur, """
                     INSERT INTO broadcast_ratings (user_chat_id, template_id, rating)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (user_chat_id, template_id) DO UPDATE SET rating = EXCLUDED.rating;
-                """, (chat_id, template_id, rating))
+                    SELECT v.user_chat_id, v.template_id, v.rating
+                    FROM (VALUES %s) AS v (user_chat_id, template_id, rating)
+                    JOIN users u ON u.chat_id = v.user_chat_id
+                    JOIN broadcast_templates bt ON bt.id = v.template_id
+                    WHERE v.rating BETWEEN 1 AND 5
+                    ORDER BY v.user_chat_id, v.template_id
+                    ON CONFLICT (user_chat_id, template_id) DO UPDATE SET rating = EXCLUDED.rating
+                    RETURNING user_chat_id, template_id;
+                """, [(chat_id, template_id, rating) for (chat_id, template_id), rating in ratings.items()],
+                    page_size=len(ratings), fetch=True)
+                return {(row['user_chat_id'], row['template_id']) for row in rows}
+    finally:
+        if conn:
+            conn.close()
 
-        conn.close()
+class BatchWriter(abc.ABC):
+    """
+    Collects keyed items in memory (last write wins per key) and hands them to write() in batches from a
+    background thread every flush_interval seconds, or as soon as flush_size keys are pending.
+    """
+    thread_name = "batch-writer"
+
+    def __init__(self, flush_interval, flush_size):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _add(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            full = len(self._pending) >= self.flush_size
+            if self._thread is None and not self._stopped.is_set():
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    @abc.abstractmethod
+    def write(self, batch):
+        """Persists a {key: value} batch and returns the number of items written."""
+
+    def flush(self):
+        """Writes everything pending; on failure the batch is kept (newer items win) for the next flush."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            try:
+                return self.write(batch)
+            except Exception as e:
+                logging.error(f"Помилка при записі пакета {self.thread_name} ({len(batch)} записів): {e}")
+                with self._lock:
+                    for key, value in batch.items():
+                        self._pending.setdefault(key, value)
+                return 0
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stops the background flusher and writes whatever is still buffered."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+class RatingWriter(BatchWriter):
+    """Collects rating taps in memory (last write wins per user/template) and flushes them in batches."""
+    thread_name = "rating-writer"
+
+    def submit(self, chat_id, template_id, rating):
+        self._add((chat_id, template_id), rating)
+
+    def write(self, batch):
+        written = save_ratings(batch)
+        # Taps are validated before they are confirmed, so these are users or templates deleted meanwhile
+        for (chat_id, template_id) in batch.keys() - written:
+            logging.warning(f"Оцінку {batch[(chat_id, template_id)]} від {chat_id} для розсилки {template_id} не збережено: "
+                            f"користувача або шаблон розсилки вже видалено")
+        return len(written)
+
+rating_writer = RatingWriter(RATING_FLUSH_INTERVAL, RATING_FLUSH_SIZE)
+atexit.register(rating_writer.close)
+
+def build_rating_thanks_text(rating):
+    """Confirmation shown after a broadcast was rated."""
+    return f"✅ Дякуємо за оцінку: {rating}⭐\n\n" \
+           "Ваша думка допоможе нам покращити якість розсилок!"
+
+@callback_route("rate_{template_id:int}_{rating:int}")
+def handle_rating(call, template_id, rating):
+    """Handles user rating of a broadcast message."""
+    chat_id = call.message.chat.id
 
-        bot.edit_message_text(
-            f"✅ Дякуємо за оцінку: {rating}⭐\n\n"
-            "Ваша думка допоможе нам покращити якість розсилок!",
-            chat_id, call.message.message_id,
-            reply_markup=get_main_menu()
-        )
+    try:
+        rejection = rating_rejection(rating, get_user_profile(chat_id), broadcast_template_exists(template_id))
+        if rejection:
+            bot.edit_message_text(rejection, chat_id, call.message.message_id, reply_markup=get_main_menu())
+            return
+
+        # Confirmed right away; the rating reaches the database with the next batch
+        rating_writer.submit(chat_id, template_id, rating)
+
+        bot.edit_message_text(build_rating_thanks_text(rating), chat_id, call.message.message_id,
+                              reply_markup=get_main_menu())
 
     except Exception as e:
         logging.error(f"Помилка при збереженні рейтингу: {e}")
         bot.send_message(chat_id, "Помилка при збереженні оцінки.")
 
+# ============ BROADCAST DELIVERY ENGINE ============
+
+# Sends are paced by the transport's OutboundLimiter in its bulk lane
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+BROADCAST_QUEUE_SIZE = int(os.getenv('BROADCAST_QUEUE_SIZE', '1000'))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+# Recipients queued per transaction (and per last_chat_id checkpoint) when expanding a broadcast job
+BROADCAST_EXPAND_BATCH = int(os.getenv('BROADCAST_EXPAND_BATCH', '1000'))
+# Deliveries claimed per round trip by a worker, and seconds after which an unfinished claim is retaken
+BROADCAST_CLAIM_BATCH = int(os.getenv('BROADCAST_CLAIM_BATCH', '100'))
+BROADCAST_CLAIM_TIMEOUT = int(os.getenv('BROADCAST_CLAIM_TIMEOUT', '300'))
+BROADCAST_POLL_INTERVAL = float(os.getenv('BROADCAST_POLL_INTERVAL', '2'))
+# Run a delivery worker inside the bot process too. The Procfile turns it off for `web`, because the
+# `worker` process type drains the queue there; single-process deployments keep the default.
+BROADCAST_INPROCESS_WORKER = os.getenv('BROADCAST_INPROCESS_WORKER', '1') == '1'
+# Rows fetched per round trip when streaming broadcast recipients from Postgres
+BROADCAST_CURSOR_ITERSIZE = int(os.getenv('BROADCAST_CURSOR_ITERSIZE', '2000'))
+# Users who blocked the bot or deleted their account are deactivated in batches of up to
+# UNREACHABLE_FLUSH_SIZE, at least every UNREACHABLE_FLUSH_INTERVAL seconds
+UNREACHABLE_FLUSH_INTERVAL = float(os.getenv('UNREACHABLE_FLUSH_INTERVAL', '5'))
+UNREACHABLE_FLUSH_SIZE = int(os.getenv('UNREACHABLE_FLUSH_SIZE', '200'))
+
+# 400 descriptions that mean the chat is gone for good (every 403 does: blocked, kicked, deactivated)
+PERMANENT_BAD_REQUESTS = ('chat not found', 'user is deactivated', 'peer_id_invalid')
+
+def is_permanent_delivery_error(error_code, description):
+    """True for Telegram errors after which sending to the chat again can never succeed."""
+    if error_code == 403:
+        return True
+    description = (description or '').lower()
+    return error_code == 400 and any(text in description for text in PERMANENT_BAD_REQUESTS)
+
+class UnreachableUsers(BatchWriter):
+    """Collects chat_ids that failed permanently during delivery and marks them is_active = FALSE in batches."""
+    thread_name = "unreachable-users"
+
+    def submit(self, chat_id, reason):
+        self._add(chat_id, reason)
+
+    def write(self, batch):
+        deactivated = deactivate_users(list(batch))
+        if deactivated:
+            logging.info(f"Деактивовано {deactivated} недоступних користувачів (заблокували бота або видалили акаунт)")
+        return deactivated
+
+unreachable_users = UnreachableUsers(UNREACHABLE_FLUSH_INTERVAL, UNREACHABLE_FLUSH_SIZE)
+atexit.register(unreachable_users.close)
+
+class BroadcastJob:
+    """Tracks progress of one queued broadcast and fires on_complete once every message was attempted."""
+    log_summary = True
+
+    def __init__(self, name, on_complete=None):
+        self.name = name
+        self.sent_count = 0
+        self.failed_count = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.producer_failed = False
+        self._on_complete = on_complete
+        self._pending = 0
+        self._producer_done = False
+        self._lock = threading.Lock()
+
+    @property
+    def messages_per_second(self):
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return self.sent_count / elapsed if elapsed > 0 else 0.0
+
+    def _add_pending(self):
+        with self._lock:
+            self._pending += 1
+
+    def _record(self, chat_id, success, error_message=None):
+        with self._lock:
+            if success:
+                self.sent_count += 1
+            else:
+                self.failed_count += 1
+            self._pending -= 1
+            done = self._producer_done and self._pending == 0
+        if done:
+            self._finish()
+
+    def _close_producer(self):
+        with self._lock:
+            self._producer_done = True
+            done = self._pending == 0
+        if done:
+            self._finish()
+
+    def _finish(self):
+        self.finished_at = time.monotonic()
+        if self.log_summary:
+            logging.info(f"Розсилка '{self.name}' завершена: надіслано {self.sent_count}, помилок {self.failed_count}, "
+                         f"{self.messages_per_second:.1f} повідомлень/с")
+        if self._on_complete:
+            try:
+                self._on_complete(self)
+            except Exception as e:
+                logging.error(f"Помилка у зворотному виклику розсилки '{self.name}': {e}")
+
+class DeliveryEngine:
+    """
+    Worker pool that drains a bounded queue of outgoing broadcast messages. Its threads send in the
+    outbound limiter's bulk lane, so interactive replies go first; 429s are retried after retry_after.
+    """
+    def __init__(self, workers, queue_size, max_retries):
+        self._workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._max_retries = max_retries
+        self._started = False
+        self._start_lock = threading.Lock()
+        self.total_sent = 0
+        self.total_failed = 0
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._started:
+                return
+            for i in range(self._workers):
+                threading.Thread(target=self._worker_loop, name=f"broadcast-worker-{i}", daemon=True).start()
+            self._started = True
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, job, recipients):
+        """Feeds (chat_id, text, reply_markup) tuples into the queue from a background producer thread."""
+        self._ensure_started()
+
+        def produce():
+            try:
+                for chat_id, text, reply_markup in recipients:
+                    job._add_pending()
+                    self._queue.put((job, chat_id, text, reply_markup))
+            except Exception as e:
+                job.producer_failed = True
+                logging.error(f"Помилка при формуванні черги розсилки '{job.name}': {e}")
+            finally:
+                job._close_producer()
+
+        threading.Thread(target=produce, name=f"broadcast-producer-{job.name}", daemon=True).start()
+        return job
+
+    def _worker_loop(self):
+        with outbound_limiter.bulk_sends():
+            self._drain_queue()
+
+    def _drain_queue(self):
+        while True:
+            job, chat_id, text, reply_markup = self._queue.get()
+            try:
+                success, error_message = self._deliver(chat_id, text, reply_markup)
+            finally:
+                self._queue.task_done()
+            if success:
+                self.total_sent += 1
+            else:
+                self.total_failed += 1
+            BROADCAST_MESSAGES.inc('sent' if success else 'failed')
+            try:
+                job._record(chat_id, success, error_message)
+            except Exception as e:
+                logging.error(f"Помилка при обліку доставки {chat_id} для '{job.name}': {e}")
+
+    def _deliver(self, chat_id, text, reply_markup):
+        for attempt in range(self._max_retries + 1):
+            try:
+                bot.send_message(chat_id, text, reply_markup=reply_markup)
+                return True, None
+            except ApiTelegramException as e:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+                if e.error_code == 429 and retry_after and attempt < self._max_retries:
+                    # The transport has already paused the limiter for retry_after seconds
+                    logging.warning(f"Telegram flood limit, повтор для {chat_id} через {retry_after}с")
+                    continue
+                if is_permanent_delivery_error(e.error_code, e.description):
+                    logging.info(f"Користувач {chat_id} недоступний ({e.description}), буде деактивований")
+                    unreachable_users.submit(chat_id, e.description)
+                    return False, str(e)
+                logging.error(f"Помилка відправки повідомлення {chat_id}: {e}")
+                return False, str(e)
+            except Exception as e:
+                logging.error(f"Помилка відправки повідомлення {chat_id}: {e}")
+                return False, str(e)
+        return False, "retries exhausted"
+
+broadcast_engine = DeliveryEngine(BROADCAST_WORKERS, BROADCAST_QUEUE_SIZE, BROADCAST_MAX_RETRIES)
+
+class DeliveryBatch(BroadcastJob):
+    """Deliveries of one persisted broadcast job claimed by this worker; each outcome is written back immediately."""
+    log_summary = False # The job as a whole is reported once complete_finished_broadcast_jobs closes it
+
+    def __init__(self, job_id, name, on_complete=None):
+        super().__init__(name, on_complete)
+        self.job_id = job_id
+
+    def _record(self, chat_id, success, error_message=None):
+        record_broadcast_delivery(self.job_id, chat_id, 'sent' if success else 'failed', error_message)
+        super()._record(chat_id, success, error_message)
+
 # ============ SEGMENTED BROADCAST ============
 
-def send_broadcast_by_city(message_text, target_cities=None, template_id=None, is_test=False, chat_id_for_test=None):
+def parse_target_cities(target_cities):
+    """Converts a template's comma-separated target_cities into a list (None means all cities)."""
+    if not target_cities:
+        return None # Send to all if no cities specified
+    return [city.strip().lower() for city in target_cities.split(',') if city.strip()]
+
+def broadcast_recipients_query(target_cities=None, after_chat_id=None):
+    """Builds the (sql, params) of the recipient scan, or None when a city filter leaves no cities."""
+    conditions = ["is_active = TRUE", "notifications = TRUE"]
+    params = []
+    if target_cities:
+        # Ensure target_cities is a tuple or list for IN clause
+        target_cities_tuple = tuple(c.strip().lower() for c in target_cities if c.strip())
+        if not target_cities_tuple:
+            # If target_cities is provided but empty after stripping, send to no one.
+            return None
+        conditions.append(f"city IN ({','.join(['%s'] * len(target_cities_tuple))})")
+        params.extend(target_cities_tuple)
+    if after_chat_id is not None:
+        conditions.append("chat_id > %s")
+        params.append(after_chat_id)
+    return f"""
+        SELECT chat_id, city FROM users
+        WHERE {' AND '.join(conditions)}
+        ORDER BY chat_id;
+    """, params
+
+def iter_broadcast_recipients(target_cities=None, after_chat_id=None):
     """
-    Sends a broadcast message to users, optionally filtered by city,
-    and includes a rating button if a template_id is provided.
-    If is_test is True, sends only to chat_id_for_test.
+    Streams active users with notifications enabled in chat_id order, optionally filtered by city.
+    Rows come from a server-side (named) cursor BROADCAST_CURSOR_ITERSIZE at a time,
+    so memory stays flat and the first rows are available before the scan finishes.
+    after_chat_id resumes from a keyset checkpoint.
     """
-    if is_test and chat_id_for_test:
-        users = [{'chat_id': chat_id_for_test, 'city': 'тестове'}] # Mock city for test
-    else:
-        conn = get_db_connection()
-        users = []
+    query = broadcast_recipients_query(target_cities, after_chat_id)
+    if query is None:
+        return
+    sql, params = query
+
+    conn = get_db_connection()
+    try:
+        with conn:
+            with conn.cursor(name='broadcast_recipients') as cur:
+                cur.itersize = BROADCAST_CURSOR_ITERSIZE
+                cur.execute(sql, params)
+                for user in cur:
+                    yield user
+    except Exception as e:
+        logging.error(f"Помилка при отриманні користувачів для розсилки: {e}")
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+# Seconds after which the audience index is rebuilt from Postgres, picking up changes made by other processes;
+# this is also how stale its counts can be
+AUDIENCE_INDEX_REFRESH = float(os.getenv('AUDIENCE_INDEX_REFRESH', '900'))
+
+class AudienceIndex:
+    """
+    In-memory broadcast audience: a sorted array('q') of chat_ids per city holding every active user with
+    notifications on. Loaded from Postgres on first use (and every `refresh_after` seconds), then kept
+    current by apply() from this process's profile write-through points, so audience counts need no scan
+    (a stale index is reloaded in the background; only the very first load makes a caller wait).
+    Writes made by other processes (worker dynos, other web replicas) only show up after the next refresh,
+    so the index is for counts and previews only; broadcast recipients are always read from Postgres.
+    """
+    def __init__(self, refresh_after):
+        self.refresh_after = refresh_after
+        self._segments = {} # city -> sorted array('q') of chat_ids
+        self._loaded_at = None
+        self._replay = None # Events seen while a load is running, applied on top of its result
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """Rebuilds the index from the users table."""
+        with self._load_lock:
+            self._load()
+
+    def _load(self):
+        with self._lock:
+            self._replay = []
         try:
-            with conn:
-                with conn.cursor() as cur:
-                    if target_cities:
-                        # Ensure target_cities is a tuple or list for IN clause
-                        target_cities_tuple = tuple(c.strip().lower() for c in target_cities if c.strip())
-                        if target_cities_tuple:
-                            placeholders = ','.join(['%s'] * len(target_cities_tuple))
-                            cur.execute(f"""
-                                SELECT chat_id, city FROM users
-                                WHERE is_active = TRUE AND notifications = TRUE
-                                AND city IN ({placeholders});
-                            """, target_cities_tuple)
-                        else:
-                            # If target_cities is provided but empty after stripping, send to no one.
-                            users = []
-                    else:
-                        cur.execute("""
-                            SELECT chat_id, city FROM users
-                            WHERE is_active = TRUE AND notifications = TRUE;
-                        """)
-                    users = cur.fetchall()
+            segments = collections.defaultdict(lambda: array.array('q'))
+            for user in iter_broadcast_recipients():
+                segments[user['city']].append(user['chat_id']) # Rows arrive in chat_id order
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+        with self._lock:
+            self._segments = dict(segments)
+            replay, self._replay = self._replay, None
+            for chat_id, profile in replay:
+                self._apply(chat_id, profile)
+            self._loaded_at = time.monotonic()
+        logging.info(f"Індекс аудиторії завантажено: {sum(len(ids) for ids in segments.values())} користувачів, "
+                     f"{len(segments)} міст")
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_after
+
+    def _ensure_loaded(self):
+        """Blocks only for the first load; afterwards a stale index keeps serving while it reloads in the background."""
+        if self._loaded_at is None:
+            with self._load_lock:
+                if self._loaded_at is None: # Another thread may have loaded it meanwhile
+                    self._load()
+        elif self._is_stale() and self._load_lock.acquire(blocking=False):
+            threading.Thread(target=self._refresh, name="audience-index-refresh", daemon=True).start()
+
+    def _refresh(self):
+        # Runs holding _load_lock, acquired by _ensure_loaded on the caller's thread
+        try:
+            if self._is_stale():
+                self._load()
         except Exception as e:
-            logging.error(f"Помилка при отриманні користувачів для розсилки: {e}")
+            logging.error(f"Помилка оновлення індексу аудиторії: {e}")
         finally:
-            if conn:
-                conn.close()
-
-    success_count = 0
+            self._load_lock.release()
+
+    def apply(self, chat_id, profile):
+        """Records a user's current profile (city/notifications/is_active) after it was written to Postgres."""
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((chat_id, profile))
+            self._apply(chat_id, profile)
+
+    def _apply(self, chat_id, profile):
+        for ids in self._segments.values():
+            position = bisect.bisect_left(ids, chat_id)
+            if position < len(ids) and ids[position] == chat_id:
+                del ids[position]
+                break
+        if profile and profile['is_active'] and profile['notifications']:
+            ids = self._segments.setdefault(profile['city'], array.array('q'))
+            ids.insert(bisect.bisect_left(ids, chat_id), chat_id)
+
+    def _selected(self, target_cities):
+        if not target_cities:
+            return list(self._segments.items())
+        cities = {c.strip().lower() for c in target_cities if c.strip()}
+        return [(city, ids) for city, ids in self._segments.items() if city in cities]
+
+    def count(self, target_cities=None):
+        """Number of recipients for a list of cities (None means all cities)."""
+        self._ensure_loaded()
+        with self._lock:
+            return sum(len(ids) for city, ids in self._selected(target_cities))
+
+audience_index = AudienceIndex(AUDIENCE_INDEX_REFRESH)
+
+def build_broadcast_messages(users, message_text, keyboard=None):
+    """Yields (chat_id, text, reply_markup) for each recipient, tagging the text with the user's city hashtag."""
     for user in users:
-        try:
-            chat_id = user['chat_id']
-            user_city = user['city'] if 'city' in user else 'не вказано' # Handle potential missing city
-
-            # Use generic hashtag for test messages or if city is not found
-            city_hashtag = UKRAINIAN_CITIES.get(user_city, f"#{user_city.replace('_', ' ').title()}")
+        user_city = user['city'] or 'не вказано' # Handle potential missing city
+        # Use generic hashtag for test messages or if city is not found
+        city_hashtag = UKRAINIAN_CITIES.get(user_city, f"#{user_city.replace('_', ' ').title()}")
+        # Adding city hashtag to the message
+        yield user['chat_id'], f"{message_text}\n\n🏙️ {city_hashtag}", keyboard
 
-            # Adding city hashtag to the message
-            full_message = f"{message_text}\n\n🏙️ {city_hashtag}"
+def send_broadcast_by_city(message_text, target_cities=None, template_id=None, is_test=False, chat_id_for_test=None,
+                           name='broadcast', on_complete=None):
+    """
+    Queues a one-off (non-persisted) broadcast message to users, optionally filtered by city,
+    and includes a rating button if a template_id is provided.
+    If is_test is True, sends only to chat_id_for_test.
+    Returns the BroadcastJob immediately; on_complete(job) runs once delivery has finished.
+    """
+    # Add rating button if template_id is provided and not a test broadcast
+    keyboard = get_rating_keyboard(template_id) if template_id and not is_test else None
+    if is_test and chat_id_for_test:
+        users = [{'chat_id': chat_id_for_test, 'city': 'тестове'}] # Mock city for test
+    else:
+        users = iter_broadcast_recipients(target_cities)
 
-            # Add rating button if template_id is provided and not a test broadcast
-            keyboard = None
-            if template_id and not is_test:
-                keyboard = get_rating_keyboard(template_id)
+    return broadcast_engine.submit(BroadcastJob(name, on_complete), build_broadcast_messages(users, message_text, keyboard))
 
-            bot.send_message(chat_id, full_message, reply_markup=keyboard)
-            success_count += 1
+def expand_broadcast_job(job_row):
+    """
+    Turns a persisted broadcast job into pending broadcast_deliveries rows for the worker queue.
+    Recipients are inserted BROADCAST_EXPAND_BATCH at a time, each batch committed together with the
+    job's last_chat_id checkpoint, so an interrupted expansion resumes exactly where it stopped.
+    """
+    batch = []
+    try:
+        for user in iter_broadcast_recipients(parse_target_cities(job_row['target_cities']),
+                                              after_chat_id=job_row['last_chat_id']):
+            batch.append((user['chat_id'], user['city']))
+            if len(batch) >= BROADCAST_EXPAND_BATCH:
+                enqueue_broadcast_deliveries(job_row['id'], batch)
+                batch = []
+        enqueue_broadcast_deliveries(job_row['id'], batch, expanded=True)
+    except Exception as e:
+        logging.error(f"Помилка при формуванні черги розсилки '{job_row['name']}' (job {job_row['id']}): {e}")
+        return
 
+    # Workers may have drained the queue before it was marked complete (or there were no recipients)
+    for finished_job in complete_finished_broadcast_jobs([job_row['id']]):
+        try:
+            report_broadcast_job(finished_job)
         except Exception as e:
-            logging.error(f"Помилка відправки повідомлення {chat_id}: {e}")
+            logging.error(f"Не вдалося надіслати звіт про розсилку {finished_job['id']}: {e}")
+
+def start_broadcast_expansion(job_row):
+    """Expands a broadcast job in a background thread so the calling handler returns immediately."""
+    threading.Thread(target=expand_broadcast_job, args=(job_row,), name=f"broadcast-expand-{job_row['id']}",
+                     daemon=True).start()
+
+def resume_broadcast_jobs():
+    """Finishes queueing recipients of broadcast jobs whose expansion was cut short by a restart."""
+    for job_row in get_unexpanded_broadcast_jobs():
+        logging.info(f"Відновлюю розсилку '{job_row['name']}' (job {job_row['id']}) з chat_id > {job_row['last_chat_id']}")
+        start_broadcast_expansion(job_row)
+
+def build_broadcast_report_text(job_row):
+    """Final delivery summary of a completed broadcast job."""
+    elapsed = (job_row['finished_at'] - job_row['created_at']).total_seconds()
+    rate = job_row['sent_count'] / elapsed if elapsed > 0 else 0.0
+    return f"✅ Розсилку '{job_row['name']}' надіслано *{job_row['sent_count']}* користувачам.\n" \
+           f"Помилок: {job_row['failed_count']}, швидкість: {rate:.1f} повідомлень/с"
+
+def report_broadcast_job(job_row):
+    """Sends the final delivery summary of a broadcast job to the admin who started it."""
+    if not job_row['requested_by']:
+        return
+    bot.send_message(job_row['requested_by'], build_broadcast_report_text(job_row),
+                     parse_mode='Markdown', reply_markup=get_admin_broadcast_menu())
 
-    return success_count
+def run_broadcast_worker(stop_event=None):
+    """
+    Delivery loop shared by the `worker` process type and the optional in-process worker.
+    Claims BROADCAST_CLAIM_BATCH pending deliveries with FOR UPDATE SKIP LOCKED, so any number of
+    workers can drain the same queue, sends them through the local rate-limited engine and
+    completes jobs once their queue is empty.
+    """
+    job_cache = {}
+    while not (stop_event and stop_event.is_set()):
+        try:
+            claimed = claim_broadcast_deliveries(BROADCAST_CLAIM_BATCH, BROADCAST_CLAIM_TIMEOUT)
+        except Exception as e:
+            logging.error(f"Помилка при отриманні доставок з черги: {e}")
+            claimed = []
+        if not claimed:
+            time.sleep(BROADCAST_POLL_INTERVAL)
+            continue
+
+        deliveries_by_job = collections.defaultdict(list)
+        for delivery in claimed:
+            deliveries_by_job[delivery['job_id']].append(delivery)
+
+        finished_batches = []
+        for job_id, deliveries in deliveries_by_job.items():
+            job_row = job_cache.get(job_id) or get_broadcast_job(job_id)
+            if not job_row:
+                continue
+            job_cache[job_id] = job_row
+            keyboard = get_rating_keyboard(job_row['template_id']) if job_row['template_id'] else None
+            done = threading.Event()
+            broadcast_engine.submit(DeliveryBatch(job_id, job_row['name'], on_complete=lambda batch, done=done: done.set()),
+                                    build_broadcast_messages(deliveries, job_row['message'], keyboard))
+            finished_batches.append(done)
+        for done in finished_batches:
+            done.wait()
+
+        for job_row in complete_finished_broadcast_jobs(list(deliveries_by_job)):
+            job_cache.pop(job_row['id'], None)
+            logging.info(f"Розсилка '{job_row['name']}' (job {job_row['id']}) завершена: "
+                         f"надіслано {job_row['sent_count']}, помилок {job_row['failed_count']}")
+            try:
+                report_broadcast_job(job_row)
+            except Exception as e:
+                logging.error(f"Не вдалося надіслати звіт про розсилку {job_row['id']}: {e}")
 
 # ============ HELPER FUNCTIONS ============
 
-def get_user_city(chat_id):
-    """Retrieves the city associated with a user's chat ID."""
+# Per-process cache of chat_id -> {'city', 'notifications', 'is_active'}; an empty dict marks an unregistered user
+PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '300'))
+PROFILE_CACHE_MAX_ENTRIES = int(os.getenv('PROFILE_CACHE_MAX_ENTRIES', '50000'))
+user_profiles = TTLCache(PROFILE_CACHE_MAX_ENTRIES, PROFILE_CACHE_TTL)
+
+def get_user_profile(chat_id):
+    """Returns the user's city/notifications/is_active (empty dict if not registered), reading Postgres only on a cache miss."""
+    profile = user_profiles.get(chat_id)
+    if profile is not None:
+        return profile
+
     conn = get_db_connection()
-    result = None
     try:
         with conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT city FROM users WHERE chat_id = %s;", (chat_id,))
+                cur.execute("SELECT city, notifications, is_active FROM users WHERE chat_id = %s;", (chat_id,))
                 result = cur.fetchone()
+                profile = dict(result) if result else {}
     except Exception as e:
-        logging.error(f"Error fetching user city for {chat_id}: {e}")
+        logging.error(f"Error fetching user profile for {chat_id}: {e}")
+        return {} # Do not cache failures
     finally:
         if conn:
             conn.close()
-    return result['city'] if result and result['city'] else 'київ' # Default to 'київ' if city is None
+    user_profiles.set(chat_id, profile)
+    return profile
+
+def get_user_city(chat_id):
+    """Retrieves the city associated with a user's chat ID."""
+    profile = get_user_profile(chat_id)
+    return profile.get('city') or 'київ' # Default to 'київ' if city is None
 
 def get_user_notifications_status(chat_id):
     """Retrieves the notification status for a user."""
+    profile = get_user_profile(chat_id)
+    return profile['notifications'] if profile else True # Default to enabled if not found
+
+def update_user_notifications_status(chat_id, status):
+    """Updates the notification status for a user."""
     conn = get_db_connection()
-    status = True # Default to enabled if not found
     try:
         with conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT notifications FROM users WHERE chat_id = %s;", (chat_id,))
+                cur.execute("""
+                    UPDATE users SET notifications = %s WHERE chat_id = %s
+                    RETURNING city, notifications, is_active;
+                """, (status, chat_id))
                 result = cur.fetchone()
                 if result:
-                    status = result['notifications']
+                    user_profiles.set(chat_id, dict(result)) # Write-through
+                    audience_index.apply(chat_id, dict(result))
     except Exception as e:
-        logging.error(f"Error fetching user notification status for {chat_id}: {e}")
+        logging.error(f"Error updating user notification status for {chat_id}: {e}")
+        user_profiles.delete(chat_id)
     finally:
         if conn:
             conn.close()
-    return status
 
-def update_user_notifications_status(chat_id, status):
-    """Updates the notification status for a user."""
+def heartbeat_outbound_sender(sender_id, expire_after):
+    """Records a heartbeat for sender_id, forgets senders silent for expire_after seconds and returns how many are live."""
     conn = get_db_connection()
     try:
         with conn:
             with conn.cursor() as cur:
                 cur.execute("""
-                    UPDATE users SET notifications = %s WHERE chat_id = %s;
-                """, (status, chat_id))
-    except Exception as e:
-        logging.error(f"Error updating user notification status for {chat_id}: {e}")
+                    INSERT INTO outbound_senders (sender_id, heartbeat_at) VALUES (%s, now())
+                    ON CONFLICT (sender_id) DO UPDATE SET heartbeat_at = EXCLUDED.heartbeat_at;
+                """, (sender_id,))
+                cur.execute("DELETE FROM outbound_senders WHERE heartbeat_at < now() - make_interval(secs => %s);",
+                            (expire_after,))
+                cur.execute("SELECT COUNT(*) AS senders FROM outbound_senders;")
+                return cur.fetchone()['senders']
+    finally:
+        conn.close()
+
+def remove_outbound_sender(sender_id):
+    conn = get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM outbound_senders WHERE sender_id = %s;", (sender_id,))
+    finally:
+        conn.close()
+
+def deactivate_users(chat_ids):
+    """Marks users the bot can no longer reach as inactive; returns how many were still active."""
+    conn = get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE users SET is_active = FALSE
+                    WHERE chat_id = ANY(%s) AND is_active = TRUE
+                    RETURNING chat_id, city, notifications, is_active;
+                """, (chat_ids,))
+                rows = cur.fetchall()
     finally:
         if conn:
             conn.close()
+    for row in rows:
+        chat_id = row.pop('chat_id')
+        user_profiles.set(chat_id, dict(row)) # Write-through
+        audience_index.apply(chat_id, dict(row))
+    return len(rows)
 
 def get_channels_by_user(chat_id):
     """Retrieves active channels added by a specific user."""
@@ -1049,7 +3332,9 @@ def delete_broadcast_template_db(template_id):
                 # Delete associated ratings first due to foreign key constraint
                 cur.execute("DELETE FROM broadcast_ratings WHERE template_id = %s;", (template_id,))
                 cur.execute("DELETE FROM broadcast_templates WHERE id = %s;", (template_id,))
-                return cur.rowcount > 0
+                deleted = cur.rowcount > 0
+        rating_templates.delete(template_id)
+        return deleted
     except Exception as e:
         logging.error(f"Error deleting broadcast template {template_id}: {e}")
         return False
@@ -1057,6 +3342,244 @@ def delete_broadcast_template_db(template_id):
         if conn:
             conn.close()
 
+def create_broadcast_job(template, requested_by):
+    """Persists a new broadcast job for a template and returns its row, or None on failure."""
+    conn = get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO broadcast_jobs (template_id, name, message, target_cities, requested_by)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id, template_id, name, message, target_cities, requested_by, last_chat_id;
+                """, (template['id'], template['name'], template['message'], template['target_cities'], requested_by))
+                return cur.fetchone()
+    except Exception as e:
+        logging.error(f"Error creating broadcast job for template {template['id']}: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def enqueue_broadcast_deliveries(job_id, recipients, expanded=False):
+    """
+    Inserts pending deliveries for (chat_id, city) recipients and advances the job's keyset
+    checkpoint in the same transaction; expanded=True marks the recipient list as complete.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                inserted = 0
+                if recipients:
+                    rows = execute_values(cur, """
+                        INSERT INTO broadcast_deliveries (job_id, chat_id, city)
+                        VALUES %s
+                        ON CONFLICT (job_id, chat_id) DO NOTHING
+                        RETURNING chat_id;
+                    """, [(job_id, chat_id, city) for chat_id, city in recipients], fetch=True)
+                    inserted = len(rows)
+                cur.execute("""
+                    UPDATE broadcast_jobs
+                    SET last_chat_id = GREATEST(last_chat_id, %s),
+                        total_recipients = total_recipients + %s,
+                        expanded = expanded OR %s,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = %s;
+                """, (recipients[-1][0] if recipients else None, inserted, expanded, job_id))
+    finally:
+        if conn:
+            conn.close()
+
+def get_unexpanded_broadcast_jobs():
+    """Retrieves running broadcast jobs whose recipients have not all been queued yet."""
+    conn = get_db_connection()
+    jobs = []
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, template_id, name, message, target_cities, requested_by, last_chat_id
+                    FROM broadcast_jobs WHERE status = 'running' AND expanded = FALSE ORDER BY id;
+                """)
+                jobs = cur.fetchall()
+    except Exception as e:
+        logging.error(f"Error fetching unexpanded broadcast jobs: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return jobs
+
+def get_broadcast_job(job_id):
+    """Retrieves a single broadcast job by ID."""
+    conn = get_db_connection()
+    job = None
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT id, template_id, name, message, requested_by FROM broadcast_jobs WHERE id = %s;", (job_id,))
+                job = cur.fetchone()
+    except Exception as e:
+        logging.error(f"Error fetching broadcast job {job_id}: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return job
+
+def claim_broadcast_deliveries(limit, stale_after):
+    """
+    Atomically claims up to `limit` pending deliveries (or ones whose claim is older than
+    `stale_after` seconds) for this worker. SKIP LOCKED lets concurrent workers claim disjoint batches.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH claimable AS (
+                        SELECT job_id, chat_id FROM broadcast_deliveries
+                        -- The IN list mirrors broadcast_deliveries_queue_idx so the planner can use it
+                        WHERE status IN ('pending', 'sending')
+                          AND (status = 'pending' OR claimed_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                        ORDER BY job_id, chat_id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE broadcast_deliveries d
+                    SET status = 'sending', claimed_at = CURRENT_TIMESTAMP, attempts = d.attempts + 1
+                    FROM claimable
+                    WHERE d.job_id = claimable.job_id AND d.chat_id = claimable.chat_id
+                    RETURNING d.job_id, d.chat_id, d.city;
+                """, (stale_after, limit))
+                return cur.fetchall()
+    finally:
+        if conn:
+            conn.close()
+
+# Bumps one of broadcast_jobs' outcome counters ({counter} is 'sent_count' or 'failed_count')
+BROADCAST_JOB_COUNTER_SQL = """
+    UPDATE broadcast_jobs SET {counter} = {counter} + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE id = %s;
+"""
+
+def record_broadcast_delivery(job_id, chat_id, status, error_message=None):
+    """Stores the outcome of a claimed delivery and bumps the job's counters in one transaction."""
+    conn = get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE broadcast_deliveries
+                    SET status = %s, error_message = %s, attempted_at = CURRENT_TIMESTAMP
+                    WHERE job_id = %s AND chat_id = %s AND status = 'sending';
+                """, (status, error_message, job_id, chat_id))
+                # Only count the first outcome if a stale claim was retaken by another worker
+                if cur.rowcount:
+                    counter = 'sent_count' if status == 'sent' else 'failed_count'
+                    cur.execute(BROADCAST_JOB_COUNTER_SQL.format(counter=counter), (job_id,))
+    except Exception as e:
+        logging.error(f"Error recording delivery of job {job_id} to {chat_id}: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+def complete_finished_broadcast_jobs(job_ids):
+    """Marks fully expanded jobs with no pending or in-flight deliveries as completed and returns them."""
+    conn = get_db_connection()
+    jobs = []
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE broadcast_jobs j
+                    SET status = 'completed', finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                    WHERE j.id = ANY(%s) AND j.status = 'running' AND j.expanded = TRUE
+                    AND NOT EXISTS (
+                        SELECT 1 FROM broadcast_deliveries d
+                        WHERE d.job_id = j.id AND d.status IN ('pending', 'sending')
+                    )
+                    RETURNING j.id, j.name, j.requested_by, j.sent_count, j.failed_count, j.created_at, j.finished_at;
+                """, (job_ids,))
+                jobs = cur.fetchall()
+    except Exception as e:
+        logging.error(f"Error completing broadcast jobs {job_ids}: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return jobs
+
+def get_recent_broadcast_jobs(limit=10):
+    """Retrieves the most recent broadcast jobs with their progress."""
+    conn = get_db_connection()
+    jobs = []
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, name, status, expanded, total_recipients, sent_count, failed_count, created_at, finished_at
+                    FROM broadcast_jobs ORDER BY id DESC LIMIT %s;
+                """, (limit,))
+                jobs = cur.fetchall()
+    except Exception as e:
+        logging.error(f"Error fetching recent broadcast jobs: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return jobs
+
+def get_city_stats():
+    """Retrieves the per-city rollup rows."""
+    conn = get_db_connection()
+    rows = []
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT city, user_count, active_user_count, channel_count, group_count FROM city_stats;")
+                rows = cur.fetchall()
+    except Exception as e:
+        logging.error(f"Error fetching city stats: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return rows
+
+def get_total_stats():
+    """Sums the city_stats rows into bot-wide totals (one row per city, so this stays cheap)."""
+    conn = get_db_connection()
+    totals = None
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT COALESCE(SUM(user_count), 0) AS user_count,
+                           COALESCE(SUM(active_user_count), 0) AS active_user_count,
+                           COALESCE(SUM(channel_count), 0) AS channel_count,
+                           COALESCE(SUM(group_count), 0) AS group_count
+                    FROM city_stats;
+                """)
+                totals = cur.fetchone()
+    except Exception as e:
+        logging.error(f"Error fetching total stats: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return totals
+
+def rebuild_city_stats():
+    """Recomputes the city_stats rollup from the source tables to repair any drift."""
+    conn = get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                rebuild_city_stats_rows(cur)
+        return True
+    except Exception as e:
+        logging.error(f"Error rebuilding city stats: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
 def send_invite_link(chat_id):
     """Sends instructions on how to get an invite link to the user."""
     # To get an invite link for a private channel (CHANNEL_ID),
@@ -1073,85 +3596,7 @@ def send_invite_link(chat_id):
 
 # ============ ADMIN FUNCTIONS ============
 
-def handle_admin_actions(call):
-    """Routes admin actions based on callback data."""
-    chat_id = call.message.chat.id
-
-    # Check if the user is an authorized admin
-    if chat_id not in ALLOWED_ADMINS:
-        bot.send_message(chat_id, "❌ У вас немає прав доступу до цієї функції.")
-        return
-
-    action = call.data.replace("admin_", "")
-
-    if action == "broadcast":
-        handle_admin_broadcast_menu(call)
-    elif action == "broadcast_create_start":
-        admin_create_broadcast_start(call)
-    elif action == "broadcast_list":
-        admin_list_broadcasts(call)
-    elif action == "broadcast_send_select":
-        admin_send_broadcast_select_template(call)
-    elif action.startswith("broadcast_send_"):
-        template_id = int(action.split('_')[2])
-        admin_confirm_send_broadcast(call, template_id)
-    elif action == "broadcast_edit_select":
-        admin_edit_broadcast_select_template(call)
-    elif action.startswith("broadcast_edit_"):
-        template_id = int(action.split('_')[2])
-        admin_edit_broadcast_start(call, template_id)
-    elif action == "broadcast_delete_select":
-        admin_delete_broadcast_select_template(call)
-    elif action.startswith("broadcast_delete_confirm_"):
-        template_id = int(action.split('_')[3])
-        admin_delete_broadcast(call, template_id)
-    elif action.startswith("broadcast_test_"):
-        template_id = int(action.split('_')[2])
-        admin_send_test_broadcast(call, template_id)
-    elif action == "users":
-        show_users_stats_by_city(call)
-    elif action == "channels":
-        show_channels_stats(call)
-    elif action == "ratings":
-        show_ratings_stats(call)
-    elif action == "cities":
-        show_city_hashtags(call)
-    # NEW Admin Bot Activity actions
-    elif action == "bot_activity":
-        handle_admin_bot_activity_menu(call)
-    elif action == "add_bot_target_location_start":
-        admin_add_bot_target_location_start(call)
-    elif action == "list_bot_target_locations":
-        admin_list_bot_target_locations(call)
-    elif action.startswith("edit_bot_target_location_"):
-        location_id = int(action.split('_')[4])
-        admin_edit_bot_target_location_start(call, location_id)
-    elif action.startswith("delete_bot_target_location_confirm_"):
-        location_id = int(action.split('_')[4])
-        admin_delete_bot_target_location(call, location_id)
-    elif action == "create_comment_template_start":
-        admin_create_comment_template_start(call)
-    elif action == "list_comment_templates":
-        admin_list_comment_templates(call)
-    elif action.startswith("edit_comment_template_"):
-        template_id = int(action.split('_')[3])
-        admin_edit_comment_template_start(call, template_id)
-    elif action.startswith("delete_comment_template_confirm_"):
-        template_id = int(action.split('_')[3])
-        admin_delete_comment_template(call, template_id)
-    elif action == "run_bot_activity_start":
-        admin_run_bot_activity_select_target(call)
-    elif action.startswith("run_bot_activity_execute_"):
-        location_id = int(action.split('_')[4])
-        template_id = int(action.split('_')[5])
-        admin_execute_bot_activity(call, location_id, template_id)
-    elif action == "bot_activity_stats":
-        show_bot_activity_stats(call)
-    elif action == "settings":
-        bot.send_message(chat_id, "Налаштування адмін-панелі ще не реалізовані.")
-    elif action == "menu":
-        bot.edit_message_text("🔧 Панель адміністратора", chat_id, call.message.message_id, reply_markup=get_admin_menu())
-
+@callback_route("admin_broadcast", admin=True)
 def handle_admin_broadcast_menu(call):
     """Admin menu for broadcast management."""
     bot.edit_message_text(
@@ -1160,16 +3605,18 @@ def handle_admin_broadcast_menu(call):
         reply_markup=get_admin_broadcast_menu()
     )
 
+@callback_route("admin_broadcast_create_start", admin=True)
 def admin_create_broadcast_start(call):
     """Starts the process of creating a new broadcast template."""
     chat_id = call.message.chat.id
-    user_states[chat_id] = {'waiting_for': 'admin_broadcast_create_name'}
+    user_states.set(chat_id, {'waiting_for': 'admin_broadcast_create_name'})
     bot.edit_message_text(
         "➕ Створення нової розсилки.\n\n"
         "Введіть унікальну *назву* для розсилки (для внутрішнього використання, наприклад, 'Акція_Весна_2025'):",
         chat_id, call.message.message_id, parse_mode='Markdown'
     )
 
+@callback_route("admin_broadcast_list", admin=True)
 def admin_list_broadcasts(call):
     """Displays a list of all broadcast templates."""
     chat_id = call.message.chat.id
@@ -1193,10 +3640,9 @@ def admin_list_broadcasts(call):
     bot.edit_message_text(message_text, chat_id, call.message.message_id,
                           reply_markup=keyboard, parse_mode='Markdown')
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("admin_broadcast_manage_"))
-def admin_manage_broadcast_details(call):
+@callback_route("admin_broadcast_manage_{template_id:int}", admin=True)
+def admin_manage_broadcast_details(call, template_id):
     """Shows options to edit/delete a specific broadcast from the list."""
-    template_id = int(call.data.replace("admin_broadcast_manage_", ""))
     template = get_broadcast_template(template_id)
     if not template:
         bot.send_message(call.message.chat.id, "Розсилку не знайдено.")
@@ -1223,6 +3669,7 @@ def admin_manage_broadcast_details(call):
                           reply_markup=keyboard, parse_mode='Markdown')
 
 
+@callback_route("admin_broadcast_send_select", admin=True)
 def admin_send_broadcast_select_template(call):
     """Lists templates for sending a broadcast."""
     chat_id = call.message.chat.id
@@ -1238,6 +3685,7 @@ def admin_send_broadcast_select_template(call):
     keyboard.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_broadcast"))
     bot.edit_message_text(message_text, chat_id, call.message.message_id, reply_markup=keyboard)
 
+@callback_route("admin_broadcast_send_{template_id:int}", admin=True)
 def admin_confirm_send_broadcast(call, template_id):
     """Confirms sending a broadcast."""
     chat_id = call.message.chat.id
@@ -1247,11 +3695,17 @@ def admin_confirm_send_broadcast(call, template_id):
         admin_send_broadcast_select_template(call)
         return
 
+    try:
+        recipients = audience_index.count(parse_target_cities(template['target_cities']))
+    except Exception as e:
+        logging.error(f"Не вдалося порахувати отримувачів розсилки {template_id}: {e}")
+        recipients = '?'
     message_text = f"Ви збираєтеся надіслати розсилку:\n\n" \
                    f"Назва: *{template['name']}*\n" \
                    f"Заголовок: _{template['title']}_\n" \
                    f"Повідомлення:\n_{template['message'][:100]}..._\n" \
-                   f"Цільові міста: {template['target_cities'] if template['target_cities'] else 'Всі'}\n\n" \
+                   f"Цільові міста: {template['target_cities'] if template['target_cities'] else 'Всі'}\n" \
+                   f"Отримувачів: *{recipients}*\n\n" \
                    "Ви впевнені?"
 
     keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -1261,11 +3715,10 @@ def admin_confirm_send_broadcast(call, template_id):
     )
     bot.edit_message_text(message_text, chat_id, call.message.message_id, reply_markup=keyboard, parse_mode='Markdown')
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("admin_broadcast_execute_send_"))
-def admin_execute_send_broadcast(call):
+@callback_route("admin_broadcast_execute_send_{template_id:int}", admin=True)
+def admin_execute_send_broadcast(call, template_id):
     """Executes sending of the broadcast."""
     chat_id = call.message.chat.id
-    template_id = int(call.data.replace("admin_broadcast_execute_send_", ""))
     template = get_broadcast_template(template_id)
 
     if not template:
@@ -1273,19 +3726,44 @@ def admin_execute_send_broadcast(call):
         admin_send_broadcast_select_template(call)
         return
 
-    bot.edit_message_text(f"✉️ Починаю надсилання розсилки '{template['name']}'...", chat_id, call.message.message_id)
+    job_row = create_broadcast_job(template, chat_id)
+    if not job_row:
+        bot.edit_message_text(f"❌ Не вдалося створити розсилку '{template['name']}'.", chat_id, call.message.message_id,
+                              reply_markup=get_admin_broadcast_menu())
+        return
 
-    target_cities = template['target_cities']
-    if target_cities:
-        # Convert comma-separated string to a list of cities
-        target_cities_list = [city.strip().lower() for city in target_cities.split(',') if city.strip()]
-    else:
-        target_cities_list = None # Send to all if no cities specified
+    bot.edit_message_text(f"✉️ Починаю надсилання розсилки '{template['name']}'...\n"
+                          "Прогрес можна переглянути в меню розсилок (📊 Статус розсилок).",
+                          chat_id, call.message.message_id)
+
+    # Recipients are queued in the background and delivered by the broadcast workers
+    start_broadcast_expansion(job_row)
 
-    sent_count = send_broadcast_by_city(template['message'], target_cities=target_cities_list, template_id=template['id'])
-    bot.send_message(chat_id, f"✅ Розсилку '{template['name']}' надіслано *{sent_count}* користувачам.", parse_mode='Markdown', reply_markup=get_admin_broadcast_menu())
 
+@callback_route("admin_broadcast_jobs", admin=True)
+def show_broadcast_jobs(call):
+    """Displays progress of the most recent broadcast jobs."""
+    jobs = get_recent_broadcast_jobs()
+    status_labels = {'running': '⏳ Триває', 'completed': '✅ Завершено'}
 
+    message_text = "📊 Статус розсилок:\n\n"
+    if not jobs:
+        message_text += "Розсилок ще не було."
+    for job_row in jobs:
+        total = f"{job_row['total_recipients']}" if job_row['expanded'] else f"{job_row['total_recipients']}+"
+        message_text += f"#{job_row['id']} {job_row['name']} — {status_labels.get(job_row['status'], job_row['status'])}\n" \
+                        f"    Надіслано: {job_row['sent_count']} з {total}, помилок: {job_row['failed_count']}\n" \
+                        f"    Створено: {job_row['created_at']:%Y-%m-%d %H:%M}\n\n"
+
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        types.InlineKeyboardButton("🔄 Оновити", callback_data="admin_broadcast_jobs"),
+        types.InlineKeyboardButton("🔙 Назад", callback_data="admin_broadcast")
+    )
+    bot.edit_message_text(message_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard)
+
+
+@callback_route("admin_broadcast_test_{template_id:int}", admin=True)
 def admin_send_test_broadcast(call, template_id):
     """Sends a test broadcast to the admin."""
     chat_id = call.message.chat.id
@@ -1296,15 +3774,18 @@ def admin_send_test_broadcast(call, template_id):
         return
 
     bot.send_message(chat_id, "🧪 Надсилаю тестову розсилку...")
-    sent_count = send_broadcast_by_city(
+    send_broadcast_by_city(
         f"TEST: {template['message']}",
         is_test=True,
         chat_id_for_test=chat_id,
-        template_id=template['id'] # Still include template_id for rating test
+        template_id=template['id'], # Still include template_id for rating test
+        name=f"test-{template['id']}",
+        on_complete=lambda job: bot.send_message(chat_id, f"Тестова розсилка надіслана. Кількість: {job.sent_count}",
+                                                 reply_markup=get_admin_broadcast_menu())
     )
-    bot.send_message(chat_id, f"Тестова розсилка надіслана. Кількість: {sent_count}", reply_markup=get_admin_broadcast_menu())
 
 
+@callback_route("admin_broadcast_edit_select", admin=True)
 def admin_edit_broadcast_select_template(call):
     """Lists templates for editing."""
     chat_id = call.message.chat.id
@@ -1321,6 +3802,7 @@ def admin_edit_broadcast_select_template(call):
     bot.edit_message_text(message_text, chat_id, call.message.message_id, reply_markup=keyboard)
 
 
+@callback_route("admin_broadcast_edit_{template_id:int}", admin=True)
 def admin_edit_broadcast_start(call, template_id):
     """Starts the process of editing an existing broadcast template."""
     chat_id = call.message.chat.id
@@ -1330,11 +3812,11 @@ def admin_edit_broadcast_start(call, template_id):
         admin_edit_broadcast_select_template(call)
         return
 
-    user_states[chat_id] = {
+    user_states.set(chat_id, {
         'waiting_for': 'admin_broadcast_edit_name',
         'template_id': template_id,
         'original_data': template.copy() # Store original data for step-by-step update
-    }
+    })
     bot.edit_message_text(
         f"✏️ Редагування розсилки *{template['name']}* (ID: `{template_id}`).\n\n"
         f"Введіть нову *назву* (поточна: '{template['name']}'):",
@@ -1342,6 +3824,7 @@ def admin_edit_broadcast_start(call, template_id):
     )
 
 
+@callback_route("admin_broadcast_delete_select", admin=True)
 def admin_delete_broadcast_select_template(call):
     """Lists templates for deletion."""
     chat_id = call.message.chat.id
@@ -1358,6 +3841,8 @@ def admin_delete_broadcast_select_template(call):
     bot.edit_message_text(message_text, chat_id, call.message.message_id, reply_markup=keyboard)
 
 
+@callback_route("admin_broadcast_delete_confirm_{template_id:int}", admin=True)
+@callback_route("admin_broadcast_delete_{template_id:int}", admin=True)
 def admin_delete_broadcast(call, template_id):
     """Deletes a broadcast template after confirmation."""
     chat_id = call.message.chat.id
@@ -1374,15 +3859,13 @@ def admin_delete_broadcast(call, template_id):
         bot.edit_message_text(f"❌ Помилка при видаленні розсилки '{template['name']}' (ID: `{template_id}`).", chat_id, call.message.message_id, parse_mode='Markdown', reply_markup=get_admin_broadcast_menu())
 
 
-def handle_admin_broadcast_input(message, user_input, input_type):
+def handle_admin_broadcast_input(message, user_input, input_type, state):
     """Handles multi-step input for admin broadcast creation/editing."""
     chat_id = message.chat.id
-    state = user_states.get(chat_id)
 
     if not state or not input_type.startswith('admin_broadcast_'):
         bot.send_message(chat_id, "Неочікуване введення. Будь ласка, почніть знову з адмін-панелі.", reply_markup=get_admin_menu())
-        if chat_id in user_states:
-            del user_states[chat_id]
+        user_states.delete(chat_id)
         return
 
     action_type = state['waiting_for']
@@ -1392,8 +3875,9 @@ def handle_admin_broadcast_input(message, user_input, input_type):
 
     if action_type == 'admin_broadcast_create_name' or action_type == 'admin_broadcast_edit_name':
         current_data['name'] = user_input
-        user_states[chat_id]['waiting_for'] = 'admin_broadcast_create_title' if template_id is None else 'admin_broadcast_edit_title'
-        user_states[chat_id]['current_data'] = current_data
+        state['waiting_for'] = 'admin_broadcast_create_title' if template_id is None else 'admin_broadcast_edit_title'
+        state['current_data'] = current_data
+        user_states.set(chat_id, state)
         bot.send_message(
             chat_id,
             f"Введіть *заголовок* розсилки (поточний: '{original_data.get('title', '') if template_id else ''}'):",
@@ -1401,8 +3885,9 @@ def handle_admin_broadcast_input(message, user_input, input_type):
         )
     elif action_type == 'admin_broadcast_create_title' or action_type == 'admin_broadcast_edit_title':
         current_data['title'] = user_input
-        user_states[chat_id]['waiting_for'] = 'admin_broadcast_create_message' if template_id is None else 'admin_broadcast_edit_message'
-        user_states[chat_id]['current_data'] = current_data
+        state['waiting_for'] = 'admin_broadcast_create_message' if template_id is None else 'admin_broadcast_edit_message'
+        state['current_data'] = current_data
+        user_states.set(chat_id, state)
         bot.send_message(
             chat_id,
             f"Введіть *текст повідомлення* розсилки (поточний: '{original_data.get('message', '') if template_id else ''}'):",
@@ -1410,8 +3895,9 @@ def handle_admin_broadcast_input(message, user_input, input_type):
         )
     elif action_type == 'admin_broadcast_create_message' or action_type == 'admin_broadcast_edit_message':
         current_data['message'] = user_input
-        user_states[chat_id]['waiting_for'] = 'admin_broadcast_create_cities' if template_id is None else 'admin_broadcast_edit_cities'
-        user_states[chat_id]['current_data'] = current_data
+        state['waiting_for'] = 'admin_broadcast_create_cities' if template_id is None else 'admin_broadcast_edit_cities'
+        state['current_data'] = current_data
+        user_states.set(chat_id, state)
         bot.send_message(
             chat_id,
             f"Введіть *цільові міста* через кому (наприклад, 'київ, харків', або залиште порожнім для всіх міст). Поточні: '{original_data.get('target_cities', '') if template_id else ''}':",
@@ -1437,36 +3923,17 @@ def handle_admin_broadcast_input(message, user_input, input_type):
             else:
                 bot.send_message(chat_id, "❌ Помилка при оновленні розсилки.", reply_markup=get_admin_broadcast_menu())
 
-        if chat_id in user_states:
-            del user_states[chat_id]
+        user_states.delete(chat_id)
     else:
         bot.send_message(chat_id, "Неочікуваний стан введення для адмін-розсилки.", reply_markup=get_admin_broadcast_menu())
-        if chat_id in user_states:
-            del user_states[chat_id]
+        user_states.delete(chat_id)
 
 
+@callback_route("admin_users", admin=True)
 def show_users_stats_by_city(call):
     """Displays user statistics categorized by city."""
-    conn = get_db_connection()
-    city_stats = []
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT
-                        city,
-                        COUNT(*) as user_count
-                    FROM users
-                    WHERE is_active = TRUE
-                    GROUP BY city
-                    ORDER BY user_count DESC;
-                """)
-                city_stats = cur.fetchall()
-    except Exception as e:
-        logging.error(f"Error fetching user stats by city: {e}")
-    finally:
-        if conn:
-            conn.close()
+    city_stats = [stat for stat in get_city_stats() if stat['active_user_count'] > 0]
+    city_stats.sort(key=lambda stat: stat['active_user_count'], reverse=True)
 
     stats_text = "👥 Статистика користувачів по містах:\n\n"
     total_users = 0
@@ -1474,7 +3941,7 @@ def show_users_stats_by_city(call):
     for stat in city_stats:
         city_name = stat['city'].replace('_', ' ').title() if stat['city'] else 'Не вказано'
         city_hashtag = UKRAINIAN_CITIES.get(stat['city'], '')
-        user_count = stat['user_count']
+        user_count = stat['active_user_count']
         total_users += user_count
 
         stats_text += f"🏙️ {city_name} {city_hashtag}: {user_count} користувачів\n"
@@ -1490,43 +3957,14 @@ def show_users_stats_by_city(call):
         reply_markup=keyboard
     )
 
+@callback_route("admin_channels", admin=True)
 def show_channels_stats(call):
     """Displays statistics about added channels and groups."""
-    conn = get_db_connection()
-    channel_counts = None
-    group_counts = None
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                # Get channel counts by city
-                cur.execute("""
-                    SELECT
-                        city,
-                        COUNT(*) as count
-                    FROM target_channels
-                    WHERE is_active = TRUE
-                    GROUP BY city
-                    ORDER BY count DESC;
-                """)
-                channel_counts = cur.fetchall()
-
-                # Get group counts by city
-                cur.execute("""
-                    SELECT
-                        city,
-                        COUNT(*) as count
-                    FROM target_groups
-                    WHERE is_active = TRUE
-                    GROUP BY city
-                    ORDER BY count DESC;
-                """)
-                group_counts = cur.fetchall()
-
-    except Exception as e:
-        logging.error(f"Error fetching channels/groups stats: {e}")
-    finally:
-        if conn:
-            conn.close()
+    city_stats = get_city_stats()
+    channel_counts = sorted(({'city': stat['city'], 'count': stat['channel_count']} for stat in city_stats if stat['channel_count'] > 0),
+                            key=lambda stat: stat['count'], reverse=True)
+    group_counts = sorted(({'city': stat['city'], 'count': stat['group_count']} for stat in city_stats if stat['group_count'] > 0),
+                          key=lambda stat: stat['count'], reverse=True)
 
     stats_text = "📊 Статистика каналів та груп:\n\n"
 
@@ -1562,6 +4000,7 @@ def show_channels_stats(call):
     )
 
 
+@callback_route("admin_ratings", admin=True)
 def show_ratings_stats(call):
     """Displays statistics of broadcast ratings."""
     conn = get_db_connection()
@@ -1569,15 +4008,15 @@ def show_ratings_stats(call):
     try:
         with conn:
             with conn.cursor() as cur:
+                # Aggregates are maintained by triggers on broadcast_ratings; this only reads one row per template
                 cur.execute("""
                     SELECT
                         bt.name,
-                        COUNT(br.rating) as total_ratings,
-                        AVG(br.rating) as avg_rating,
-                        COUNT(CASE WHEN br.rating >= 4 THEN 1 END) as positive_ratings
+                        rs.rating_count,
+                        rs.rating_sum::numeric / NULLIF(rs.rating_count, 0) as avg_rating,
+                        rs.stars_1, rs.stars_2, rs.stars_3, rs.stars_4, rs.stars_5
                     FROM broadcast_templates bt
-                    LEFT JOIN broadcast_ratings br ON bt.id = br.template_id
-                    GROUP BY bt.id, bt.name
+                    LEFT JOIN broadcast_rating_stats rs ON rs.template_id = bt.id
                     ORDER BY avg_rating DESC NULLS LAST;
                 """)
                 rating_stats = cur.fetchall()
@@ -1594,14 +4033,18 @@ def show_ratings_stats(call):
     else:
         for stat in rating_stats:
             name = stat['name']
-            total = stat['total_ratings'] or 0
+            total = stat['rating_count'] or 0
             avg_rating = round(stat['avg_rating'], 1) if stat['avg_rating'] is not None else "N/A"
-            positive = stat['positive_ratings'] or 0
+            positive = (stat['stars_4'] or 0) + (stat['stars_5'] or 0)
 
             stats_text += f"📝 {name}\n"
             stats_text += f"    📊 Оцінок: {total}\n"
             stats_text += f"    ⭐ Середній рейтинг: {avg_rating}/5\n"
-            stats_text += f"    👍 Позитивних: {positive}\n\n"
+            stats_text += f"    👍 Позитивних: {positive}\n"
+            if total:
+                distribution = " · ".join(f"{stars}⭐ {stat[f'stars_{stars}']}" for stars in range(5, 0, -1))
+                stats_text += f"    📈 Розподіл: {distribution}\n"
+            stats_text += "\n"
 
     keyboard = types.InlineKeyboardMarkup()
     keyboard.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_menu"))
@@ -1612,34 +4055,14 @@ def show_ratings_stats(call):
         reply_markup=keyboard
     )
 
+@callback_route("stats")
 def show_overall_stats(call):
     """Displays overall statistics, combining user and channel/group stats for now."""
-    conn = get_db_connection()
-    total_users = 0
-    total_active_users = 0
-    total_channels = 0
-    total_groups = 0
-
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM users;")
-                total_users = cur.fetchone()['count']
-
-                cur.execute("SELECT COUNT(*) FROM users WHERE is_active = TRUE;")
-                total_active_users = cur.fetchone()['count']
-
-                cur.execute("SELECT COUNT(*) FROM target_channels WHERE is_active = TRUE;")
-                total_channels = cur.fetchone()['count']
-
-                cur.execute("SELECT COUNT(*) FROM target_groups WHERE is_active = TRUE;")
-                total_groups = cur.fetchone()['count']
-
-    except Exception as e:
-        logging.error(f"Error fetching overall stats: {e}")
-    finally:
-        if conn:
-            conn.close()
+    totals = get_total_stats()
+    total_users = totals['user_count'] if totals else 0
+    total_active_users = totals['active_user_count'] if totals else 0
+    total_channels = totals['channel_count'] if totals else 0
+    total_groups = totals['group_count'] if totals else 0
 
     stats_text = "📊 Загальна статистика:\n\n" \
                  f"👥 Користувачі: {total_users} (активні: {total_active_users})\n" \
@@ -1652,6 +4075,7 @@ def show_overall_stats(call):
     bot.edit_message_text(stats_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard)
 
 
+@callback_route("admin_cities", admin=True)
 def show_city_hashtags(call):
     """Admin function to show city hashtags."""
     hashtags = sorted(UKRAINIAN_CITIES.items()) # Get sorted items from the dictionary
@@ -1675,6 +4099,7 @@ def show_city_hashtags(call):
 
 # ============ USER CHANNELS/GROUPS MANAGEMENT ============
 
+@callback_route("my_channels")
 def show_my_channels(call):
     """Displays channels added by the current user."""
     chat_id = call.message.chat.id
@@ -1697,10 +4122,10 @@ def show_my_channels(call):
     bot.edit_message_text(message_text, chat_id, call.message.message_id, reply_markup=keyboard, parse_mode='Markdown', disable_web_page_preview=True)
 
 
-def delete_user_channel(call):
+@callback_route("delete_channel_{channel_id:int}")
+def delete_user_channel(call, channel_id):
     """Deletes a channel added by the user."""
     chat_id = call.message.chat.id
-    channel_id = int(call.data.replace("delete_channel_", ""))
 
     success = delete_channel_by_id(channel_id, chat_id)
     if success:
@@ -1710,6 +4135,7 @@ def delete_user_channel(call):
     show_my_channels(call) # Refresh the list
 
 
+@callback_route("my_groups")
 def show_my_groups(call):
     """Displays groups added by the current user."""
     chat_id = call.message.chat.id
@@ -1732,10 +4158,10 @@ def show_my_groups(call):
     bot.edit_message_text(message_text, chat_id, call.message.message_id, reply_markup=keyboard, parse_mode='Markdown', disable_web_page_preview=True)
 
 
-def delete_user_group(call):
+@callback_route("delete_group_{group_id:int}")
+def delete_user_group(call, group_id):
     """Deletes a group added by the user."""
     chat_id = call.message.chat.id
-    group_id = int(call.data.replace("delete_group_", ""))
 
     success = delete_group_by_id(group_id, chat_id)
     if success:
@@ -1746,6 +4172,7 @@ def delete_user_group(call):
 
 # ============ USER SETTINGS ============
 
+@callback_route("settings")
 def user_settings(call):
     """Displays user settings menu."""
     chat_id = call.message.chat.id
@@ -1757,6 +4184,7 @@ def user_settings(call):
         reply_markup=get_user_settings_menu(notifications_enabled)
     )
 
+@callback_route("toggle_notifications")
 def toggle_notifications(call):
     """Toggles user's notification preference."""
     chat_id = call.message.chat.id
@@ -1773,6 +4201,7 @@ def toggle_notifications(call):
 
 # ============ NEW BOT ACTIVITY FUNCTIONS (ADMIN ONLY) ============
 
+@callback_route("admin_bot_activity", admin=True)
 def handle_admin_bot_activity_menu(call):
     """Admin menu for bot commenting/inviting activity."""
     bot.edit_message_text(
@@ -1783,16 +4212,18 @@ def handle_admin_bot_activity_menu(call):
 
 # --- Bot Target Locations ---
 
+@callback_route("admin_add_bot_target_location_start", admin=True)
 def admin_add_bot_target_location_start(call):
     """Starts adding a new bot target location."""
     chat_id = call.message.chat.id
-    user_states[chat_id] = {'waiting_for': 'admin_bot_target_location_name'}
+    user_states.set(chat_id, {'waiting_for': 'admin_bot_target_location_name'})
     bot.edit_message_text(
         "➕ Додавання нового цільового місця для бота.\n\n"
         "Введіть *назву* каналу/групи (для ідентифікації, наприклад, 'Група Київ Продаж'):",
         chat_id, call.message.message_id, parse_mode='Markdown'
     )
 
+@callback_route("admin_list_bot_target_locations", admin=True)
 def admin_list_bot_target_locations(call):
     """Displays a list of all bot target locations."""
     chat_id = call.message.chat.id
@@ -1815,6 +4246,7 @@ def admin_list_bot_target_locations(call):
     bot.edit_message_text(message_text, chat_id, call.message.message_id,
                           reply_markup=keyboard, parse_mode='Markdown', disable_web_page_preview=True)
 
+@callback_route("admin_edit_bot_target_location_{location_id:int}", admin=True)
 def admin_edit_bot_target_location_start(call, location_id):
     """Starts editing an existing bot target location."""
     chat_id = call.message.chat.id
@@ -1824,17 +4256,18 @@ def admin_edit_bot_target_location_start(call, location_id):
         admin_list_bot_target_locations(call)
         return
 
-    user_states[chat_id] = {
+    user_states.set(chat_id, {
         'waiting_for': 'admin_bot_target_location_edit_name',
         'location_id': location_id,
         'original_data': location.copy()
-    }
+    })
     bot.edit_message_text(
         f"✏️ Редагування цільового місця *{location['location_name']}* (ID: `{location_id}`).\n\n"
         f"Введіть нову *назву* (поточна: '{location['location_name']}'):",
         chat_id, call.message.message_id, parse_mode='Markdown'
     )
 
+@callback_route("admin_delete_bot_target_location_confirm_{location_id:int}", admin=True)
 def admin_delete_bot_target_location(call, location_id):
     """Deletes a bot target location after confirmation."""
     chat_id = call.message.chat.id
@@ -1852,16 +4285,18 @@ def admin_delete_bot_target_location(call, location_id):
 
 # --- Comment Templates ---
 
+@callback_route("admin_create_comment_template_start", admin=True)
 def admin_create_comment_template_start(call):
     """Starts creating a new bot comment template."""
     chat_id = call.message.chat.id
-    user_states[chat_id] = {'waiting_for': 'admin_comment_template_create_name'}
+    user_states.set(chat_id, {'waiting_for': 'admin_comment_template_create_name'})
     bot.edit_message_text(
         "➕ Створення нового повідомлення для коментування.\n\n"
         "Введіть унікальну *назву* для шаблону (для внутрішнього використання, наприклад, 'Запрошення_Канал1'):",
         chat_id, call.message.message_id, parse_mode='Markdown'
     )
 
+@callback_route("admin_list_comment_templates", admin=True)
 def admin_list_comment_templates(call):
     """Displays a list of all bot comment templates."""
     chat_id = call.message.chat.id
@@ -1883,6 +4318,7 @@ def admin_list_comment_templates(call):
     bot.edit_message_text(message_text, chat_id, call.message.message_id,
                           reply_markup=keyboard, parse_mode='Markdown', disable_web_page_preview=True)
 
+@callback_route("admin_edit_comment_template_{template_id:int}", admin=True)
 def admin_edit_comment_template_start(call, template_id):
     """Starts editing an existing bot comment template."""
     chat_id = call.message.chat.id
@@ -1892,17 +4328,18 @@ def admin_edit_comment_template_start(call, template_id):
         admin_list_comment_templates(call)
         return
 
-    user_states[chat_id] = {
+    user_states.set(chat_id, {
         'waiting_for': 'admin_comment_template_edit_name',
         'template_id': template_id,
         'original_data': template.copy()
-    }
+    })
     bot.edit_message_text(
         f"✏️ Редагування повідомлення *{template['name']}* (ID: `{template_id}`).\n\n"
         f"Введіть нову *назву* (поточна: '{template['name']}'):",
         chat_id, call.message.message_id, parse_mode='Markdown'
     )
 
+@callback_route("admin_delete_comment_template_confirm_{template_id:int}", admin=True)
 def admin_delete_comment_template(call, template_id):
     """Deletes a bot comment template after confirmation."""
     chat_id = call.message.chat.id
@@ -1921,6 +4358,7 @@ def admin_delete_comment_template(call, template_id):
 
 # --- Bot Activity Execution ---
 
+@callback_route("admin_run_bot_activity_start", admin=True)
 def admin_run_bot_activity_select_target(call):
     """Admin selects a target location and a message template to run bot activity."""
     chat_id = call.message.chat.id
@@ -1947,6 +4385,7 @@ def admin_run_bot_activity_select_target(call):
     bot.edit_message_text(message_text, chat_id, call.message.message_id, reply_markup=keyboard)
 
 
+@callback_route("admin_run_bot_activity_execute_{location_id:int}_{template_id:int}", admin=True)
 def admin_execute_bot_activity(call, location_id, template_id):
     """Executes the bot activity (commenting/inviting) in the selected location with the selected message."""
     chat_id = call.message.chat.id
@@ -1999,6 +4438,7 @@ def admin_execute_bot_activity(call, location_id, template_id):
         bot.send_message(chat_id, f"❌ Помилка при запуску активності у *{location['location_name']}*: {e}. Переконайтеся, що бот є адміністратором у цій групі/каналі та має необхідні дозволи.", parse_mode='Markdown', reply_markup=get_admin_bot_activity_menu())
     
 # --- Statistics ---
+@callback_route("admin_bot_activity_stats", admin=True)
 def show_bot_activity_stats(call):
     """Displays statistics related to bot's commenting/inviting activity."""
     conn = get_db_connection()
@@ -2065,15 +4505,13 @@ def show_bot_activity_stats(call):
     )
 
 
-def handle_admin_bot_activity_input(message, user_input, input_type):
+def handle_admin_bot_activity_input(message, user_input, input_type, state):
     """Handles multi-step input for admin bot activity creation/editing."""
     chat_id = message.chat.id
-    state = user_states.get(chat_id)
 
     if not state:
         bot.send_message(chat_id, "Неочікуване введення. Будь ласка, почніть знову з адмін-панелі.", reply_markup=get_admin_menu())
-        if chat_id in user_states:
-            del user_states[chat_id]
+        user_states.delete(chat_id)
         return
 
     # --- Bot Target Location Input ---
@@ -2081,6 +4519,7 @@ def handle_admin_bot_activity_input(message, user_input, input_type):
         state['current_data'] = state.get('current_data', {})
         state['current_data']['location_name'] = user_input
         state['waiting_for'] = 'admin_bot_target_location_id' if 'location_id' not in state else 'admin_bot_target_location_edit_id'
+        user_states.set(chat_id, state)
         
         prompt_text = "Введіть *ID чату* (каналу/групи). Це *числове ID*, яке можна отримати, наприклад, через @getidsbot. " \
                       "Для каналів це зазвичай від'ємне число (наприклад, -1001234567890).\n"
@@ -2093,6 +4532,7 @@ def handle_admin_bot_activity_input(message, user_input, input_type):
             location_id = int(user_input)
             state['current_data']['location_id'] = location_id
             state['waiting_for'] = 'admin_bot_target_location_type' if 'location_id' not in state else 'admin_bot_target_location_edit_type'
+            user_states.set(chat_id, state)
 
             prompt_text = "Введіть *тип місця* ('channel' для каналу або 'group' для групи):\n"
             if 'original_data' in state and state['original_data'].get('location_type'):
@@ -2108,6 +4548,7 @@ def handle_admin_bot_activity_input(message, user_input, input_type):
             return
         state['current_data']['location_type'] = location_type
         state['waiting_for'] = 'admin_bot_target_location_invite_link' if 'location_id' not in state else 'admin_bot_target_location_edit_invite_link'
+        user_states.set(chat_id, state)
 
         prompt_text = "Введіть *посилання-запрошення* (необов'язково, для груп/каналів). Залиште порожнім, якщо немає або не потрібно.\n"
         if 'original_data' in state and state['original_data'].get('invite_link'):
@@ -2137,13 +4578,14 @@ def handle_admin_bot_activity_input(message, user_input, input_type):
             else:
                 bot.send_message(chat_id, "❌ Помилка при оновленні цільового місця.", reply_markup=get_admin_bot_activity_menu())
         
-        del user_states[chat_id]
+        user_states.delete(chat_id)
 
     # --- Comment Template Input ---
     elif input_type == 'admin_comment_template_create_name' or input_type == 'admin_comment_template_edit_name':
         state['current_data'] = state.get('current_data', {})
         state['current_data']['name'] = user_input
         state['waiting_for'] = 'admin_comment_template_message_text' if 'template_id' not in state else 'admin_comment_template_edit_message_text'
+        user_states.set(chat_id, state)
         
         prompt_text = "Введіть *текст повідомлення* для коментування:\n"
         if 'original_data' in state and state['original_data'].get('message_text'):
@@ -2153,6 +4595,7 @@ def handle_admin_bot_activity_input(message, user_input, input_type):
     elif input_type == 'admin_comment_template_message_text' or input_type == 'admin_comment_template_edit_message_text':
         state['current_data']['message_text'] = user_input
         state['waiting_for'] = 'admin_comment_template_subscription_link' if 'template_id' not in state else 'admin_comment_template_edit_subscription_link'
+        user_states.set(chat_id, state)
 
         prompt_text = "Введіть *посилання для підписки* (URL). Залиште порожнім, якщо не потрібно.\n"
         if 'original_data' in state and state['original_data'].get('subscription_link'):
@@ -2181,12 +4624,11 @@ def handle_admin_bot_activity_input(message, user_input, input_type):
             else:
                 bot.send_message(chat_id, "❌ Помилка при оновленні повідомлення.", reply_markup=get_admin_bot_activity_menu())
         
-        del user_states[chat_id]
+        user_states.delete(chat_id)
 
     else:
         bot.send_message(chat_id, "Неочікуваний стан введення.", reply_markup=get_admin_bot_activity_menu())
-        if chat_id in user_states:
-            del user_states[chat_id]
+        user_states.delete(chat_id)
 
 # --- Database Operations for Bot Activity ---
 
@@ -2358,11 +4800,107 @@ def delete_bot_comment_template_db(template_id):
         if conn:
             conn.close()
 
+# ============ WEBHOOK SERVER ============
+
+# Serves /metrics next to the polling loop when set (webhook mode always serves it on PORT)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET METRICS_PATH returns the metrics registry; any other GET is the platform's health check."""
+    def _reply(self, status, payload=b'', content_type='text/plain'):
+        # An explicit length lets the client treat the response as complete before the connection closes
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == METRICS_PATH:
+            if METRICS_TOKEN and self.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+                self._reply(403)
+                return
+            self._reply(200, metrics.render().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+        self._reply(200, b'ok')
+
+    def log_message(self, format, *args):
+        logging.debug(f"http: {format % args}")
+
+class TelegramWebhookHandler(MetricsHandler):
+    """
+    Accepts Telegram updates posted to WEBHOOK_PATH. The 200 (with Content-Length: 0) is flushed
+    before the update is processed, so Telegram never waits on the handler filters or handlers,
+    which then run on this request thread and the bot's handler thread pool.
+    """
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self._reply(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self._reply(403)
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            update = types.Update.de_json(body.decode('utf-8'))
+        except Exception as e:
+            logging.error(f"Некоректне оновлення від вебхука: {e}")
+            self._reply(400)
+            return
+
+        self._reply(200)
+        bot.process_new_updates([update])
+
+def run_webhook_server():
+    """Registers the webhook with Telegram and serves updates on PORT until interrupted."""
+    bot.remove_webhook()
+    bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS)
+    server = ThreadingHTTPServer(('0.0.0.0', PORT), TelegramWebhookHandler)
+    server.daemon_threads = True
+    logging.info(f"Вебхук-сервер слухає порт {PORT} ({BOT_WORKER_THREADS} потоків обробки)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def start_metrics_server():
+    """Serves /metrics and the health check on METRICS_PORT from a daemon thread (polling mode)."""
+    server = ThreadingHTTPServer(('0.0.0.0', METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Метрики доступні на порту {METRICS_PORT}{METRICS_PATH}")
+    return server
+
 # ============ MAIN FUNCTION ============
 
 if __name__ == '__main__':
     # Initialize the database and create tables if they don't exist
     init_db()
+    warm_keyboards()
+    audience_index.load()
+    install_profile_signal()
+    rate_share.start()
+    # Pick up broadcasts that were cut short by a restart
+    resume_broadcast_jobs()
+    if BROADCAST_INPROCESS_WORKER:
+        threading.Thread(target=run_broadcast_worker, name="broadcast-queue-worker", daemon=True).start()
     logging.info("База даних ініціалізована. Бот запущено...")
     # Start the bot's polling loop
-    bot.polling(non_stop=True)
+    try:
+        if BOT_MODE == 'webhook':
+            run_webhook_server()
+        else:
+            if METRICS_PORT:
+                start_metrics_server()
+            # Telegram refuses getUpdates while a webhook is registered
+            bot.remove_webhook()
+            bot.polling(non_stop=True)
+    finally:
+        rating_writer.close()
+        unreachable_users.close()
+        rate_share.close()
+        db_pool.closeall()
+        telegram_transport.close()
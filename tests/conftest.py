@@ -0,0 +1,9 @@
+import os
+import sys
+
+# bot.py reads its configuration at import time; nothing below connects to Telegram or Postgres
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/bot_tests')
+os.environ.setdefault('TELEGRAM_ADMIN_IDS', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,149 @@
+import threading
+import time
+
+import pytest
+
+import bot
+
+
+def profile(city, is_active=True, notifications=True):
+    return {'city': city, 'is_active': is_active, 'notifications': notifications}
+
+
+def rows(*users):
+    return [{'chat_id': chat_id, 'city': city} for chat_id, city in users]
+
+
+@pytest.fixture
+def index():
+    return bot.AudienceIndex(refresh_after=3600)
+
+
+def use_recipients(monkeypatch, scan):
+    monkeypatch.setattr(bot, 'iter_broadcast_recipients', lambda *args, **kwargs: scan())
+
+
+def test_load_and_count(monkeypatch, index):
+    use_recipients(monkeypatch, lambda: iter(rows((1, 'київ'), (2, 'київ'), (3, 'львів'))))
+    assert index.count() == 3
+    assert index.count(['Київ ']) == 2
+    assert index.count(['одеса']) == 0
+
+
+def test_apply_moves_and_removes_users(monkeypatch, index):
+    use_recipients(monkeypatch, lambda: iter(rows((1, 'київ'), (2, 'київ'), (3, 'львів'))))
+    index.load()
+    index.apply(1, profile('львів'))
+    index.apply(2, profile('київ', notifications=False))
+    index.apply(4, profile('одеса'))
+    index.apply(3, None) # Deleted user
+    assert index.count(['київ']) == 0
+    assert index.count(['львів']) == 1
+    assert index.count(['одеса']) == 1
+    assert sorted(index._segments['львів']) == list(index._segments['львів'])
+
+
+def test_apply_during_load_is_replayed(monkeypatch, index):
+    """Writes that land while the scan runs must survive the swap to the freshly loaded segments."""
+    def scan():
+        yield {'chat_id': 1, 'city': 'київ'}
+        yield {'chat_id': 2, 'city': 'київ'}
+        # The scan already returned user 2's old row; these writes race with the rest of the load
+        index.apply(2, profile('київ', notifications=False))
+        index.apply(1, profile('львів'))
+        index.apply(9, profile('одеса'))
+        yield {'chat_id': 3, 'city': 'львів'}
+        yield {'chat_id': 9, 'city': 'одеса'} # Seen by the scan too; replay must not duplicate it
+
+    use_recipients(monkeypatch, scan)
+    index.load()
+    assert list(index._segments['київ']) == []
+    assert list(index._segments['львів']) == [1, 3]
+    assert list(index._segments['одеса']) == [9]
+    assert index._replay is None
+
+
+def test_apply_from_another_thread_during_load(monkeypatch, index):
+    loading = threading.Event()
+    applied = threading.Event()
+
+    def scan():
+        yield {'chat_id': 1, 'city': 'київ'}
+        loading.set()
+        assert applied.wait(2)
+        yield {'chat_id': 2, 'city': 'київ'}
+
+    use_recipients(monkeypatch, scan)
+    loader = threading.Thread(target=index.load)
+    loader.start()
+    assert loading.wait(2)
+    index.apply(1, profile('київ', is_active=False))
+    applied.set()
+    loader.join(timeout=2)
+    assert list(index._segments['київ']) == [2]
+
+
+def test_failed_load_keeps_previous_segments(monkeypatch, index):
+    use_recipients(monkeypatch, lambda: iter(rows((1, 'київ'))))
+    index.load()
+
+    def broken():
+        yield {'chat_id': 5, 'city': 'київ'}
+        raise RuntimeError("connection lost")
+
+    use_recipients(monkeypatch, broken)
+    with pytest.raises(RuntimeError):
+        index.load()
+    assert list(index._segments['київ']) == [1]
+    assert index._replay is None
+    index.apply(2, profile('київ'))
+    assert list(index._segments['київ']) == [1, 2]
+
+
+def test_stale_index_is_served_while_reloading_in_background(monkeypatch, index):
+    use_recipients(monkeypatch, lambda: iter(rows((1, 'київ'))))
+    assert index.count() == 1
+
+    release = threading.Event()
+    reloaded = threading.Event()
+
+    def slow_scan():
+        assert release.wait(2)
+        yield {'chat_id': 1, 'city': 'київ'}
+        yield {'chat_id': 2, 'city': 'київ'}
+        reloaded.set()
+
+    use_recipients(monkeypatch, slow_scan)
+    index._loaded_at -= index.refresh_after + 1
+    # Callers get the current segments at once while one background reload runs
+    assert index.count() == 1
+    assert index.count() == 1
+    release.set()
+    assert reloaded.wait(2)
+    deadline = time.monotonic() + 2
+    while index._is_stale() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert index.count() == 2
+
+
+def test_failed_background_reload_is_retried(monkeypatch, index):
+    use_recipients(monkeypatch, lambda: iter(rows((1, 'київ'))))
+    index.load()
+
+    def broken():
+        raise RuntimeError("connection lost")
+        yield
+
+    use_recipients(monkeypatch, broken)
+    index._loaded_at -= index.refresh_after + 1
+    assert index.count() == 1
+    deadline = time.monotonic() + 2
+    while index._load_lock.locked() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert index._is_stale()
+    use_recipients(monkeypatch, lambda: iter(rows((1, 'київ'), (3, 'львів'))))
+    index.count()
+    deadline = time.monotonic() + 2
+    while index._is_stale() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert index.count() == 2
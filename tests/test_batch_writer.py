@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+import bot
+
+
+class RecordingWriter(bot.BatchWriter):
+    """Stores batches in a list; fails while `failing` is set."""
+    def __init__(self):
+        super().__init__(flush_interval=60, flush_size=1000)
+        self.batches = []
+        self.failing = False
+
+    def write(self, batch):
+        if self.failing:
+            raise RuntimeError("database unavailable")
+        self.batches.append(dict(batch))
+        return len(batch)
+
+
+@pytest.fixture
+def writer():
+    writer = RecordingWriter()
+    yield writer
+    writer.failing = False
+    writer.close()
+
+
+def test_batch_writer_is_abstract():
+    with pytest.raises(TypeError):
+        bot.BatchWriter(1, 1)
+
+
+def test_last_write_wins_per_key(writer):
+    writer._add(('u1', 't1'), 3)
+    writer._add(('u1', 't1'), 5)
+    writer._add(('u2', 't1'), 4)
+    assert writer.flush() == 2
+    assert writer.batches == [{('u1', 't1'): 5, ('u2', 't1'): 4}]
+    assert writer.flush() == 0
+
+
+def test_failed_batch_is_kept_for_next_flush(writer):
+    writer._add('a', 1)
+    writer._add('b', 2)
+    writer.failing = True
+    assert writer.flush() == 0
+    assert writer.pending == 2
+
+    # A newer value that arrived after the failure wins over the kept one
+    writer._add('a', 10)
+    writer.failing = False
+    assert writer.flush() == 2
+    assert writer.batches == [{'a': 10, 'b': 2}]
+    assert writer.pending == 0
+
+
+def test_close_flushes_pending(writer):
+    writer._add('a', 1)
+    writer.close()
+    assert writer.batches == [{'a': 1}]
+
+
+def test_flush_size_wakes_background_flusher():
+    writer = RecordingWriter()
+    writer.flush_size = 2
+    try:
+        writer._add('a', 1)
+        writer._add('b', 2)
+        deadline = time.monotonic() + 2
+        while not writer.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert writer.batches == [{'a': 1, 'b': 2}]
+    finally:
+        writer.close()
+
+
+def test_rating_writer_reports_dropped_ratings(monkeypatch, caplog):
+    monkeypatch.setattr(bot, 'save_ratings', lambda batch: {(1, 10)})
+    writer = bot.RatingWriter(60, 1000)
+    writer.submit(1, 10, 5)
+    writer.submit(2, 10, 4)
+    with caplog.at_level('WARNING'):
+        assert writer.flush() == 1
+    assert any('від 2' in record.getMessage() for record in caplog.records)
@@ -0,0 +1,78 @@
+import ast
+import os
+import re
+
+import pytest
+
+import bot
+
+SAMPLE_VALUES = {'int': '42', 'str': 'kyiv', 'rest': 'ivano_frankivsk'}
+EXPECTED_VALUES = {'int': 42, 'str': 'kyiv', 'rest': 'ivano_frankivsk'}
+PARAM = re.compile(r'\{(\w+)(?::(\w+))?\}')
+
+ROUTES = list(bot.callback_router._routes)
+
+
+def sample_data(pattern):
+    """callback_data for a pattern with every parameter filled in, and the params it should resolve to."""
+    params = {}
+
+    def fill(match):
+        name, type_name = match.group(1), match.group(2) or 'str'
+        params[name] = EXPECTED_VALUES[type_name]
+        return SAMPLE_VALUES[type_name]
+
+    return PARAM.sub(fill, pattern), params
+
+
+def test_every_handler_is_registered():
+    assert len(ROUTES) == 51
+
+
+@pytest.mark.parametrize('route', ROUTES, ids=[route.pattern for route in ROUTES])
+def test_pattern_resolves_to_its_route(route):
+    data, params = sample_data(route.pattern)
+    found = bot.callback_router.resolve(data)
+    assert found is not None, data
+    assert found[0] is route
+    assert found[1] == params
+
+
+def test_literal_prefix_wins_over_parameter():
+    # admin_broadcast_delete_confirm_7 must not be read as admin_broadcast_delete_{template_id}
+    route, params = bot.callback_router.resolve('admin_broadcast_delete_confirm_7')
+    assert route.pattern == 'admin_broadcast_delete_confirm_{template_id:int}'
+    assert params == {'template_id': 7}
+    route, params = bot.callback_router.resolve('admin_broadcast_delete_7')
+    assert route.pattern == 'admin_broadcast_delete_{template_id:int}'
+
+
+@pytest.mark.parametrize('data', ['', 'unknown', 'rate_x_5', 'rate_1', 'rate_1_2_3', 'delete_channel_', 'main_menu_1'])
+def test_unknown_data_does_not_resolve(data):
+    assert bot.callback_router.resolve(data) is None
+
+
+def test_callback_data_in_source_resolves():
+    """Every literal callback_data the bot hands out has a route."""
+    source = open(os.path.join(os.path.dirname(bot.__file__), 'bot.py'), encoding='utf-8').read()
+    literals = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.keyword) and node.arg == 'callback_data' and isinstance(node.value, ast.Constant):
+            literals.add(node.value.value)
+    assert literals
+    unresolved = sorted(data for data in literals if bot.callback_router.resolve(data) is None)
+    assert unresolved == []
+
+
+def test_duplicate_and_malformed_patterns_are_rejected():
+    router = bot.CallbackRouter()
+    router.add('item_{item_id:int}', lambda call, item_id: None)
+    with pytest.raises(ValueError):
+        router.add('item_{item_id:int}', lambda call, item_id: None)
+    router.add('menu', lambda call: None)
+    with pytest.raises(ValueError):
+        router.add('menu', lambda call: None)
+    with pytest.raises(ValueError):
+        router.add('item_{item_id:float}', lambda call, item_id: None)
+    with pytest.raises(ValueError):
+        router.add('tail_{rest:rest}_end', lambda call, rest: None)
@@ -0,0 +1,49 @@
+import bot
+
+
+def test_histogram_quantiles_use_bucket_bounds():
+    histogram = bot.LatencyHistogram()
+    for seconds in (0.005, 0.02, 0.02, 0.3, 4):
+        histogram.observe(seconds)
+    assert histogram.count == 5
+    assert histogram.quantile(0.5) == 0.025
+    assert histogram.quantile(0.8) == 0.5
+    # The top bucket is capped by the largest observation
+    assert histogram.quantile(1.0) == 4
+    assert bot.LatencyHistogram().quantile(0.99) == 0.0
+
+
+def test_registry_renders_prometheus_text():
+    registry = bot.MetricsRegistry()
+    calls = registry.counter('test_calls_total', "Calls", ('method',))
+    latency = registry.histogram('test_seconds', "Latency", ('method',), buckets=(0.1, 1, float('inf')))
+    registry.gauge('test_depth', "Depth", lambda: 7)
+    calls.inc('send"Message')
+    calls.inc('send"Message', amount=2)
+    latency.observe(0.05, 'get')
+    latency.observe(0.5, 'get')
+
+    text = registry.render()
+    assert '# TYPE test_calls_total counter' in text
+    assert 'test_calls_total{method="send\\"Message"} 3' in text
+    assert 'test_seconds_bucket{method="get",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{method="get",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{method="get",le="+Inf"} 2' in text
+    assert 'test_seconds_count{method="get"} 2' in text
+    assert 'test_depth 7' in text
+    assert text.endswith('\n')
+
+
+def test_failing_gauge_does_not_break_render():
+    registry = bot.MetricsRegistry()
+    registry.gauge('test_broken', "Broken", lambda: 1 / 0)
+    registry.counter('test_after_total', "After").inc()
+    assert 'test_after_total 1' in registry.render()
+
+
+def test_snapshot_is_a_copy():
+    family = bot.Histogram('test_copy_seconds', "Copy")
+    family.observe(0.1)
+    snapshot = family.snapshot()
+    family.observe(0.2)
+    assert snapshot[()].count == 1
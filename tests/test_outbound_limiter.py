@@ -0,0 +1,76 @@
+import threading
+import time
+
+import bot
+
+
+def limiter(rate=20, chat_interval=0, group_interval=0, reserve=0):
+    return bot.OutboundLimiter(rate, chat_interval, group_interval, reserve)
+
+
+def timed(func, *args):
+    started = time.monotonic()
+    func(*args)
+    return time.monotonic() - started
+
+
+def test_burst_then_global_rate():
+    paced = limiter(rate=20)
+    # The bucket starts full, so the first second's worth goes out at once
+    assert timed(lambda: [paced.acquire(chat_id, True) for chat_id in range(1, 21)]) < 0.1
+    elapsed = timed(lambda: [paced.acquire(chat_id, True) for chat_id in range(21, 31)])
+    assert 0.4 <= elapsed < 0.8
+
+
+def test_same_chat_spacing():
+    paced = limiter(rate=1000, chat_interval=0.1, group_interval=0.3)
+    assert 0.18 <= timed(lambda: [paced.acquire(5, True) for _ in range(3)]) < 0.4
+    # Groups and channels (negative ids) use their own, longer interval
+    assert 0.28 <= timed(lambda: [paced.acquire(-100, True) for _ in range(2)]) < 0.5
+    # Edits and callback answers are not new messages and skip the per-chat spacing
+    assert timed(lambda: [paced.acquire(5, False) for _ in range(3)]) < 0.05
+
+
+def test_pause_blocks_every_send():
+    paced = limiter(rate=1000)
+    paced.pause(0.3)
+    assert 0.28 <= timed(paced.acquire, 7, True) < 0.5
+
+
+def test_bulk_leaves_reserve_for_interactive():
+    paced = limiter(rate=10, reserve=5)
+    with paced.bulk_sends():
+        # Capacity is 10; bulk stops once only the reserved 5 are left
+        assert timed(lambda: [paced.acquire(chat_id, True) for chat_id in range(1, 6)]) < 0.05
+        assert timed(paced.acquire, 6, True) >= 0.05
+    assert timed(lambda: [paced.acquire(chat_id, True) for chat_id in range(10, 14)]) < 0.05
+
+
+def test_set_rate_changes_pacing():
+    paced = limiter(rate=100)
+    for chat_id in range(100):
+        paced.acquire(chat_id, True)
+    paced.set_rate(10)
+    assert paced.rate == 10
+    assert 0.15 <= timed(lambda: [paced.acquire(chat_id, True) for chat_id in range(200, 202)]) < 0.4
+
+
+def test_interactive_send_is_not_starved_by_bulk():
+    paced = limiter(rate=20, reserve=2)
+    stop = threading.Event()
+
+    def bulk():
+        with paced.bulk_sends():
+            chat_id = 1000
+            while not stop.is_set():
+                paced.acquire(chat_id, True)
+                chat_id += 1
+
+    worker = threading.Thread(target=bulk, daemon=True)
+    worker.start()
+    time.sleep(0.3)
+    try:
+        assert timed(paced.acquire, 1, True) < 0.1
+    finally:
+        stop.set()
+        worker.join(timeout=2)
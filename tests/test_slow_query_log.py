@@ -0,0 +1,38 @@
+import bot
+
+
+def test_aggregates_by_helper_and_statement():
+    log = bot.SlowQueryLog(max_entries=10)
+    log.record('get_user_profile', 'SELECT 1', '(int)', 0.5)
+    log.record('get_user_profile', 'SELECT 1', '(int)', 1.5, error='canceling statement due to statement timeout')
+    log.record('save_ratings', 'INSERT', '[3 rows]', 0.2)
+
+    top = log.top(5)
+    assert [entry['helper'] for entry in top] == ['get_user_profile', 'save_ratings']
+    assert top[0]['calls'] == 2
+    assert top[0]['errors'] == 1
+    assert top[0]['total'] == 2.0
+    assert top[0]['max'] == 1.5
+
+
+def test_evicts_least_total_time_when_full():
+    log = bot.SlowQueryLog(max_entries=2)
+    log.record('a', 'SELECT a', '()', 3.0)
+    log.record('b', 'SELECT b', '()', 0.1)
+    log.record('c', 'SELECT c', '()', 1.0)
+    assert sorted(entry['helper'] for entry in log.top(5)) == ['a', 'c']
+
+
+def test_top_returns_copies_and_reset_clears():
+    log = bot.SlowQueryLog(max_entries=2)
+    log.record('a', 'SELECT a', '()', 1.0)
+    log.top(1)[0]['calls'] = 100
+    assert log.top(1)[0]['calls'] == 1
+    log.reset()
+    assert log.top(1) == []
+
+
+def test_params_shape_hides_values():
+    assert bot.describe_params((12345, 'secret', [1, 2, 3])) == '(int, str[6], list[3])'
+    assert bot.describe_params({'chat_id': 12345}) == '{chat_id: int}'
+    assert bot.describe_params(None) == '()'
@@ -0,0 +1,41 @@
+import json
+import time
+
+import requests
+
+import bot
+
+
+def timed(func, *args):
+    started = time.monotonic()
+    func(*args)
+    return time.monotonic() - started
+
+
+class FakeSession:
+    """Answers every request with one canned response."""
+    def __init__(self, status, payload):
+        self.status = status
+        self.payload = payload
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = self.status
+        response._content = json.dumps(self.payload).encode()
+        return response
+
+
+def test_transport_pauses_limiter_on_429():
+    paced = bot.OutboundLimiter(1000, 0, 0, 0)
+    transport = bot.TelegramTransport(1, 1, 1, paced)
+    transport.session = FakeSession(429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0.3}})
+    before = bot.TELEGRAM_API_RESPONSES.values().get(('sendMessage', '429'), 0)
+
+    response = transport.send('post', 'https://api.telegram.org/botTOKEN/sendMessage', params={'chat_id': '5'})
+
+    assert response.status_code == 429
+    assert bot.TELEGRAM_API_RESPONSES.values()[('sendMessage', '429')] == before + 1
+    # Every chat waits out retry_after, not just the one that hit the limit
+    assert 0.25 <= timed(paced.acquire, 6, True) < 0.5
@@ -0,0 +1,49 @@
+import time
+
+import bot
+
+
+def test_get_set_delete():
+    cache = bot.TTLCache(max_entries=10, ttl=60)
+    assert cache.get('a') is None
+    assert cache.get('a', 'missing') == 'missing'
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    cache.delete('a')
+    cache.delete('a')
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: now[0])
+    cache = bot.TTLCache(max_entries=10, ttl=5)
+    cache.set('a', 1)
+    now[0] += 4.9
+    assert cache.get('a') == 1
+    now[0] += 0.1
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = bot.TTLCache(max_entries=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a') # 'b' is now the least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_set_refreshes_ttl_and_clear_empties():
+    cache = bot.TTLCache(max_entries=2, ttl=0.05)
+    cache.set('a', 1)
+    time.sleep(0.03)
+    cache.set('a', 2)
+    time.sleep(0.03)
+    assert cache.get('a') == 2
+    cache.clear()
+    assert len(cache) == 0
@@ -0,0 +1,169 @@
+"""
+Database benchmark: times bot.py's hot SQL paths against a seeded database and writes JSON
+results that can be diffed between commits (--baseline prints the change per case).
+
+Statements inlined in handlers are taken verbatim from bot.py's source (as tools/query_audit.py
+does); helpers are called directly. Writes run in a transaction that is rolled back, so the
+dataset, and therefore the numbers, stay stable between runs:
+
+    for n in 10000 100000 1000000; do
+        DATABASE_URL=postgresql://localhost/botdb_bench python tools/seed_data.py --users $n --reset
+        DATABASE_URL=postgresql://localhost/botdb_bench python tools/db_benchmark.py --output bench-$n.json
+    done
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot  # noqa: E402
+from load_test import percentile  # noqa: E402
+from query_audit import collect_statements  # noqa: E402
+
+SAMPLE_SIZE = 1000
+TARGET_CITIES = ['київ', 'львів', 'одеса']
+
+
+def statement(name, index=0):
+    """The literal SQL of a function's index-th statement in bot.py."""
+    for function, position, sql, batched in collect_statements(os.path.join(ROOT, 'bot.py')):
+        if function == name and position == index:
+            return sql
+    raise LookupError(f"No statement #{index} in {name}")
+
+
+def timed(operation, iterations, warmup):
+    """Runs operation() warmup + iterations times; returns (seconds per iteration, last result)."""
+    result = None
+    for _ in range(warmup):
+        result = operation()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        result = operation()
+        samples.append(time.perf_counter() - started)
+    return samples, result
+
+
+def summarize(samples, rows):
+    total = sum(samples)
+    return {'iterations': len(samples), 'rows': rows,
+            'mean_ms': total / len(samples) * 1000,
+            'p50_ms': percentile(samples, 0.50) * 1000, 'p95_ms': percentile(samples, 0.95) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+            'min_ms': min(samples) * 1000, 'max_ms': max(samples) * 1000,
+            'ops_per_second': len(samples) / total if total else 0.0}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def dataset(cur):
+    cur.execute("""
+        SELECT (SELECT count(*) FROM users) AS users,
+               (SELECT count(*) FROM users WHERE is_active AND notifications) AS recipients,
+               (SELECT count(*) FROM target_channels) AS channels,
+               (SELECT count(*) FROM broadcast_ratings) AS ratings,
+               current_setting('server_version') AS postgres;
+    """)
+    return dict(cur.fetchone())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=500, help="runs of each point query (default 500)")
+    parser.add_argument('--scan-iterations', type=int, default=5, help="runs of each full-audience case (default 5)")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="earlier JSON results to compare p50 against")
+    parser.add_argument('--seed', type=int, default=94, help="random seed for the sampled ids (default 94)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bot.init_db()
+    conn = bot.get_db_connection()
+    cases = {}
+    try:
+        with conn.cursor() as cur:
+            info = dataset(cur)
+            if not info['users']:
+                sys.exit("users is empty; seed the database with tools/seed_data.py first")
+            cur.execute("SELECT chat_id FROM users ORDER BY random() LIMIT %s;", (SAMPLE_SIZE,))
+            users = [row['chat_id'] for row in cur.fetchall()]
+            cur.execute("SELECT DISTINCT added_by FROM target_channels WHERE is_active LIMIT %s;", (SAMPLE_SIZE,))
+            owners = [row['added_by'] for row in cur.fetchall()] or users
+        conn.rollback()
+        cities = sorted(bot.UKRAINIAN_CITIES)
+
+        upsert = statement('handle_city_selection')
+        def register(chat_id):
+            # The handler's upsert in its own transaction, rolled back to keep the dataset unchanged
+            with conn.cursor() as cur:
+                cur.execute(upsert, (chat_id, 'bench', 'Bench', rng.choice(cities)))
+                row = cur.fetchone()
+            conn.rollback()
+            return 1 if row else 0
+
+        ratings_stats = statement('show_ratings_stats')
+        def show_ratings():
+            with conn.cursor() as cur:
+                cur.execute(ratings_stats)
+                rows = cur.fetchall()
+            conn.rollback()
+            return len(rows)
+
+        point_cases = {
+            'handle_city_selection.upsert[existing]': lambda: register(rng.choice(users)),
+            'handle_city_selection.upsert[new]': lambda: register(rng.randrange(9_900_000_000, 9_999_999_999)),
+            'get_channels_by_user[owner]': lambda: len(bot.get_channels_by_user(rng.choice(owners))),
+            'get_channels_by_user[any]': lambda: len(bot.get_channels_by_user(rng.choice(users))),
+            'show_ratings_stats': show_ratings,
+            'audience_index.count[3 cities]': lambda: bot.audience_index.count(TARGET_CITIES),
+        }
+        scan_cases = {
+            'iter_broadcast_recipients[all]': lambda: sum(1 for _ in bot.iter_broadcast_recipients()),
+            'iter_broadcast_recipients[3 cities]': lambda: sum(1 for _ in bot.iter_broadcast_recipients(TARGET_CITIES)),
+            'audience_index.load': lambda: bot.audience_index.load() or bot.audience_index.count(),
+        }
+        for name, operation in point_cases.items():
+            samples, rows = timed(operation, args.iterations, warmup=min(20, args.iterations))
+            cases[name] = summarize(samples, rows)
+        for name, operation in scan_cases.items():
+            samples, rows = timed(operation, args.scan_iterations, warmup=1)
+            cases[name] = summarize(samples, rows)
+    finally:
+        conn.close()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['cases']
+    print(f"{'case':<44}{'rows':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>10}"
+          + (f"{'vs base':>10}" if baseline else ""))
+    for name, row in cases.items():
+        line = (f"{name:<44}{row['rows']:>9}{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}{row['p99_ms']:>10.3f}"
+                f"{row['ops_per_second']:>10.1f}")
+        if name in baseline and baseline[name]['p50_ms']:
+            line += f"{(row['p50_ms'] / baseline[name]['p50_ms'] - 1) * 100:>+9.1f}%"
+        print(line)
+
+    if args.output:
+        results = {'commit': git_commit(), 'timestamp': datetime.now().isoformat(timespec='seconds'),
+                   'dataset': info, 'cases': cases}
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
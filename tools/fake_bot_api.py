@@ -0,0 +1,203 @@
+"""
+Fake Telegram Bot API: a local stand-in for api.telegram.org with configurable latency,
+429 flood-limit injection and chats that have "blocked" the bot.
+
+Point the bot at it with TELEGRAM_API_URL and feed it updates through getUpdates
+(POST a JSON list of updates to /_updates) or use it in-process from tools/load_test.py:
+
+    python tools/fake_bot_api.py --port 8081 --latency 40 --flood-every 500 --blocked-percent 5
+    TELEGRAM_API_URL='http://127.0.0.1:8081/bot{0}/{1}' BOT_MODE=polling python bot.py
+
+GET /_stats returns the per-method call counts and injected failures as JSON.
+"""
+import argparse
+import collections
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Methods that deliver something to a chat; only these are flood-limited or refused for blocked chats
+SEND_METHODS = ('send', 'edit', 'copy', 'forward')
+
+
+class FakeBotAPI:
+    """Bot API state: queued updates, per-chat reply counters and call statistics."""
+
+    def __init__(self, latency=0.0, jitter=0.0, flood_every=0, retry_after=1, blocked_percent=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.blocked_percent = blocked_percent
+        self.blocked_chats = set()
+        self.calls = collections.Counter()
+        self.flooded = 0
+        self.refused = 0
+        self.webhook_url = ''
+        self._sends = 0
+        self._message_id = 0
+        self._updates = []
+        self._replies = collections.Counter() # chat_id -> messages sent or edited for it
+        self._cond = threading.Condition()
+
+    def is_blocked(self, chat_id):
+        return chat_id in self.blocked_chats or (0 < chat_id and chat_id % 100 < self.blocked_percent)
+
+    def push_updates(self, updates):
+        with self._cond:
+            self._updates.extend(updates)
+            self._cond.notify_all()
+
+    def replies(self, chat_id):
+        with self._cond:
+            return self._replies[chat_id]
+
+    def wait_reply(self, chat_id, seen, timeout):
+        """Blocks until more than `seen` replies reached chat_id; False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._replies[chat_id] <= seen:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stats(self):
+        with self._cond:
+            return {'calls': dict(self.calls), 'flooded': self.flooded, 'refused': self.refused,
+                    'queued_updates': len(self._updates)}
+
+    def handle(self, method, params):
+        """Returns (HTTP status, response document) for one Bot API call."""
+        with self._cond:
+            self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if method.startswith(SEND_METHODS):
+            chat_id = _chat_id(params.get('chat_id'))
+            with self._cond:
+                self._sends += 1
+                if self.flood_every and self._sends % self.flood_every == 0:
+                    self.flooded += 1
+                    return 429, {'ok': False, 'error_code': 429,
+                                 'description': f"Too Many Requests: retry after {self.retry_after}",
+                                 'parameters': {'retry_after': self.retry_after}}
+                if self.is_blocked(chat_id):
+                    self.refused += 1
+                    return 403, {'ok': False, 'error_code': 403, 'description': "Forbidden: bot was blocked by the user"}
+                self._message_id += 1
+                message_id = int(params.get('message_id') or self._message_id)
+                self._replies[chat_id] += 1
+                self._cond.notify_all()
+            chat = {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'first_name': 'Load'}
+            return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()), 'chat': chat,
+                                                'text': params.get('text', '')}}
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}}
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url', '')
+        elif method == 'deleteWebhook':
+            self.webhook_url = ''
+        elif method == 'getWebhookInfo':
+            return 200, {'ok': True, 'result': {'url': self.webhook_url, 'has_custom_certificate': False,
+                                                'pending_update_count': 0}}
+        return 200, {'ok': True, 'result': True}
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = min(float(params.get('timeout') or 0), 25)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Confirmed updates (below offset) are dropped, as Telegram does
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return self._updates[:int(params.get('limit') or 100)]
+
+    def serve(self, host='127.0.0.1', port=0):
+        """Starts an HTTP server in a daemon thread and returns it (server.server_port holds the port)."""
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Keep-alive, like the real API
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if url.path == '/_updates':
+                    api.push_updates(json.loads(body or b'[]'))
+                    return self._reply(200, {'ok': True})
+                if url.path == '/_stats':
+                    return self._reply(200, api.stats())
+                params = dict(parse_qsl(url.query))
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update(parse_qsl(body.decode('utf-8')))
+                elif content_type.startswith('application/json'):
+                    params.update(json.loads(body or b'{}'))
+                status, document = api.handle(url.path.rsplit('/', 1)[-1], params)
+                self._reply(status, document)
+
+            def _reply(self, status, document):
+                payload = json.dumps(document).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True).start()
+        return server
+
+
+def _chat_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0 # @channelusername
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help="ms added to every call except getUpdates")
+    parser.add_argument('--jitter', type=float, default=0, help="± ms of uniform jitter on top of --latency")
+    parser.add_argument('--flood-every', type=int, default=0, help="answer every Nth send with 429 (0 = never)")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after of injected 429s, seconds")
+    parser.add_argument('--blocked-percent', type=int, default=0,
+                        help="private chats with chat_id %% 100 below this get 403 'bot was blocked'")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.latency / 1000, args.jitter / 1000, args.flood_every, args.retry_after, args.blocked_percent)
+    server = api.serve(args.host, args.port)
+    print(f"Fake Bot API on http://{args.host}:{server.server_port}/bot{{0}}/{{1}}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""
+Load test: drives bot.py's handlers end to end against the fake Bot API (tools/fake_bot_api.py).
+
+Synthetic users register, pick a city and tap through the menus. Then a rated broadcast goes out
+to their cities; some dormant users in those cities have blocked the bot. Then every user rates it.
+Each update is handed to the bot exactly as the webhook server does (bot.process_new_updates). Its
+latency is measured from hand-off to the first message the bot sends or edits for that chat.
+The report gives p50/p95/p99 per step and the broadcast's messages/s; --json saves it for diffing.
+Synthetic rows use chat_ids from LOAD_USER_BASE up and are deleted afterwards. Nothing reaches
+Telegram, but broadcast recipients include every real user of the chosen cities, so use a scratch database:
+
+    DATABASE_URL=postgresql://localhost/botdb_load python tools/load_test.py --users 500 --latency 30
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+LOAD_USER_BASE = 9_500_000_000
+CITIES = ('київ', 'львів', 'одеса', 'біла_церква')
+
+SCENARIO = [
+    ('start', 'message', '/start'),
+    ('register', 'callback', 'register'),
+    ('select_city', 'callback', 'select_city_{city}'),
+    ('stats', 'callback', 'stats'),
+    ('settings', 'callback', 'settings'),
+    ('toggle_off', 'callback', 'toggle_notifications'),
+    ('toggle_on', 'callback', 'toggle_notifications'),
+    ('main_menu', 'callback', 'main_menu'),
+]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of an unsorted list (0 for an empty one)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+class LoadTest:
+    """Runs the synthetic user scenarios and collects per-step latencies."""
+
+    def __init__(self, bot, api, timeout, think_time):
+        self.bot = bot
+        self.api = api
+        self.timeout = timeout
+        self.think_time = think_time
+        self.latencies = {}  # step -> [seconds]
+        self.timeouts = {}  # step -> count
+        self._update_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _user(self, chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': f"Load {chat_id}", 'username': f"load{chat_id}"}
+
+    def _update(self, chat_id, kind, payload):
+        update_id = next(self._update_ids)
+        chat = {'id': chat_id, 'type': 'private', 'first_name': f"Load {chat_id}"}
+        message = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': self._user(chat_id),
+                   'text': payload}
+        if kind == 'message':
+            if payload.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(payload.split()[0])}]
+            return {'update_id': update_id, 'message': message}
+        return {'update_id': update_id,
+                'callback_query': {'id': str(update_id), 'from': self._user(chat_id), 'chat_instance': str(chat_id),
+                                   'data': payload, 'message': message}}
+
+    def step(self, chat_id, name, kind, payload):
+        """Sends one update and waits for the bot's first reply to that chat."""
+        seen = self.api.replies(chat_id)
+        update = self.bot.types.Update.de_json(json.dumps(self._update(chat_id, kind, payload)))
+        started = time.perf_counter()
+        self.bot.bot.process_new_updates([update])
+        answered = self.api.wait_reply(chat_id, seen, self.timeout)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            if answered:
+                self.latencies.setdefault(name, []).append(elapsed)
+            else:
+                self.timeouts[name] = self.timeouts.get(name, 0) + 1
+        if self.think_time:
+            time.sleep(self.think_time)
+
+    def run_users(self, chat_ids, steps, concurrency):
+        def scenario(chat_id):
+            city = CITIES[chat_id % len(CITIES)]
+            for name, kind, payload in steps(chat_id):
+                self.step(chat_id, name, kind, payload.format(city=city))
+
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in concurrent.futures.as_completed([pool.submit(scenario, c) for c in chat_ids]):
+                future.result()
+        return time.perf_counter() - started
+
+    def report(self):
+        rows = {}
+        every = []
+        for name, values in self.latencies.items():
+            every.extend(values)
+            rows[name] = self._summary(values, self.timeouts.get(name, 0))
+        rows['all'] = self._summary(every, sum(self.timeouts.values()))
+        return rows
+
+    @staticmethod
+    def _summary(values, timeouts):
+        return {'count': len(values), 'timeouts': timeouts,
+                'p50_ms': percentile(values, 0.50) * 1000, 'p95_ms': percentile(values, 0.95) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000, 'max_ms': max(values, default=0) * 1000}
+
+
+def seed_dormant_users(bot, chat_ids):
+    """Registers users that never interact; the fake API reports them as having blocked the bot."""
+    conn = bot.get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO users (chat_id, first_name, city)
+                    SELECT id, 'Dormant', (%s::text[])[1 + id %% %s] FROM unnest(%s::bigint[]) AS id
+                    ON CONFLICT (chat_id) DO NOTHING;
+                """, (list(CITIES), len(CITIES), chat_ids))
+    finally:
+        conn.close()
+
+
+def create_template(bot):
+    conn = bot.get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO broadcast_templates (name, title, message, target_cities)
+                    VALUES ('load-test', 'Load test', 'Load test broadcast', %s) RETURNING id;
+                """, (','.join(CITIES),))
+                return cur.fetchone()['id']
+    finally:
+        conn.close()
+
+
+def cleanup(bot, template_id):
+    if template_id:
+        bot.delete_broadcast_template_db(template_id)
+    conn = bot.get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM users WHERE chat_id >= %s;", (LOAD_USER_BASE,))
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help="synthetic users tapping through the bot (default 200)")
+    parser.add_argument('--dormant', type=int, default=50,
+                        help="registered users that have blocked the bot, reached only by the broadcast (default 50)")
+    parser.add_argument('--concurrency', type=int, default=50, help="users acting at the same time (default 50)")
+    parser.add_argument('--latency', type=float, default=20, help="fake Bot API latency per call, ms (default 20)")
+    parser.add_argument('--jitter', type=float, default=5, help="± ms of jitter on the fake latency (default 5)")
+    parser.add_argument('--flood-every', type=int, default=0, help="inject a 429 every Nth send (default never)")
+    parser.add_argument('--think-time', type=float, default=50, help="pause between a user's steps, ms (default 50)")
+    parser.add_argument('--timeout', type=float, default=15, help="seconds to wait for a reply (default 15)")
+    parser.add_argument('--rate', type=float, help="override TELEGRAM_RATE_PER_SECOND for the run")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.latency / 1000, args.jitter / 1000, args.flood_every)
+    server = api.serve()
+    # bot.py reads its settings at import time, so the fake API has to be configured first
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}"
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:load-test')
+    if args.rate:
+        os.environ['TELEGRAM_RATE_PER_SECOND'] = str(args.rate)
+    import bot
+
+    users = [LOAD_USER_BASE + i for i in range(args.users)]
+    dormant = [LOAD_USER_BASE + args.users + i for i in range(args.dormant)]
+    api.blocked_chats.update(dormant)
+    bot.init_db()
+    bot.warm_keyboards()
+    template_id = None
+    test = LoadTest(bot, api, args.timeout, args.think_time / 1000)
+    try:
+        seed_dormant_users(bot, dormant)
+        template_id = create_template(bot)
+        bot.audience_index.load()
+
+        interactive_time = test.run_users(users, lambda chat_id: SCENARIO, args.concurrency)
+
+        done = threading.Event()
+        job = bot.send_broadcast_by_city("Load test broadcast", list(CITIES), template_id=template_id,
+                                         name='load-test', on_complete=lambda job: done.set())
+        done.wait()
+        deactivated = bot.unreachable_users.flush()
+
+        rating_steps = lambda chat_id: [('rate', 'callback', f"rate_{template_id}_{1 + chat_id % 5}")]  # noqa: E731
+        rating_time = test.run_users(users, rating_steps, args.concurrency)
+        ratings_written = bot.rating_writer.flush()
+    finally:
+        cleanup(bot, template_id)
+        server.shutdown()
+
+    steps = test.report()
+    interactive_updates = steps['all']['count'] - steps.get('rate', {}).get('count', 0)
+    results = {
+        'users': args.users, 'dormant': args.dormant, 'concurrency': args.concurrency, 'fake_latency_ms': args.latency,
+        'steps': steps,
+        'interactive_updates_per_second': interactive_updates / interactive_time if interactive_time else 0.0,
+        'rating_updates_per_second': steps.get('rate', {}).get('count', 0) / rating_time if rating_time else 0.0,
+        'broadcast': {'sent': job.sent_count, 'failed': job.failed_count,
+                      'messages_per_second': job.messages_per_second, 'deactivated': deactivated},
+        'ratings_written': ratings_written,
+        'api': api.stats(),
+        'routes': bot.callback_router.stats(),
+    }
+
+    print(f"{'step':<14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'timeouts':>10}")
+    for name, row in steps.items():
+        print(f"{name:<14}{row['count']:>7}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}"
+              f"{row['max_ms']:>10.1f}{row['timeouts']:>10}")
+    print(f"\nInteractive: {results['interactive_updates_per_second']:.1f} updates/s, "
+          f"ratings: {results['rating_updates_per_second']:.1f} updates/s")
+    print(f"Broadcast: {job.sent_count} sent, {job.failed_count} failed, {job.messages_per_second:.1f} msgs/s, "
+          f"{deactivated} users deactivated")
+    print(f"Fake API: {api.flooded} 429s injected, {api.refused} sends refused; calls {dict(api.calls)}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    sys.exit(1 if steps['all']['timeouts'] else 0)
+
+
+if __name__ == '__main__':
+    main()
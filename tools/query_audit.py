@@ -0,0 +1,313 @@
+"""
+Query audit: runs EXPLAIN (ANALYZE, BUFFERS) for every SQL statement in bot.py against
+synthetic data and fails if any of them sequentially scans more than --threshold rows.
+
+Statements are collected from bot.py's source (cur.execute / execute_values string literals),
+so a new query without sample parameters below fails the audit until it is covered.
+The audit applies the bot's migrations, seeds inside a transaction that is rolled back and
+VACUUMs the seeded tables afterwards, so point it at a scratch database (it refuses to run
+against one with users unless --force is given, e.g. a seed_data.py dataset):
+
+    DATABASE_URL=postgresql://localhost/botdb_audit python tools/query_audit.py --users 50000
+"""
+import argparse
+import ast
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2  # noqa: E402
+from psycopg2.extras import execute_values  # noqa: E402
+
+import bot  # noqa: E402
+
+# Seeded ids live far above anything a real deployment hands out
+USER_BASE = 9_000_000_000
+ROW_BASE = 900_000_000
+USER = USER_BASE + 42
+TEMPLATE = ROW_BASE + 1
+JOB = ROW_BASE + 1
+CHANNEL = ROW_BASE + 7
+LOCATION = ROW_BASE + 3
+COMMENT_TEMPLATE = ROW_BASE + 3
+CITY = 'київ'
+
+SEEDED_TABLES = ('users', 'target_channels', 'target_groups', 'broadcast_templates', 'broadcast_ratings',
+                 'broadcast_rating_stats', 'broadcast_jobs', 'broadcast_deliveries', 'conversation_states', 'city_stats',
+                 'bot_target_locations', 'bot_comment_templates')
+
+# Statements that are not part of the bot's runtime workload
+SKIP_FUNCTIONS = {'ConnectionPool._is_healthy', 'get_schema_version', 'init_db'}
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+# Representative parameters per function, one tuple per statement in source order.
+# execute_values statements take a list of rows instead.
+SAMPLE_PARAMS = {
+    'PostgresStateStore.get': [(USER,)],
+    'PostgresStateStore.set': [(USER, '{"waiting_for": "channel_name"}', 3600)],
+    'PostgresStateStore.delete': [(USER,)],
+    'handle_city_selection': [(USER, 'audit', 'Audit', CITY)],
+    'complete_channel_addition': [('audit channel', 'https://t.me/audit', CITY, USER)],
+    'complete_group_addition': [('audit group', 'https://t.me/audit', CITY, USER)],
+    'save_ratings': [[(USER, TEMPLATE, 5), (USER + 1, TEMPLATE, 4)]],
+    'broadcast_template_exists': [(TEMPLATE,)],
+    'get_user_profile': [(USER,)],
+    'update_user_notifications_status': [(False, USER)],
+    'deactivate_users': [([USER, USER + 1, USER + 2],)],
+    'heartbeat_outbound_sender': [('audit:1',), (30,)],
+    'remove_outbound_sender': [('audit:1',)],
+    'get_channels_by_user': [(USER,)],
+    'get_groups_by_user': [(USER,)],
+    'delete_channel_by_id': [(CHANNEL, USER)],
+    'delete_group_by_id': [(CHANNEL, USER)],
+    'get_broadcast_template': [(TEMPLATE,)],
+    'add_broadcast_template': [('audit new', 'title', 'message', None)],
+    'update_broadcast_template': [('audit renamed', 'title', 'message', None, TEMPLATE)],
+    'delete_broadcast_template_db': [(TEMPLATE,), (TEMPLATE,)],
+    'create_broadcast_job': [(TEMPLATE, 'audit', 'message', None, USER)],
+    'enqueue_broadcast_deliveries': [[(JOB, USER_BASE + 10_000_000, CITY)], (USER_BASE + 10_000_000, 1, False, JOB)],
+    'get_broadcast_job': [(JOB,)],
+    'claim_broadcast_deliveries': [(300, 100)],
+    'record_broadcast_delivery': [('sent', None, JOB, USER)],
+    'complete_finished_broadcast_jobs': [([JOB],)],
+    'get_recent_broadcast_jobs': [(10,)],
+    'add_bot_target_location': [('audit', -1009999999999, 'group', None, USER)],
+    'get_bot_target_location': [(LOCATION,)],
+    'update_bot_target_location': [('audit', -1009999999998, 'group', None, LOCATION)],
+    'delete_bot_target_location_db': [(LOCATION,)],
+    'add_bot_comment_template': [('audit new', 'text', None)],
+    'get_bot_comment_template': [(COMMENT_TEMPLATE,)],
+    'update_bot_comment_template': [('audit renamed', 'text', None, COMMENT_TEMPLATE)],
+    'delete_bot_comment_template_db': [(COMMENT_TEMPLATE,)],
+}
+
+# Statements bot.py assembles at runtime, built with the same helpers the bot uses
+DYNAMIC_STATEMENTS = [
+    ('iter_broadcast_recipients[all]', *bot.broadcast_recipients_query()),
+    ('iter_broadcast_recipients[cities]', *bot.broadcast_recipients_query([CITY, 'львів'])),
+    ('iter_broadcast_recipients[resume]', *bot.broadcast_recipients_query(after_chat_id=USER_BASE + 10_000)),
+    ('record_broadcast_delivery[sent]', bot.BROADCAST_JOB_COUNTER_SQL.format(counter='sent_count'), (JOB,)),
+    ('record_broadcast_delivery[failed]', bot.BROADCAST_JOB_COUNTER_SQL.format(counter='failed_count'), (JOB,)),
+]
+
+# Full-table reads that are intentional; each needs a reason
+ALLOWED_SEQ_SCANS = {
+    # Plain EXPLAIN plans for total cost; the bot reads this through a named cursor, which plans for fast start
+    'iter_broadcast_recipients[all]': "a whole-audience broadcast streams every reachable user",
+    'PostgresStateStore.__len__': "diagnostic count of every live dialog",
+    'rebuild_city_stats_rows': "drift repair recomputes the rollup from every row",
+}
+
+
+def collect_statements(path):
+    """Returns (qualified function name, index, sql, is_execute_values) for every literal statement."""
+    tree = ast.parse(open(path, encoding='utf-8').read())
+    statements = []
+
+    class Visitor(ast.NodeVisitor):
+        def __init__(self):
+            self.scope = []
+            self.counts = {}
+
+        def _scoped(self, node):
+            self.scope.append(node.name)
+            self.generic_visit(node)
+            self.scope.pop()
+
+        visit_ClassDef = visit_FunctionDef = _scoped
+
+        def visit_Call(self, node):
+            func = node.func
+            if isinstance(func, ast.Attribute) and func.attr == 'execute' and node.args:
+                sql, batched = node.args[0], False
+            elif isinstance(func, ast.Name) and func.id == 'execute_values' and len(node.args) > 1:
+                sql, batched = node.args[1], True
+            else:
+                sql = None
+            if isinstance(sql, ast.Constant) and isinstance(sql.value, str):
+                name = '.'.join(self.scope)
+                index = self.counts.get(name, 0)
+                self.counts[name] = index + 1
+                statements.append((name, index, sql.value, batched))
+            self.generic_visit(node)
+
+    Visitor().visit(tree)
+    return statements
+
+
+def seed(cur, users):
+    """Inserts synthetic rows shaped like production data and refreshes planner statistics."""
+    cities = sorted(bot.UKRAINIAN_CITIES)
+    cur.execute("""
+        INSERT INTO users (chat_id, username, first_name, city, is_active, notifications, registration_date)
+        SELECT %s + g, 'user' || g, 'User', (%s::text[])[1 + mod(g, %s)],
+               mod(g, 20) <> 0, mod(g, 10) <> 0, CURRENT_TIMESTAMP - g * INTERVAL '1 minute'
+        FROM generate_series(1, %s) g;
+    """, (USER_BASE, cities, len(cities), users))
+    for table, name_column in (('target_channels', 'channel_name'), ('target_groups', 'group_name')):
+        cur.execute(f"""
+            INSERT INTO {table} (id, {name_column}, city, added_by, is_active, created_at)
+            SELECT %s + g, 'audit ' || g, (%s::text[])[1 + mod(g, %s)], %s + 1 + mod(g * 7, %s),
+                   mod(g, 15) <> 0, CURRENT_TIMESTAMP - g * INTERVAL '1 minute'
+            FROM generate_series(1, %s) g;
+        """, (ROW_BASE, cities, len(cities), USER_BASE, users, max(users // 4, 1)))
+    cur.execute("""
+        INSERT INTO broadcast_templates (id, name, title, message)
+        SELECT %s + g, 'audit-' || g, 'title', 'message' FROM generate_series(1, 50) g;
+    """, (ROW_BASE,))
+    cur.execute("""
+        INSERT INTO broadcast_ratings (user_chat_id, template_id, rating)
+        SELECT %s + u, %s + t, 1 + mod(u + t, 5)
+        FROM generate_series(1, %s) u, generate_series(1, 39) t
+        WHERE mod(u, 13) = mod(t, 13);
+    """, (USER_BASE, ROW_BASE, users))
+    cur.execute("""
+        INSERT INTO broadcast_jobs (id, template_id, name, message, requested_by, expanded, total_recipients)
+        VALUES (%s, %s, 'audit', 'message', %s, TRUE, %s);
+    """, (JOB, TEMPLATE, USER, users))
+    cur.execute("""
+        INSERT INTO broadcast_deliveries (job_id, chat_id, city, status, attempts, claimed_at)
+        SELECT %s, %s + g, NULL, CASE WHEN mod(g, 50) = 0 THEN 'pending' ELSE 'sent' END, 1, CURRENT_TIMESTAMP
+        FROM generate_series(1, %s) g;
+    """, (JOB, USER_BASE, users))
+    cur.execute("""
+        INSERT INTO conversation_states (chat_id, state, expires_at)
+        SELECT %s + g, '{}', CURRENT_TIMESTAMP + (CASE WHEN mod(g, 100) = 0 THEN -1 ELSE 1 END) * mod(g, 60) * INTERVAL '1 minute'
+        FROM generate_series(1, %s) g;
+    """, (USER_BASE, max(users // 10, 1)))
+    cur.execute("""
+        INSERT INTO bot_target_locations (id, location_name, location_id, location_type, added_by)
+        SELECT %s + g, 'audit ' || g, -1009000000000 - g, 'group', %s FROM generate_series(1, 20) g;
+    """, (ROW_BASE, USER))
+    cur.execute("""
+        INSERT INTO bot_comment_templates (id, name, message_text)
+        SELECT %s + g, 'audit-' || g, 'text' FROM generate_series(1, 20) g;
+    """, (ROW_BASE,))
+    for table in SEEDED_TABLES:
+        cur.execute(f"ANALYZE {table};")
+
+
+def has_users():
+    """True when the database already holds users (a fresh scratch database has no users table yet)."""
+    conn = psycopg2.connect(bot.DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('users') IS NOT NULL;")
+            if not cur.fetchone()[0]:
+                return False
+            cur.execute("SELECT EXISTS (SELECT 1 FROM users);")
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def vacuum_seeded_tables():
+    """Reclaims the rolled-back seed rows; left in place they skew the next run's plans."""
+    conn = psycopg2.connect(bot.DATABASE_URL)
+    try:
+        conn.autocommit = True # VACUUM cannot run inside a transaction
+        with conn.cursor() as cur:
+            for table in SEEDED_TABLES:
+                cur.execute(f"VACUUM ANALYZE {table};")
+    finally:
+        conn.close()
+
+
+def seq_scans(plan, threshold):
+    """Yields (relation, rows read) for every Seq Scan node reading at least threshold rows."""
+    if plan.get('Node Type') == 'Seq Scan':
+        rows = (plan.get('Actual Rows', 0) + plan.get('Rows Removed by Filter', 0)) * plan.get('Actual Loops', 1)
+        if rows >= threshold:
+            yield plan.get('Relation Name'), rows
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child, threshold)
+
+
+def explain(cur, sql, params, batched):
+    """Runs the statement under EXPLAIN ANALYZE and returns the JSON plan."""
+    prefix = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+    if batched:
+        result = execute_values(cur, prefix + sql, params, fetch=True)
+    else:
+        cur.execute(prefix + sql, params)
+        result = cur.fetchall()
+    document = result[0]['QUERY PLAN']
+    return (json.loads(document) if isinstance(document, str) else document)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000, help="synthetic users to seed (default 20000)")
+    parser.add_argument('--threshold', type=int, default=1000,
+                        help="fail on sequential scans reading at least this many rows (default 1000)")
+    parser.add_argument('--verbose', action='store_true', help="print every plan")
+    parser.add_argument('--force', action='store_true', help="run even though users is not empty")
+    args = parser.parse_args()
+
+    statements = []
+    missing = []
+    for name, index, sql, batched in collect_statements(os.path.join(ROOT, 'bot.py')):
+        if name in SKIP_FUNCTIONS or name.startswith('_migration_') or not sql.lstrip().upper().startswith(EXPLAINABLE):
+            continue
+        if '%s' in sql:
+            samples = SAMPLE_PARAMS.get(name, [])
+            if index >= len(samples):
+                missing.append(f"{name} #{index}")
+                continue
+            params = samples[index]
+        else:
+            params = ()
+        statements.append((name if index == 0 else f"{name}#{index}", name, sql, params, batched))
+    for label, sql, params in DYNAMIC_STATEMENTS:
+        statements.append((label, label, sql, params, False))
+
+    # Checked before init_db so nothing (migrations, seed locks, VACUUM) touches a live database
+    if has_users() and not args.force:
+        sys.exit("users is not empty; point DATABASE_URL at a scratch database or pass --force")
+    bot.init_db()
+    conn = bot.get_db_connection()
+    failures = []
+    try:
+        with conn.cursor() as cur:
+            seed(cur, args.users)
+            # A function's statements run in order (later ones may depend on earlier writes),
+            # and its writes are undone before the next function runs
+            cur.execute("SAVEPOINT audit_function;")
+            previous = None
+            for label, name, sql, params, batched in statements:
+                if name != previous:
+                    cur.execute("ROLLBACK TO SAVEPOINT audit_function;")
+                    previous = name
+                plan = explain(cur, sql, params, batched)
+                top = plan['Plan']
+                scans = list(seq_scans(top, args.threshold))
+                allowed = ALLOWED_SEQ_SCANS.get(name)
+                status = 'ok'
+                if scans:
+                    status = 'allowed' if allowed else 'FAIL'
+                    if not allowed:
+                        failures.append((label, scans))
+                print(f"{status:8} {plan['Execution Time']:9.2f} ms  {top['Node Type']:<18} {label}"
+                      + (f"  seq scan: {', '.join(f'{rel} ({rows} rows)' for rel, rows in scans)}" if scans else ""))
+                if args.verbose:
+                    print(json.dumps(top, indent=2, ensure_ascii=False))
+    finally:
+        conn.rollback()
+        conn.close()
+        vacuum_seeded_tables()
+
+    for name in missing:
+        print(f"MISSING  no sample parameters for {name}")
+    if failures or missing:
+        print(f"\n{len(failures)} statement(s) with sequential scans over {args.threshold} rows, "
+              f"{len(missing)} without sample parameters.")
+        return 1
+    print(f"\nAll {len(statements)} statements pass (threshold {args.threshold} rows).")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+Seed data generator: bulk-loads realistic users, channels, groups, broadcast templates and ratings
+with COPY, for benchmarking (tools/db_benchmark.py) at production-like sizes.
+
+The target database must be a scratch one: the generator refuses to touch a non-empty users
+table unless --reset is given, which TRUNCATEs every table the bot writes to.
+
+    DATABASE_URL=postgresql://localhost/botdb_bench python tools/seed_data.py --users 1000000 --reset
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2  # noqa: E402
+from psycopg2.extras import execute_values  # noqa: E402
+
+import bot  # noqa: E402
+
+# Rows written per COPY statement (each one also fires the statistics triggers once)
+COPY_CHUNK = 100_000
+RESET_TABLES = ('broadcast_deliveries', 'broadcast_jobs', 'broadcast_ratings', 'broadcast_rating_stats',
+                'broadcast_templates', 'target_channels', 'target_groups', 'conversation_states', 'users')
+# Share of users per rating 1..5; most feedback on broadcasts is positive
+RATING_WEIGHTS = (5, 5, 15, 35, 40)
+
+
+def city_weights(cities):
+    """Zipf-like weights: a few big cities hold most users, like the real audience."""
+    return [1 / (rank ** 1.1) for rank in range(1, len(cities) + 1)]
+
+
+def copy_rows(cur, table, columns, rows):
+    """Streams tuples into `table` with COPY, COPY_CHUNK rows per statement; None becomes NULL."""
+    total = 0
+    buffer = io.StringIO()
+    count = 0
+
+    def flush():
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+        buffer.seek(0)
+        buffer.truncate()
+
+    for row in rows:
+        buffer.write('\t'.join(r'\N' if value is None else str(value) for value in row))
+        buffer.write('\n')
+        count += 1
+        if count == COPY_CHUNK:
+            flush()
+            total += count
+            count = 0
+    if count:
+        flush()
+        total += count
+    return total
+
+
+def generate_users(rng, chat_ids, cities, now):
+    weights = city_weights(cities)
+    for chat_id, city in zip(chat_ids, rng.choices(cities, weights, k=len(chat_ids))):
+        registered = now - timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        yield (chat_id, f"user{chat_id}" if rng.random() < 0.7 else None, f"User {chat_id % 100000}",
+               registered.isoformat(sep=' '), rng.random() < 0.92, rng.random() < 0.85,
+               city if rng.random() < 0.98 else None)
+
+
+def generate_targets(rng, chat_ids, cities, share, now):
+    """Channels or groups added by `share` of the users, one to three each."""
+    for chat_id in chat_ids:
+        if rng.random() >= share:
+            continue
+        for n in range(rng.randint(1, 3)):
+            created = now - timedelta(seconds=rng.randrange(180 * 24 * 3600))
+            yield (f"Target {chat_id}-{n}", f"https://t.me/target{chat_id}_{n}", rng.choice(cities), chat_id,
+                   rng.random() < 0.9, created.isoformat(sep=' '))
+
+
+def generate_ratings(rng, chat_ids, template_ids, share):
+    for chat_id in chat_ids:
+        if rng.random() >= share:
+            continue
+        for template_id in rng.sample(template_ids, min(len(template_ids), rng.randint(1, 3))):
+            yield chat_id, template_id, rng.choices((1, 2, 3, 4, 5), RATING_WEIGHTS)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, required=True, help="users to generate")
+    parser.add_argument('--reset', action='store_true', help="TRUNCATE the bot's tables first")
+    parser.add_argument('--templates', type=int, default=50, help="broadcast templates (default 50)")
+    parser.add_argument('--channel-share', type=float, default=0.05, help="users who added channels (default 0.05)")
+    parser.add_argument('--group-share', type=float, default=0.03, help="users who added groups (default 0.03)")
+    parser.add_argument('--rating-share', type=float, default=0.3, help="users who rated broadcasts (default 0.3)")
+    parser.add_argument('--seed', type=int, default=94, help="random seed, for repeatable datasets (default 94)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cities = list(bot.UKRAINIAN_CITIES) # Listed from the biggest city down
+    now = datetime.now()
+    bot.init_db()
+    started = time.monotonic()
+
+    conn = bot.get_db_connection()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                if args.reset:
+                    cur.execute(f"TRUNCATE {', '.join(RESET_TABLES)} RESTART IDENTITY CASCADE;")
+                else:
+                    cur.execute("SELECT EXISTS (SELECT 1 FROM users) AS has_users;")
+                    if cur.fetchone()['has_users']:
+                        sys.exit("users is not empty; point DATABASE_URL at a scratch database or pass --reset")
+
+                # Telegram user ids are large and arrive in no particular order
+                chat_ids = rng.sample(range(100_000_000, 8_000_000_000), args.users)
+                users = copy_rows(cur, 'users', ('chat_id', 'username', 'first_name', 'registration_date',
+                                                 'is_active', 'notifications', 'city'),
+                                  generate_users(rng, chat_ids, cities, now))
+                channels = copy_rows(cur, 'target_channels', ('channel_name', 'channel_link', 'city', 'added_by',
+                                                              'is_active', 'created_at'),
+                                     generate_targets(rng, chat_ids, cities, args.channel_share, now))
+                groups = copy_rows(cur, 'target_groups', ('group_name', 'group_link', 'city', 'added_by',
+                                                          'is_active', 'created_at'),
+                                   generate_targets(rng, chat_ids, cities, args.group_share, now))
+                template_ids = [row['id'] for row in execute_values(cur, """
+                    INSERT INTO broadcast_templates (name, title, message, target_cities) VALUES %s RETURNING id;
+                """, [(f"seed-{n}", f"Seed broadcast {n}", f"Seed broadcast message {n}",
+                       ','.join(rng.sample(cities, 3)) if n % 2 else None) for n in range(args.templates)],
+                    fetch=True)]
+                ratings = copy_rows(cur, 'broadcast_ratings', ('user_chat_id', 'template_id', 'rating'),
+                                    generate_ratings(rng, chat_ids, template_ids, args.rating_share))
+                # TRUNCATE bypasses the statistics triggers, so the rollup is recomputed from scratch
+                bot.rebuild_city_stats_rows(cur)
+    finally:
+        conn.close()
+
+    # Fresh statistics and visibility maps, so plans match a long-running database
+    conn = psycopg2.connect(bot.DATABASE_URL)
+    try:
+        conn.autocommit = True # VACUUM cannot run inside a transaction
+        with conn.cursor() as cur:
+            for table in RESET_TABLES + ('city_stats',):
+                cur.execute(f"VACUUM ANALYZE {table};")
+    finally:
+        conn.close()
+    print(f"Seeded {users} users, {channels} channels, {groups} groups, {len(template_ids)} templates, "
+          f"{ratings} ratings in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+"""
+Broadcast delivery worker (the `worker` process type in the Procfile).
+Claims pending broadcast deliveries from Postgres and sends them; run as many
+as needed across dynos, they coordinate only through DATABASE_URL.
+
+Telegram's ~30 messages/s limit is per bot, not per process: TELEGRAM_RATE_PER_SECOND is the
+bot-wide budget, and every sending process (each worker and the web process) takes an equal
+share of it through the outbound_senders heartbeat (bot.RateShare). More workers therefore
+drain the queue in parallel but never send faster than the budget in total. The web process
+runs no delivery worker of its own when deployed with this Procfile.
+"""
+import logging
+
+from bot import init_db, rate_share, run_broadcast_worker
+
+if __name__ == '__main__':
+    init_db()
+    rate_share.start()
+    logging.info("Broadcast worker запущено...")
+    try:
+        run_broadcast_worker()
+    finally:
+        rate_share.close()